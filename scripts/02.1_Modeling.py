@@ -22,44 +22,110 @@ from sklearn.metrics import classification_report
 from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay
 import seaborn as sns
 import os
+from camr.coefficients import top_coefficients
+from camr.h5ad import read_h5ad_columns
+from camr.model_cache import ModelCache, cache_key
+from camr.store import fingerprint, load_summary_store
+from camr.xenium import panel_feasible_genes, read_panel_targets
+from camr.modeling import (balanced_subsample, fit_incremental, fit_l1_path, fit_ovr, holdout_rows, ovr_coefficients,
+                           predict_incremental, run_grouped_jobs, to_csr32, track_resources)
 
 os.chdir('/project/hipaa_ycheng11lab/atlas/CAMR2024')
 sc.settings.n_jobs = -1
 
 number_of_features = 20
 ncols = 2
+sparse_training = False # CSR float32 + saga in parallel threads: faster, but saga converges to different coefficients than lbfgs and so can change the top markers; False keeps the published lbfgs fit
+n_jobs = 16
+parallel_majorclasses = True # Train every major class at once in its own process, cores split by class size
+n_cores = len(os.sched_getaffinity(0))
+incremental_training = False # Stream shuffled cell chunks from the h5ad into SGD partial_fit; memory stays at one chunk
+incremental_majorclass_model = True # In incremental mode, also train the full-atlas majorclass model
+epochs = 5
+chunk_size = 50000 # Cells per partial_fit call
+panel_feasible_only = False # Train only on genes that can pass the 03.1 Xenium length and 4-100 raw count filters
+cells_per_subtype = None # Cap on training cells per author_cell_type (None for all); see 02.2_Subsample_Benchmark.py to choose it
+cap_per_reference = False # Apply the cap per author_cell_type and reference study instead
+label_columns = ['author_cell_type', 'reference'] # obs columns handed to each major class job
+l1_path_training = False # Sweep a warm-started L1 path per major class and keep the most accurate model within the gene budget
+l1_Cs = np.logspace(-3, 0, 16) # Path from few to many genes
+l1_ratio = None # None for L1; between 0 and 1 for elastic net
+gene_budget_panel = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '9MV3RF_mRetina_91g_panel.json') # Its targets are the genes per model (91)
+gene_budget = len(read_panel_targets(gene_budget_panel)) if l1_path_training else None # Only read when the L1 path uses it
+genes_per_subtype = None # Most genes any one subtype may use; None for no per-class budget
+use_model_cache = True # Restore models whose data, cells, genes and parameters are unchanged from 02_Modeling/<analysis>/cache instead of retraining
 
-adata = ad.read_h5ad('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad')
+h5ad_path = '01_QualityControl/1_camr_scrublet_batch_filtered.h5ad'
+if incremental_training:
+    adata = read_h5ad_columns(h5ad_path, obs = ['majorclass'] + label_columns, var = ['feature_name'], matrix = None) # No matrix in memory
+else:
+    adata = read_h5ad_columns(h5ad_path, obs = ['majorclass'] + label_columns, var = ['feature_name'], matrix = 'X') # X only, no raw
+var = adata.var[['feature_name']].copy()
 
-for majorclass in adata.obs['majorclass'].cat.categories:
+# Everything besides the data, cells and genes that changes a model or its artifacts
+training_parameters = dict(sparse_training = sparse_training, incremental_training = incremental_training, epochs = epochs,
+                           chunk_size = chunk_size, cells_per_subtype = cells_per_subtype, cap_per_reference = cap_per_reference,
+                           l1_path_training = l1_path_training, l1_Cs = list(l1_Cs), l1_ratio = l1_ratio, gene_budget = gene_budget,
+                           genes_per_subtype = genes_per_subtype, number_of_features = number_of_features,
+                           max_iter = 1000, test_size = 0.2, random_state = 42, sklearn = sk.__version__)
+h5ad_fingerprint = fingerprint(h5ad_path)
+data_fingerprint = h5ad_fingerprint if use_model_cache else None
 
-    print(f'{datetime.datetime.now()} Major Class: {majorclass}')
-    
-    # Extract feature matrix (X) and target vector (y)
-    X = adata.X[adata.obs['majorclass'] == majorclass, :]
-    y = adata.obs.loc[adata.obs['majorclass'] == majorclass, 'author_cell_type']
-    
-    if len(y.unique()) < 2:
-        continue
-    
-    le = LabelEncoder()
-    _ = le.fit_transform(y)
-    
-    # Split data into training and testing sets
-    X_train, X_test, y_train_subclass, y_test_subclass = train_test_split(X, y_encoded, test_size=0.2, random_state=42)
-    
-    ovr_classifier_subclass = LogisticRegression(multi_class='ovr', max_iter=1000, random_state=42, n_jobs = 16)
-    ovr_classifier_subclass.fit(X_train, y_train_subclass)
+feature_columns = {} # Model ('majorclass' or a major class) -> gene columns it is trained on; all genes when missing
+if panel_feasible_only:
+    summary_store = load_summary_store(h5ad_path)
+    minor_to_major = summary_store.group_pairs('author_cell_type', 'majorclass')
+    for majorclass in adata.obs['majorclass'].cat.categories:
+        subtypes = minor_to_major.loc[minor_to_major['majorclass'] == majorclass, 'author_cell_type']
+        feasible = panel_feasible_genes(summary_store, subtypes)
+        feature_columns[majorclass] = np.flatnonzero(var.index.isin(feasible.index[feasible]))
+    feasible = panel_feasible_genes(summary_store, groupby = 'majorclass')
+    feature_columns['majorclass'] = np.flatnonzero(var.index.isin(feasible.index[feasible]))
+    for model, columns in feature_columns.items():
+        print(f'{datetime.datetime.now()} {model}: {len(columns)} of {len(var)} genes are panel feasible')
+
+def artifact_paths(analysis, tag):
+    # Output files of one model, by artifact name
+    return {'model': f'02_Modeling/{analysis}/2_ovr_LogReg_{tag}.pkl',
+            'report': f'02_Modeling/{analysis}/2_{tag}_validation_report.txt',
+            'confusion': f'02_Modeling/figures/confusion_matrix_{tag}.pdf',
+            'coefficients': f'02_Modeling/{analysis}/2_ovr_LogReg_{tag}_AbsTop{number_of_features}Markers.txt',
+            'l1_path': f'02_Modeling/{analysis}/2_{tag}_l1_path.txt'}
+
+def cached_model(analysis, tag, cells, columns):
+    # (cache, key, record): record is the stored training record with the artifacts restored on a hit, None on a miss
+    if not use_model_cache:
+        return None, None, None
+    cache = ModelCache(f'02_Modeling/{analysis}/cache')
+    key = cache_key(data_fingerprint, cells, columns, training_parameters)
+    cached = cache.load(tag, key)
+    if cached is None:
+        return cache, key, None
+    print(f'{datetime.datetime.now()} {tag}: cached model {key}')
+    cached.restore(artifact_paths(analysis, tag))
+    return cache, key, dict(cached.meta['record'], cached = True)
+
+def cache_model(cache, key, model, analysis, tag, record):
+    # Stores a freshly trained model with its artifacts (the L1 path table only when it was written by this run)
+    if cache is not None:
+        files = {name: path for name, path in artifact_paths(analysis, tag).items() if name != 'l1_path' or l1_path_training}
+        cache.save(tag, key, model, files, meta = {'record': record})
+    return record
+
+def write_model_artifacts(ovr_classifier_subclass, le, y_test_subclass, y_pred_subclass_ovr, analysis, tag, majorclass = None, columns = None):
+    # Pickled model, validation report, confusion matrix and top/bottom coefficient genes of one model
+    # analysis: 'minorclass' or 'majorclass' output folder; tag: file name part, e.g. minorclass-AC
+    # majorclass: Major class of a subtype model, None for the majorclass model
+    # columns: Gene columns the model was trained on, None for all genes
+    genes = var if columns is None else var.iloc[columns]
+    paths = artifact_paths(analysis, tag)
     
-    model_filename = f'02_Modeling/minorclass/2_ovr_LogReg_minorclass-{majorclass}.pkl'
-    joblib.dump(ovr_classifier_subclass, model_filename)
+    joblib.dump(ovr_classifier_subclass, paths['model'])
     
-    # Validation
-    y_pred_subclass_ovr = ovr_classifier_subclass.predict(X_test)
     target_names = le.inverse_transform(np.unique(y_test_subclass))
     validation_report = classification_report(y_test_subclass, y_pred_subclass_ovr, target_names=target_names)
     print(validation_report)
-    with open(f"02_Modeling/minorclass/2_minorclass-{majorclass}_validation_report.txt", "w") as report_file:
+    with open(paths['report'], "w") as report_file:
         report_file.write(validation_report)
     
     # Generate the confusion matrix
@@ -71,37 +137,120 @@ for majorclass in adata.obs['majorclass'].cat.categories:
                 yticklabels=le.inverse_transform(ovr_classifier_subclass.classes_))
     plt.xlabel('Predicted Label')
     plt.ylabel('True Label')
-    plt.title(f'{majorclass}: {100 * cm.diagonal().sum() / cm.sum()}% Accuracy')
-    plt.savefig(f"02_Modeling/figures/confusion_matrix_minorclass-{majorclass}.pdf", bbox_inches='tight')
+    plt.title(f'{majorclass or analysis}: {100 * cm.diagonal().sum() / cm.sum()}% Accuracy')
+    plt.savefig(paths['confusion'], bbox_inches='tight')
     plt.show()
     
-    print(f"{majorclass} Minorclass:", le.inverse_transform(ovr_classifier_subclass.classes_))
-    
-    # Get class-specific coefficients
-    class_coefficients = ovr_classifier_subclass.coef_
-    num_classes = len(le.classes_)
-    nrows = (num_classes // ncols) + (num_classes % ncols)
-    
-    # Get the top 20 important features for each class for each direction
-    all_top_features_df = pd.DataFrame(columns=['Name', 'Major_Name', 'Ensembl', 'Marker', 'Coefficient'])
-    for idx, class_name in enumerate(le.inverse_transform(ovr_classifier_subclass.classes_)):
-        
-        print(f'{datetime.datetime.now()} Subclass: {class_name}')
-        
-        if len(ovr_classifier_subclass.classes_) == 2 and idx == 1:
-            continue # Binary classifications use only 1 regression equation
-        
-        coefficients = class_coefficients[idx]
-        all_feature_importance = pd.DataFrame({
-            'Name': class_name,
-            'Major_Name': majorclass,
-            'Ensembl': adata.var_names,
-            'Marker': adata.var['feature_name'].astype(str),
-            'Coefficient': coefficients
-        })
-        top_features_df = all_feature_importance.sort_values(by='Coefficient', ascending=False).head(number_of_features)
-        bottom_features_df = all_feature_importance.sort_values(by='Coefficient', ascending=True).head(number_of_features)
-        all_top_features_df = pd.concat([all_top_features_df, top_features_df, bottom_features_df], ignore_index=True)
-    # End subclass
-    all_top_features_df.to_csv(f'02_Modeling/minorclass/2_ovr_LogReg_minorclass-{majorclass}_AbsTop{number_of_features}Markers.txt', index=False, sep ='\t')
+    print(f"{majorclass or analysis} classes:", le.inverse_transform(ovr_classifier_subclass.classes_))
+    
+    # Top and bottom genes of every class, with sign, uniqueness and specificity margin, in one vectorized call
+    class_coefficients, _ = ovr_coefficients(ovr_classifier_subclass)
+    all_top_features_df = top_coefficients(class_coefficients, le.inverse_transform(ovr_classifier_subclass.classes_), genes.index,
+                                           genes['feature_name'].astype(str), k = number_of_features, major_name = majorclass)
+    all_top_features_df.to_csv(paths['coefficients'], index=False, sep ='\t')
+# End write_model_artifacts
+
+
+def train_majorclass(majorclass, X, labels, n_jobs):
+    # X and labels (the label_columns of obs) hold the cells of one major class; returns the training resources or None if there is nothing to train
+
+    print(f'{datetime.datetime.now()} Major Class: {majorclass}')
+    
+    labels = pd.DataFrame(np.asarray(labels), columns = label_columns).astype(str)
+    y = labels['author_cell_type']
+    if len(y.unique()) < 2:
+        return None
+    
+    le = LabelEncoder()
+    y_encoded = le.fit_transform(y)
+    columns = feature_columns.get(majorclass)
+    tag = f'minorclass-{majorclass}'
+    cache, key, record = cached_model('minorclass', tag, [majorclass, labels], columns) # Cells: the major class and its labels in this h5ad
+    if record is not None:
+        return record
+    if columns is not None:
+        X = X[:, columns]
+    
+    # Split data into training and testing sets
+    X_train, X_test, y_train_subclass, y_test_subclass, reference_train, _ = train_test_split(X, y_encoded, labels['reference'].to_numpy(), test_size=0.2, random_state=42)
+    if cells_per_subtype is not None: # Validation still uses every held-out cell
+        keep = balanced_subsample(y_train_subclass, cells_per_subtype, reference_train if cap_per_reference else None, random_state = 42)
+        X_train, y_train_subclass = X_train[keep], y_train_subclass[keep]
+    
+    with track_resources(f'{majorclass} training ({len(le.classes_)} subtypes, {X_train.shape[0]} cells)') as usage:
+        if l1_path_training:
+            # C is picked on cells split off the training cells, so the held-out test cells stay unseen for the report below
+            X_fit, X_validation, y_fit, y_validation = train_test_split(X_train, y_train_subclass, test_size=0.2, random_state=42)
+            l1_path = fit_l1_path(X_fit, y_fit, X_validation, y_validation, l1_Cs, l1_ratio, n_jobs = n_jobs, random_state = 42)
+            path_table = l1_path.table()
+            selected = l1_path.select(gene_budget, genes_per_subtype)
+            path_table['Selected'] = path_table.index == selected
+            path_table.to_csv(artifact_paths('minorclass', tag)['l1_path'], index=False, sep='\t')
+            ovr_classifier_subclass = l1_path.model(selected)
+        elif sparse_training:
+            ovr_classifier_subclass = fit_ovr(to_csr32(X_train), y_train_subclass, n_jobs = n_jobs, max_iter = 1000, random_state = 42)
+        else:
+            ovr_classifier_subclass = LogisticRegression(multi_class='ovr', max_iter=1000, random_state=42, n_jobs = n_jobs)
+            ovr_classifier_subclass.fit(X_train, y_train_subclass)
+    
+    # Validation
+    y_pred_subclass_ovr = ovr_classifier_subclass.predict(to_csr32(X_test) if sparse_training or l1_path_training else X_test)
+    write_model_artifacts(ovr_classifier_subclass, le, y_test_subclass, y_pred_subclass_ovr, 'minorclass', tag, majorclass, columns)
+    
+    record = dict(usage, majorclass = majorclass, n_subtypes = len(le.classes_), n_cells = X_train.shape[0])
+    return cache_model(cache, key, ovr_classifier_subclass, 'minorclass', tag, record)
 # End majorclass
+
+def train_incremental(analysis, tag, rows, y, majorclass = None):
+    # Out-of-core version of train_majorclass(): rows are h5ad row numbers; held-out rows are kept in 02_Modeling/<analysis>/
+    
+    print(f'{datetime.datetime.now()} {analysis}: {tag}')
+    
+    y = pd.Series(np.asarray(y).astype(str), index = rows)
+    if len(y.unique()) < 2:
+        return None
+    
+    le = LabelEncoder()
+    le.fit(y)
+    columns = feature_columns.get(majorclass or analysis)
+    cache, key, record = cached_model(analysis, tag, [rows, y], columns)
+    if record is not None:
+        return record
+    train_rows, test_rows = holdout_rows(rows, f'02_Modeling/{analysis}/2_{tag}_heldout_rows.{h5ad_fingerprint}.{len(rows)}.npy', # One split per data and cell set
+                                         test_size = 0.2, random_state = 42)
+    if cells_per_subtype is not None: # Cap per class of this model; validation still uses every held-out cell
+        reference = adata.obs['reference'].iloc[train_rows] if cap_per_reference else None
+        train_rows = train_rows[balanced_subsample(y.loc[train_rows], cells_per_subtype, reference, random_state = 42)]
+    
+    with track_resources(f'{tag} incremental training ({len(le.classes_)} classes, {len(train_rows)} cells)') as usage:
+        ovr_classifier = fit_incremental(h5ad_path, train_rows, le.transform(y.loc[train_rows]), np.arange(len(le.classes_)),
+                                         epochs = epochs, chunk_size = chunk_size, n_jobs = n_jobs, random_state = 42, columns = columns)
+    
+    # Validation
+    y_pred = predict_incremental(ovr_classifier, h5ad_path, test_rows, chunk_size = chunk_size, columns = columns)
+    write_model_artifacts(ovr_classifier, le, le.transform(y.loc[test_rows]), y_pred, analysis, tag, majorclass, columns)
+    
+    record = dict(usage, majorclass = majorclass or analysis, n_subtypes = len(le.classes_), n_cells = len(train_rows))
+    return cache_model(cache, key, ovr_classifier, analysis, tag, record)
+# End train_incremental
+
+
+if incremental_training:
+    results = {}
+    for majorclass in adata.obs['majorclass'].cat.categories:
+        rows = np.flatnonzero((adata.obs['majorclass'] == majorclass).to_numpy())
+        results[majorclass] = train_incremental('minorclass', f'minorclass-{majorclass}', rows, adata.obs['author_cell_type'].iloc[rows], majorclass)
+    if incremental_majorclass_model:
+        results['majorclass'] = train_incremental('majorclass', 'majorclass', np.arange(adata.n_obs), adata.obs['majorclass'])
+elif parallel_majorclasses:
+    # Rows sorted by major class go to a scratch copy under 02_Modeling/minorclass once; each process memory-maps its own rows
+    results = run_grouped_jobs(train_majorclass, adata.X, adata.obs['majorclass'], adata.obs[label_columns],
+                               '02_Modeling/minorclass', n_cores = n_cores)
+else:
+    results = {}
+    for majorclass in adata.obs['majorclass'].cat.categories:
+        in_majorclass = (adata.obs['majorclass'] == majorclass).to_numpy()
+        results[majorclass] = train_majorclass(majorclass, adata.X[in_majorclass, :], adata.obs.loc[in_majorclass, label_columns], n_jobs)
+training_resources = [usage for usage in results.values() if usage is not None]
+
+pd.DataFrame(training_resources).to_csv('02_Modeling/minorclass/2_training_resources.txt', index=False, sep='\t')
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Accuracy vs training set size for the minorclass models of 02.1_Modeling.py.
+# Every major class is refit on the same 80% training split as 02.1, capped at a number of cells per author_cell_type,
+# and validated on the whole held-out 20%. Fit time, peak memory and per-subtype F1 are recorded for each cap;
+# the smallest cap whose F1 matches the uncapped model (cap "all", the current validation reports) goes into
+# cells_per_subtype in 02.1_Modeling.py.
+import datetime
+print(f'{datetime.datetime.now()} Analysis Setup')
+
+import anndata as ad
+import matplotlib.pyplot as plt
+import pandas as pd
+import numpy as np
+import seaborn as sns
+import os
+from sklearn.model_selection import train_test_split
+from sklearn.preprocessing import LabelEncoder
+from sklearn.metrics import f1_score
+from camr.modeling import balanced_subsample, fit_ovr, to_csr32, track_resources
+
+os.chdir('/project/hipaa_ycheng11lab/atlas/CAMR2024')
+
+majorclasses = ['AC', 'BC', 'Microglia', 'RGC']
+caps = [100, 250, 500, 1000, 2500, None] # Training cells per subtype; None for every cell
+cap_per_reference = False # Cap per author_cell_type and reference study instead
+n_jobs = 16
+
+adata = ad.read_h5ad('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad')
+
+benchmark = []
+for majorclass in majorclasses:
+
+    print(f'{datetime.datetime.now()} Major Class: {majorclass}')
+
+    in_majorclass = (adata.obs['majorclass'] == majorclass).to_numpy()
+    X = to_csr32(adata.X[in_majorclass, :])
+    y = adata.obs.loc[in_majorclass, 'author_cell_type'].astype(str)
+    reference = adata.obs.loc[in_majorclass, 'reference'].astype(str).to_numpy()
+
+    le = LabelEncoder()
+    y_encoded = le.fit_transform(y)
+
+    # Same split as 02.1_Modeling.py
+    X_train, X_test, y_train_subclass, y_test_subclass, reference_train, _ = train_test_split(X, y_encoded, reference, test_size=0.2, random_state=42)
+
+    for cap in caps:
+        keep = balanced_subsample(y_train_subclass, cap, reference_train if cap_per_reference else None, random_state = 42)
+        with track_resources(f'{majorclass} cap {cap}: {len(keep)} of {len(y_train_subclass)} training cells') as usage:
+            ovr_classifier_subclass = fit_ovr(X_train[keep], y_train_subclass[keep], n_jobs = n_jobs, max_iter = 1000, random_state = 42)
+        y_pred_subclass_ovr = ovr_classifier_subclass.predict(X_test)
+
+        f1 = f1_score(y_test_subclass, y_pred_subclass_ovr, labels = np.arange(len(le.classes_)), average = None, zero_division = 0)
+        benchmark += [pd.DataFrame({
+            'Major_Name': majorclass,
+            'Cap': 'all' if cap is None else cap,
+            'Training_Cells': len(keep),
+            'Wall_s': usage['wall_s'],
+            'Peak_RSS_GB': usage['peak_rss_gb'],
+            'Children_Peak_RSS_GB': usage['children_peak_rss_gb'], # lbfgs workers, if any
+            'Name': le.classes_,
+            'F1': f1,
+            'Macro_F1': f1.mean()
+        })]
+# End majorclass
+
+benchmark = pd.concat(benchmark, ignore_index = True)
+full_f1 = benchmark.loc[benchmark['Cap'] == 'all'].set_index(['Major_Name', 'Name'])['F1']
+benchmark['F1_Change'] = benchmark['F1'].to_numpy() - full_f1.reindex(pd.MultiIndex.from_frame(benchmark[['Major_Name', 'Name']])).to_numpy()
+benchmark.to_csv('02_Modeling/minorclass/2_subsample_benchmark.txt', index = False, sep = '\t')
+
+summary = benchmark.drop_duplicates(['Major_Name', 'Cap'])
+fig, axes = plt.subplots(1, 2, figsize = (12, 5))
+sns.lineplot(data = summary, x = 'Training_Cells', y = 'Macro_F1', hue = 'Major_Name', marker = 'o', ax = axes[0])
+sns.lineplot(data = summary, x = 'Training_Cells', y = 'Wall_s', hue = 'Major_Name', marker = 'o', ax = axes[1])
+for ax in axes:
+    ax.set_xscale('log')
+axes[0].set_title('Macro F1 on the held-out cells')
+axes[1].set_title('Fit time (s)')
+plt.savefig('02_Modeling/figures/subsample_benchmark.pdf', bbox_inches = 'tight')
+plt.show()
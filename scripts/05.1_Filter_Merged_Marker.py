@@ -16,14 +16,16 @@ import numpy as np
 import seaborn as sns
 import os
 
+from camr.genes import load_gene_index
+from camr.h5ad import read_h5ad_columns
+from camr.hierarchy import load_hierarchy, relabel_categories
+from camr.store import load_summary_store
+from camr.xenium import XeniumFilter
+
 os.chdir('/project/hipaa_ycheng11lab/atlas/CAMR2024')
 os.makedirs('05_Filter_Merged_Markers', exist_ok = True)
 sc.settings.n_jobs = -1
-if True:
-    adata = ad.read_h5ad('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad')
-else:
-    adata = ad.read_h5ad('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad', backed='r')
-subcell_raw_mean = pd.read_csv('data/raw_meanExpression_minorclass.txt', sep = '\t')
+summary_store = load_summary_store() # Per group x gene statistics, built once per version of the h5ad
 
 sc.plotting.DotPlot.DEFAULT_SAVE_PREFIX = "05_Filter_Merged_Markers/figures/5_dotplot_"
 sc.plotting.DotPlot.DEFAULT_LARGEST_DOT = 200.0
@@ -35,33 +37,23 @@ if raw:
     data_string = "rawCounts"
     max_col = 4
 
-# Clean subtypes
-# Move some of this work to Quality Control so ALL adata from that point on have this.
-adata.obs = adata.obs.loc[:, ["majorclass", "author_cell_type"]]
-adata.obs["author_cell_type"] = adata.obs["author_cell_type"].astype(str)
-is_unassigned = adata.obs["author_cell_type"] == adata.obs["majorclass"]
-is_subtype = adata.obs["author_cell_type"].isin(["AC", "BC", "Microglia", "RGC"])
-unassigned_subtypes = adata.obs["author_cell_type"].loc[is_unassigned & is_subtype]
-adata.obs.loc[is_unassigned & is_subtype, "author_cell_type"] = ["Unassigned_" + uv for uv in unassigned_subtypes]
+gene_index = load_gene_index() # Symbol -> column lookups, built once per version of the h5ad
+hierarchy = load_hierarchy() # Cell-type codes saved next to the h5ad, built once per version of it
+adata = read_h5ad_columns('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad', # Only what this stage uses
+                          obs = ["majorclass", "author_cell_type"],
+                          var = ["gene_symbols", "feature_name", "feature_length"],
+                          matrix = "raw/X" if raw else "X")
+
+# Clean subtypes: Unassigned_* pseudo-subtypes as categories of the compiled hierarchy
+hierarchy.annotate(adata.obs, columns = ["author_cell_type"])
 
 
-# Make memory available
-if raw:
-    adata.X = adata.raw.X
-adata.raw = None
-adata.var = adata.var.loc[:, ["gene_symbols", "feature_name", "feature_length"]]
 adata.var["feature_name"] = adata.var["feature_name"].astype(str).str.capitalize()
 adata.var["feature_length"] = adata.var["feature_length"].astype(int)
 adata.var.index = adata.var["feature_name"] # subset on genes instead of booleans
 adata.var_names = adata.var["feature_name"] # subset on genes instead of booleans
 # adata.var_names_make_unique()
 
-import gc
-import ctypes
-gc.collect() # Free memory
-libc = ctypes.CDLL("libc.so.6") # clearing cache 
-libc.malloc_trim(0)
-
 
 merged_filtered_markers = pd.read_csv('04_Merge_Curated_Markers/4_harmonized_curated_markers.txt', sep = '\t')
 # small_coef = np.logical_or(merged_filtered_markers["Minor_Coefficient"] <= 0.3, merged_filtered_markers["Major_Coefficient"] <= 0.3)
@@ -69,90 +61,30 @@ merged_filtered_markers = pd.read_csv('04_Merge_Curated_Markers/4_harmonized_cur
 # merged_filtered_markers = merged_filtered_markers[~small_coef_in_query]
 # merged_filtered_markers.to_csv('05_Filter_Merged_Markers/5_merged_curated-queried_markers_coefficientFiltered.txt', sep ='\t', index = False)
 
-# Add gene length
-merged_filtered_markers.index = merged_filtered_markers["Marker"]
-merged_filtered_markers = merged_filtered_markers.join(adata.var["feature_length"])
-merged_filtered_markers.index = list(range(merged_filtered_markers.shape[0]))
-
-# Curated entries need a queried name to work with the next section
-# q2n = pd.read_csv('04_Merge_Curated_Markers/4_queried_to_name.txt', sep ='\t', index_col=0)
-# merged_filtered_markers.loc[merged_filtered_markers["Queried_Name"].isnull(), "Queried_Name"] = q2n["Queried_Name"].get(merged_filtered_markers.loc[merged_filtered_markers["Queried_Name"].isnull(), "Queried_Name"])
-
-# raw counts
-## minorclass
-### Pre-process names
-
-is_subtype = subcell_raw_mean["author_cell_type"].isin(["AC", "BC", "Microglia", "RGC"])
-unassigned_subtypes = subcell_raw_mean.loc[is_subtype, "author_cell_type"]
-subcell_raw_mean.loc[is_subtype, "author_cell_type"] = ["Unassigned_" + uv for uv in unassigned_subtypes]
-
-### Process table
-subcell_raw_mean_long = pd.melt(subcell_raw_mean, id_vars='author_cell_type', var_name='Marker', value_name='Raw_Mean_Expression_Minorclass_Marker')
-subcell_raw_mean_long = subcell_raw_mean_long.rename(columns={'author_cell_type':'Queried_Name'})
-subcell_raw_mean_long["Marker"] = subcell_raw_mean_long["Marker"].str.capitalize()
-major_sub_mean = subcell_raw_mean_long.loc[subcell_raw_mean_long['Raw_Mean_Expression_Minorclass_Marker'] >= 4]
-
-### Add expression data
-merged_filtered_markers = merged_filtered_markers.merge(major_sub_mean, on=['Queried_Name', 'Marker'], how = 'left')
-
-## majorclass
-major_raw_mean = pd.read_csv('data/raw_meanExpression_majorclass.txt', sep = '\t')
-major_raw_mean_long = pd.melt(major_raw_mean, id_vars='majorclass', var_name='Marker', value_name='Raw_Mean_Expression_Majorclass_Marker')
-major_raw_mean_long = major_raw_mean_long.rename(columns={'majorclass':'Major_Name'})
-major_raw_mean_long["Marker"] = major_raw_mean_long["Marker"].str.capitalize()
-# major_raw_mean_long = major_raw_mean_long.loc[major_raw_mean_long["Raw_Mean_Expression_Majorclass_Marker"] >= 4]
-
-merged_filtered_markers = merged_filtered_markers.merge(major_raw_mean_long, on=['Major_Name', 'Marker'], how = 'left')
-
-## all majorclass for each row
-major_raw_mean = major_raw_mean.T
-major_raw_mean.columns = major_raw_mean.iloc[0]
-major_raw_mean["Marker"] = major_raw_mean.index.astype(str).str.capitalize()
-major_raw_mean = major_raw_mean.drop(major_raw_mean.index[0])
-merged_filtered_markers = merged_filtered_markers.merge(major_raw_mean, on = 'Marker', how = 'left')
-
-
+# Gene length, target and all-group expression, detection and crowding, evaluated for every row at once
+# major_keep: long enough, detectable in some major class and crowding none; minor_keep: some AC/BC/Microglia/RGC class has a
+# detectable subtype and some has no crowding subtype (kept when not in the data); final_keep picks by whether the row targets a major class
+# Labels match exactly, as the merges on the table's names did
+xenium_filter = XeniumFilter(summary_store, match_case = True)
+length_expression_columns = merged_filtered_markers.columns.tolist() + ['feature_length', 'Raw_Mean_Expression_Minorclass_Marker', 'Raw_Mean_Expression_Majorclass_Marker'] + xenium_filter.majors.tolist()
+annotated_keep_columns = length_expression_columns + ['major_keep', 'is_major', 'minor_keep', 'final_keep']
+merged_filtered_markers = xenium_filter.annotate(merged_filtered_markers, marker = "Marker", target = "Queried_Name", major = "Major_Name")
 merged_filtered_markers = merged_filtered_markers.sort_values(['Major_Name', 'Name']) # For future
 merged_filtered_markers = merged_filtered_markers.drop_duplicates()
-merged_filtered_markers.to_csv('05_Filter_Merged_Markers/5_curated_markers_lengthExpression.txt', sep ='\t', index = False)
-
-merged_filtered_markers = pd.read_csv('05_Filter_Merged_Markers/5_curated_markers_lengthExpression.txt', sep ='\t')
-
-# Filter
-not_in_data = merged_filtered_markers["feature_length"].isnull()
-## majorclass
-long_enough = (merged_filtered_markers["feature_length"] >= 960)
-major_detectable = np.sum(merged_filtered_markers.loc[:, 'AC':'Rod'] >= 4, axis = 1) > 0 
-major_not_crowding = np.sum(merged_filtered_markers.loc[:, 'AC':'Rod'] > 100, axis = 1) == 0
-merged_filtered_markers["major_keep"] = long_enough & (major_detectable & major_not_crowding)
-merged_filtered_markers["is_major"] = merged_filtered_markers["Queried_Name"].isin(adata.obs["majorclass"].drop_duplicates())
-
-minorToMajor = adata.obs[["author_cell_type", "majorclass"]].drop_duplicates()
-subcell_raw_mean.index = subcell_raw_mean['author_cell_type']
-
-minor_detectable = np.zeros(sum(merged_filtered_markers["Marker"].isin(subcell_raw_mean.columns)))
-minor_not_crowding = np.zeros(sum(merged_filtered_markers["Marker"].isin(subcell_raw_mean.columns)))
-for majorclass in ["AC", "BC", "Microglia", "RGC"]:
-    sub_expr_mtx = subcell_raw_mean.loc[minorToMajor.loc[minorToMajor["majorclass"] == majorclass, "author_cell_type"], merged_filtered_markers.loc[merged_filtered_markers["Marker"].isin(subcell_raw_mean.columns), "Marker"]]
-    minor_detectable = minor_detectable | (np.sum(sub_expr_mtx >= 4, axis = 0) > 0)
-    minor_not_crowding = minor_not_crowding | (np.sum(sub_expr_mtx > 100, axis = 0) == 0)
-
-minor_keep = minor_detectable & minor_not_crowding
-minor_keep.name = "minor_keep"
-merged_filtered_markers.index = merged_filtered_markers.Marker
-merged_filtered_markers = merged_filtered_markers.join(minor_keep, how = "left").drop_duplicates()
-merged_filtered_markers.loc[merged_filtered_markers["minor_keep"].isnull(), "minor_keep"] = True
-
-merged_filtered_markers["final_keep"] = (merged_filtered_markers["minor_keep"] & (~merged_filtered_markers["is_major"])) | (merged_filtered_markers["major_keep"] & merged_filtered_markers["is_major"])
-merged_filtered_markers.to_csv('05_Filter_Merged_Markers/5_curated_markers_annotatedKeep_lengthExpression.txt', sep ='\t', index = False)
-
-merged_filtered_markers_filtered = merged_filtered_markers.loc[merged_filtered_markers["final_keep"]]
+merged_filtered_markers.to_csv('05_Filter_Merged_Markers/5_curated_markers_xeniumDiagnostics.txt', sep ='\t', index = False) # Every rule of the filter
+# The tables below keep their original columns: the subtype mean only where it is detectable, as the old merge with the >= 4 rows
+minor_mean = merged_filtered_markers["Raw_Mean_Expression_Minorclass_Target"]
+merged_filtered_markers["Raw_Mean_Expression_Minorclass_Marker"] = minor_mean.where(minor_mean >= 4)
+merged_filtered_markers["Raw_Mean_Expression_Majorclass_Marker"] = merged_filtered_markers["Raw_Mean_Expression_Majorclass_Target"]
+merged_filtered_markers[length_expression_columns].to_csv('05_Filter_Merged_Markers/5_curated_markers_lengthExpression.txt', sep ='\t', index = False) # Before the filters
+merged_filtered_markers[annotated_keep_columns].to_csv('05_Filter_Merged_Markers/5_curated_markers_annotatedKeep_lengthExpression.txt', sep ='\t', index = False)
+
+merged_filtered_markers_filtered = merged_filtered_markers.loc[merged_filtered_markers["final_keep"], annotated_keep_columns]
 merged_filtered_markers_filtered.to_csv('05_Filter_Merged_Markers/5_curated_markers_annotatedKeep_lengthExpressionFiltered.txt', sep ='\t', index = False)
 
 # Let's be strict here
-not_in_data.index = merged_filtered_markers.index
-merged_filtered_markers["final_keep"] = ((merged_filtered_markers["minor_keep"] & (~merged_filtered_markers["is_major"])) | (merged_filtered_markers["major_keep"] & merged_filtered_markers["is_major"])) & ~not_in_data
-merged_filtered_markers_filtered = merged_filtered_markers.loc[merged_filtered_markers["final_keep"]]
+merged_filtered_markers["final_keep"] = merged_filtered_markers["final_keep"] & ~merged_filtered_markers["Not_In_Data"]
+merged_filtered_markers_filtered = merged_filtered_markers.loc[merged_filtered_markers["final_keep"], annotated_keep_columns]
 merged_filtered_markers_filtered.to_csv('05_Filter_Merged_Markers/5_curated_markers_annotatedKeep_lengthExpressionMissingFiltered.txt', sep ='\t', index = False)
 
 merged_filtered_markers = merged_filtered_markers.sort_values(['Major_Name', 'Queried_Name']) # For now
@@ -176,22 +108,9 @@ for majorclass in adata.obs['majorclass'].cat.categories:
     
     marker2type = merged_filtered_markers.loc[is_major_marker, "Name"].tolist() + merged_filtered_markers.loc[is_subtype_marker, "Name"].tolist()
     
-    # sc.pl.dotplot throws a fit if there are duplicates
-    unique_markers = []
-    for i, m in enumerate(markers):
-        if m not in unique_markers:
-            unique_markers += [m]
-        else:
-            print(f'Found duplicate marker {m} in {marker2type[i]}!')
-
-    final_markers = []
-    for m in unique_markers: # Necessary to avoid "KeyError: "Values ['Cd39'], from ['Calb2', ...], are not valid obs/ var names or indices.
-        if m in adata.var_names:
-            final_markers += [m]
-        else:
-            print(f'Marker {m} from curate is not in this data!')
-
-    print(f'Final Markers: {final_markers}')
+    # sc.pl.dotplot throws a fit on duplicates and KeyErrors on markers missing from the data (e.g. 'Cd39')
+    resolution = gene_index.resolve(markers, labels = marker2type, verbose = True)
+    final_markers = adata.var_names[resolution.columns].tolist()
 
     if final_markers == []: # Necessary to avoid "ValueError: left cannot be >= right"
         print(f'No markers available for {majorclass}!')
@@ -200,15 +119,15 @@ for majorclass in adata.obs['majorclass'].cat.categories:
     sc.pl.dotplot(adata[adata.obs['majorclass'] == majorclass_original, final_markers],
                   var_names = final_markers,
                   groupby = 'author_cell_type',
-                  categories_order = adata.obs.loc[adata.obs['majorclass'] == majorclass_original, "author_cell_type"].astype(str).sort_values().drop_duplicates(keep='first').tolist(), # Only celltypes that have a marker should be present
+                  categories_order = hierarchy.subtypes_of(majorclass_original), # Only celltypes that have a marker should be present
                   vmax = max_col,
                   vmin = 0,
                   show = False,
                   save = f"mouseRetina_minorclass-{majorclass}_filteredMergedMarkers_{data_string}.pdf")
 # End majorclass
 
-majorclass_idx = adata.obs["author_cell_type"].str.upper().isin(adata.obs["majorclass"].astype(str).str.upper())
-adata.obs.loc[majorclass_idx, "author_cell_type"] = adata.obs.loc[majorclass_idx, "author_cell_type"].str.upper()
+major_names = set(hierarchy.majors.str.upper()) # Subtypes named after their major class take the curated spelling
+adata.obs["author_cell_type"] = relabel_categories(adata.obs["author_cell_type"], lambda c: c.upper() if c.upper() in major_names else c)
 
 merged_filtered_markers = merged_filtered_markers.loc[merged_filtered_markers["Curated"] == "Curated"]
 merged_filtered_markers1 = merged_filtered_markers.loc[merged_filtered_markers["Major_Name"] == "AC"]
@@ -218,7 +137,7 @@ merged_filtered_markers4 = merged_filtered_markers.loc[merged_filtered_markers["
 merged_filtered_markers5 = merged_filtered_markers.loc[merged_filtered_markers["Major_Name"] == "RPE"]
 merged_filtered_markers = pd.concat([merged_filtered_markers1,merged_filtered_markers2,merged_filtered_markers3,merged_filtered_markers4,merged_filtered_markers5], ignore_index = True)
 
-adata.obs.loc[adata.obs["author_cell_type"].astype(str).str.contains("Microglia"), "author_cell_type"] = "MICROGLIA" # No subtypes of Microglia here
+adata.obs["author_cell_type"] = relabel_categories(adata.obs["author_cell_type"], lambda c: "MICROGLIA" if "Microglia" in c else c) # No subtypes of Microglia here
 ordered_celltypes = merged_filtered_markers["Queried_Name"].drop_duplicates().astype('category').cat.remove_categories('RGC').dropna().tolist() + ["ROD","CONE","HC","MICROGLIA","ENDOTHELIAL"]
 
 final_ordered_markers = ["Ptn","Cntn6","Nxph1","Cpne4","Cbln4","Etv1","Epha3","Trhde", # AC
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# How many curated/queried markers survive the Xenium filters under other thresholds than the
+# 960 bp / 4 / 100 counts defaults, and which ones flip. Every combination of the grids below is
+# evaluated at once from the summary store's raw means (camr.xenium.XeniumFilter.sweep), so hundreds of
+# combinations take seconds instead of one 05.1 run each.
+
+import datetime
+print(f'{datetime.datetime.now()} Analysis Setup')
+
+import os
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import seaborn as sns
+
+from camr.store import load_summary_store
+from camr.xenium import XeniumFilter
+
+os.chdir('/project/hipaa_ycheng11lab/atlas/CAMR2024')
+os.makedirs('05_Filter_Merged_Markers/figures', exist_ok = True)
+
+markers_path = '04_Merge_Curated_Markers/4_harmonized_curated_markers.txt' # 05.1 input
+target_column = 'Queried_Name' # 'Name' for the 02.1/03.1 model marker tables
+rule = 'final_keep' # 'final_keep' (05.1), 'Xenium_Filter' (05) or 'minor_filter' (03.1)
+length_thresholds = np.arange(0, 2001, 120) # Baseline 960
+count_lowclusters = np.arange(1, 10.5, 0.5) # Baseline 4
+count_highclusters = np.arange(25, 301, 25) # Baseline 100
+
+summary_store = load_summary_store() # Per group x gene statistics, built once per version of the h5ad
+xenium_filter = XeniumFilter(summary_store, match_case = rule == 'final_keep') # Default thresholds are the baseline flips are counted against; 05.1 matches labels exactly
+markers = pd.read_csv(markers_path, sep = '\t')
+
+print(f'{datetime.datetime.now()} Sweeping {len(length_thresholds) * len(count_lowclusters) * len(count_highclusters)} combinations over {len(markers)} markers')
+summary, counts, flips = xenium_filter.sweep(markers, length_thresholds, count_lowclusters, count_highclusters, rule = rule,
+                                             marker = 'Marker', target = target_column, major = 'Major_Name')
+print(f'{datetime.datetime.now()} Done')
+
+summary.to_csv(f'05_Filter_Merged_Markers/5_threshold_sweep_{rule}_summary.txt', sep = '\t', index = False)
+counts.to_csv(f'05_Filter_Merged_Markers/5_threshold_sweep_{rule}_counts.txt', sep = '\t', index = False)
+flips.to_csv(f'05_Filter_Merged_Markers/5_threshold_sweep_{rule}_flips.txt', sep = '\t', index = False)
+
+# Genes that flip in the most combinations (counted once per combination however many rows they have), i.e. the ones the thresholds decide on
+flip_frequency = flips.drop_duplicates(list(summary.columns[:3]) + ['Marker', 'Kept']).groupby(['Marker', 'Kept']).size().unstack(fill_value = 0).rename(columns = {True: 'N_Gained', False: 'N_Lost'})
+flip_frequency = flip_frequency.reindex(columns = ['N_Gained', 'N_Lost'], fill_value = 0)
+flip_frequency = flip_frequency.assign(Fraction = flip_frequency.sum(axis = 1) / len(summary)).sort_values('Fraction', ascending = False)
+flip_frequency.to_csv(f'05_Filter_Merged_Markers/5_threshold_sweep_{rule}_flipFrequency.txt', sep = '\t')
+print(flip_frequency.head(20))
+
+grid = sns.relplot(data = summary, x = 'Count_Lowcluster', y = 'N_Kept', hue = 'Count_Highcluster', col = 'Length_Threshold',
+                   col_wrap = 4, kind = 'line', palette = 'viridis', height = 3)
+grid.set_titles('Length >= {col_name}')
+plt.savefig(f'05_Filter_Merged_Markers/figures/5_threshold_sweep_{rule}.pdf', bbox_inches = 'tight')
+plt.close()
@@ -17,11 +17,19 @@ import numpy as np
 import seaborn as sns
 import os
 
+from camr.genes import load_gene_index
+from camr.h5ad import read_h5ad_columns
+from camr.hierarchy import load_hierarchy
+from camr.store import load_summary_store
+from camr.xenium import XeniumFilter
+
 os.chdir('/project/ycheng11lab/jfmaurer/mouse_retina_atlas_chen_2024/')
 os.makedirs('05_Filter_Curated_Markers', exist_ok = True)
 sc.settings.n_jobs = -1
 
-adata = ad.read_h5ad('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad')
+summary_store = load_summary_store() # Per group x gene statistics, built once per version of the h5ad
+gene_index = load_gene_index() # Symbol -> column lookups, built once per version of the h5ad
+hierarchy = load_hierarchy() # Cell-type codes saved next to the h5ad, built once per version of it
 
 sc.plotting.DotPlot.DEFAULT_SAVE_PREFIX = "05_Filter_Curated_Markers/figures/5_dotplot_"
 sc.plotting.DotPlot.DEFAULT_LARGEST_DOT = 200.0
@@ -45,24 +53,19 @@ max_col = 3
 if raw:
     data_string = "rawCounts"
     max_col = 4
-    adata.X = adata.raw.X
+
+adata = read_h5ad_columns('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad', # Only what this stage uses
+                          obs = ["majorclass", "author_cell_type"],
+                          var = ["feature_name", "feature_length"],
+                          matrix = "raw/X" if raw else "X")
 
 # plot_occassion = "" # Options: "august_grant": # 05.1, "curated_xenium_filtered": # 05.2
 # data_string = data_string + f"_{plot_occassion}"
 
-# Clean subtypes
-adata.obs["author_cell_type"] = adata.obs["author_cell_type"].astype(str).str.upper() # From category
-adata.obs["majorclass"] = adata.obs["majorclass"].astype(str).str.upper() # From category
-is_unassigned = adata.obs["author_cell_type"] == adata.obs["majorclass"]
-is_subtype = adata.obs["author_cell_type"].isin(["AC", "BC", "MICROGLIA", "RGC"])
-unassigned_subtypes = adata.obs["author_cell_type"].loc[is_unassigned & is_subtype]
-adata.obs.loc[is_unassigned & is_subtype, "author_cell_type"] = ["UNASSIGNED_" + uv for uv in unassigned_subtypes]
-adata.obs["minorclass"] = adata.obs["author_cell_type"]
+# Clean subtypes: UNASSIGNED_* pseudo-subtypes and curated upper case as categories of the compiled hierarchy
+hierarchy.annotate(adata.obs, case = 'upper') # author_cell_type, minorclass, majorclass and Major_Name
 adata.obs["Name"] = adata.obs["author_cell_type"] # This should be fed through q2n
-adata.obs["Major_Name"] = adata.obs["majorclass"].astype(str) # This should be fed through q2n
 
-# Shrink adata footprint
-adata.raw = None # 5GB saved?
 adata.var["Ensembl"] = adata.var.index.tolist()
 adata.var["feature_name"] = adata.var["feature_name"].astype(str).str.capitalize()
 adata.var["feature_length"] = adata.var["feature_length"].astype(int)
@@ -77,71 +80,12 @@ if os.path.isfile('05_Filter_Curated_Markers/5_curated_markers_xeniumFiltered.tx
 else:
     # Coefficient Marking # Jumping the shark, don't merge until the wet lab does it.
     curated_markers = pd.read_csv('04_Merge_Curated_Markers/4_harmonized_curated_markers.txt', sep = '\t').drop_duplicates()
+    curated_markers["Marker"] = curated_markers["Marker"].str.capitalize()
     
-    # Add gene length
-    curated_markers["Marker"] = curated_markers["Marker"].str.capitalize() # Make sure the below join keeps all rows
-    curated_markers.index = curated_markers["Marker"] # Make sure the below join keeps all rows
-    curated_markers = curated_markers.join(adata.var[["feature_length", "Ensembl"]])
-    curated_markers["missing_length"] = curated_markers["feature_length"].isnull()
-    curated_markers[curated_markers["missing_length"], "feature_length"] = 0
-    curated_markers["Long_Enough"] = curated_markers["feature_length"] >= length_threshold
-    curated_markers.index = list(range(curated_markers.shape[0])) # Move this to after minorclass merges?
-    
-    # minorclass
-    ## Pre-process expression table names
-    subcell_raw_mean = pd.read_csv('data/raw_meanExpression_minorclass.txt', sep = '\t')
-    subcell_raw_mean["author_cell_type"].str.upper()
-    is_subtype = subcell_raw_mean["author_cell_type"].isin(["AC", "BC", "MICROGLIA", "RGC"])
-    unassigned_subtypes = subcell_raw_mean.loc[is_subtype, "author_cell_type"]
-    subcell_raw_mean.loc[is_subtype, "author_cell_type"] = ["UNASSIGNED_" + uv for uv in unassigned_subtypes]
-    
-    ## Process table and detection
-    subcell_raw_mean_long = pd.melt(subcell_raw_mean, id_vars='author_cell_type', var_name='Marker', value_name='Raw_Mean_Expression_Minorclass_Target')
-    subcell_raw_mean_long = subcell_raw_mean_long.rename(columns={'author_cell_type':'Queried_Name'})
-    subcell_raw_mean_long["Marker"] = subcell_raw_mean_long["Marker"].str.capitalize()
-    subcell_raw_mean_long["Detectable_Minor_Expression"] = subcell_raw_mean_long['Raw_Mean_Expression_Minorclass_Target'] >= raw_expression_threshold
-    curated_markers = curated_markers.merge(subcell_raw_mean_long, on=['Queried_Name', 'Marker'], how = 'left')
-    
-    ## Optical crowding
-    minorToMajor = adata.obs[["author_cell_type", "majorclass"]].drop_duplicates()
-    subcell_raw_mean.index = subcell_raw_mean['author_cell_type']
-    
-    minor_crowding = np.zeros(sum(curated_markers["Marker"].isin(subcell_raw_mean.columns)))
-    included_markers = curated_markers.loc[curated_markers["Marker"].isin(subcell_raw_mean.columns), "Marker"]
-    for majorclass in ["AC", "BC", "MICROGLIA", "RGC"]:
-        minorclasses = minorToMajor.loc[minorToMajor["majorclass"] == majorclass, "author_cell_type"] # Why is below line needed given the 'clean_genes()' from last script? How well does 'upper' fix this?
-        sub_expr_mtx = subcell_raw_mean.loc[minorclasses, included_markers]
-        minor_crowding = minor_not_crowding & (np.sum(sub_expr_mtx > 100, axis = 0) > 0)
+    # Gene length, target and all-group expression, detection and crowding, evaluated for every row at once
+    xenium_filter = XeniumFilter(summary_store, length_threshold = length_threshold, count_lowcluster = raw_expression_threshold)
+    curated_markers = xenium_filter.annotate(curated_markers, marker = "Marker", target = "Queried_Name", major = "Major_Name")
     
-    minor_crowding.name = "Minor_Crowding_Risk" # Is this not a numpy array?
-    curated_markers.index = curated_markers["Marker"]
-    curated_markers = curated_markers.join(minor_crowding, how = "left").drop_duplicates() # Drop duplicate necessary?
-    curated_markers.loc[curated_markers["Minor_Crowding_Risk"].isnull(), "Minor_Crowding_Risk"] = True # Be alittle leaky
-    
-    # majorclass expression
-    major_raw_mean = pd.read_csv('data/raw_meanExpression_majorclass.txt', sep = '\t')
-    major_raw_mean_long = pd.melt(major_raw_mean, id_vars='majorclass', var_name='Marker', value_name='Raw_Mean_Expression_Majorclass_Target')
-    major_raw_mean_long = major_raw_mean_long.rename(columns={'majorclass':'Major_Name'}) # Major_Queried name?
-    major_raw_mean_long["Marker"] = major_raw_mean_long["Marker"].str.capitalize()
-    major_raw_mean_long["Detectable_Major_Expression"] = major_raw_mean_long["Raw_Mean_Expression_Majorclass_Target"] >= raw_expression_threshold
-    curated_markers = curated_markers.merge(major_raw_mean_long, on=['Major_Name', 'Marker'], how = 'left')
-    
-    ## all majorclass expression
-    major_raw_mean = major_raw_mean.T
-    major_raw_mean.columns = major_raw_mean.iloc[0] # majorclass in first column becomes first row
-    major_raw_mean["Marker"] = major_raw_mean.index.astype(str).str.capitalize()
-    major_raw_mean = major_raw_mean.drop(major_raw_mean.index[0])
-    curated_markers = curated_markers.merge(major_raw_mean, on = 'Marker', how = 'left')
-    curated_markers["Major_Crowding_Risk"] = np.sum(curated_markers.loc[:, adata.obs["majorclass"].unique()] > 100, axis = 1) > 0 # If subtype is high, that should be ok?
-    
-    # Combine Major and Minor
-    curated_markers["Detectable_Expression"] = curated_markers["Detectable_Major_Expression"] | curated_markers["Detectable_Minor_Expression"]
-    curated_markers["Optical_Crowding_Risk"] = curated_markers["Major_Crowding_Risk"] | curated_markers["Minor_Crowding_Risk"]
-    
-    # Filter
-    curated_markers["Xenium_Filter"] = (curated_markers["Long_Enough"] &
-                                        curated_markers["Detectable_Expression"] &
-                                        ~curated_markers["Optical_Crowding_Risk"])
     curated_markers = curated_markers.sort_values(['Major_Name', 'Queried_Name']) # For now
     curated_markers.to_csv('05_Filter_Curated_Markers/5_curated_markers_xeniumAnnotated.txt', sep = '\t')
     filtered_markers = curated_markers.loc[curated_markers["Xenium_Filter"]]
@@ -154,18 +98,9 @@ else: # Road less travelled
     filtered_markers = filtered_markers.join(queried_markers)
 
 def clean_markers(var_names, dirty_markers, verbose=True):
-    final_markers = []
-    for m in dirty_markers:
-        if m in final_markers: # sc.pl.dotplot throws a fit if there are duplicates
-            print(f'Found duplicate marker {m}!')
-            continue
-        if m not in var_names:
-            print(f'Marker {m} from curate is not in this data!')
-            continue
-        final_markers += [m]
-    if verbose:
-        print(f'Final Markers: {final_markers}')
-    return(final_markers)
+    # sc.pl.dotplot throws a fit on duplicates and KeyErrors on markers missing from the data
+    resolution = gene_index.resolve(dirty_markers, verbose = verbose)
+    return(var_names[resolution.columns].tolist())
 
 # 05.2
 if plot_major_markers and plot_major_cells:
@@ -178,7 +113,7 @@ if plot_major_markers and plot_major_cells:
     sc.pl.dotplot(adata[:, final_markers],
                   var_names = final_markers,
                   groupby = 'majorclass',
-                  categories_order = adata.obs["majorclass"].astype(str).drop_duplicates(keep='first').sort_values().tolist(), # Only celltypes that have a marker should be present
+                  categories_order = sorted(adata.obs["majorclass"].cat.remove_unused_categories().cat.categories), # Only celltypes that have a marker should be present
                   vmax = max_col,
                   vmin = 0,
                   show = False,
@@ -216,8 +151,8 @@ if plot_minor_markers and plot_minor_cells:
             continue
         
         if not plot_only_target_cells:
-            all_subtypes = adata.obs.loc[adata.obs['majorclass'] == majorclass_original, "author_cell_type"].astype(str).sort_values().drop_duplicates(keep='first')
-            target_subtypes += all_subtypes[!all_subtypes.isin(target_subtypes)].tolist()
+            all_subtypes = pd.Series(sorted(subtype.upper() for subtype in hierarchy.subtypes_of(majorclass_original)))
+            target_subtypes += all_subtypes[~all_subtypes.isin(target_subtypes)].tolist()
         all_target_subtypes += target_subtypes
         
         sc.pl.dotplot(adata[adata.obs['majorclass'] == majorclass_original, final_markers],
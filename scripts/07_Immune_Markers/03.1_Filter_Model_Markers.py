@@ -14,6 +14,13 @@ import numpy as np
 import os
 import joblib
 import datetime as dt
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # scripts/ for camr
+from camr.coefficients import filter_markers
+from camr.dotplot import dotplot_from_table
+from camr.store import load_summary_store
+from camr.xenium import XeniumFilter
 
 sc.settings.n_jobs = -1
 
@@ -23,6 +30,8 @@ is_verbose = True
 
 count_lowcluster = 4 # Recommended detection limit for cell markers 
 count_highcluster = 100 # Recommended detection ceiling
+per_chemistry = False # Also require detectability within every library_platform with enough cells
+min_chemistry_cells = 50 # Subtype x chemistry pairs with fewer cells are too noisy to judge
 
 sc.plotting.DotPlot.DEFAULT_SAVE_PREFIX = "" # "03_Filter_Model_Markers/figures/3_dotplot_"
 sc.plotting.DotPlot.DEFAULT_LARGEST_DOT = 200.0
@@ -35,50 +44,42 @@ if raw:
 final_majorclass_candidates_ordered = pd.read_csv('03_Filter_Model_Markers/3_ovr_LogReg_majorclass_xeniumFiltered.txt', sep = '\t') # No need to recalculate for majorclass, variable genes should be good enough
 subtype_to_type = pd.read_csv('02_Modeling/2_minorToMajorClass.txt', sep = '\t')
 
-adata = ad.read_h5ad('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad')
-adata.var.index = adata.var["feature_name"] # subset on genes instead of booleans for dotplots
-if raw:
-    adata.X = adata.raw.X
-raw_mean_expression_minorclass = pd.read_csv(f'data/raw_meanExpression_minorclass.txt', sep = '\t', index_col=0)
+summary_store = load_summary_store() # Per group x gene statistics, built once per version of the h5ad; no need to load the h5ad
+raw_mean_expression_minorclass = summary_store.frame('mean', 'raw', 'author_cell_type')
+plot_layer = "raw" if raw else "norm"
+plot_mean = summary_store.frame('mean', plot_layer, 'author_cell_type')
+plot_frac = summary_store.frame('frac', plot_layer, 'author_cell_type')
+minor_to_major = summary_store.group_pairs('author_cell_type', 'majorclass')
+xenium_filter = XeniumFilter(summary_store, count_lowcluster = count_lowcluster, count_highcluster = count_highcluster)
+raw_mean_expression_chemistry = summary_store.frame('mean', 'raw', 'author_cell_type', 'library_platform')
+n_cells_chemistry = pd.Series(summary_store.stats('raw', 'author_cell_type', 'library_platform').n_cells,
+                              index = raw_mean_expression_chemistry.index)
 
 ## Subtype Markers
 
 def get_top_coefficient_genes(majorclass: str):
     top_features_log_reg_sub = pd.read_csv(f'02_Modeling/minorclass/2_ovr_LogReg_minorclass-{majorclass}_AbsTop20Markers.txt', sep ='\t')
-    if majorclass != 'Microglia':
-        top_features_log_reg_sub = top_features_log_reg_sub[top_features_log_reg_sub['Coefficient'] > 0]
-    # top_features_log_reg_sub['Coefficient'] = abs(top_features_log_reg_sub['Coefficient'])
+    if 'Sign' not in top_features_log_reg_sub.columns: # Tables written before camr.coefficients
+        top_features_log_reg_sub['Sign'] = np.sign(top_features_log_reg_sub['Coefficient'])
+    # Positive coefficients only (all for Microglia), then markers listed once
+    top_features_log_reg_sub = filter_markers(top_features_log_reg_sub, positive = majorclass != 'Microglia', unique = True)
     top_features_log_reg_sub.index = top_features_log_reg_sub.Marker
     
     return top_features_log_reg_sub
 
 
-# Filter based on innate features of the gene itself
-def filter_gene_by_genomics(adata, top_coefficient_genes, length_threshold = 960, verbose = False):
-    in_regression = adata.var["feature_name"].astype(str).isin(top_coefficient_genes["Marker"])
-    long_enough = adata.var["feature_length"].astype(int) >= length_threshold # It's a conservative filter
+# Same detection limit, but it has to be met in some subtype of every chemistry, not only in the pooled means
+def filter_gene_by_chemistry(var, raw_mean_expression_chemistry, n_cells_chemistry, count_lowcluster = 4, min_cells = 50, verbose = False):
+    well_sampled = (n_cells_chemistry >= min_cells).to_numpy()
+    detectable = raw_mean_expression_chemistry.loc[well_sampled] >= count_lowcluster
+    detectable_genes = detectable.groupby(level = 'library_platform').any().all(axis = 0)
     
-    is_genomics_candidate = long_enough & in_regression
-    genomics_candidates = adata.var["feature_name"].astype(str)[is_genomics_candidate.tolist()].tolist()
+    chemistry_candidates = var["feature_name"].astype(str)[detectable_genes.tolist()].tolist()
     
     if verbose:
-        print(len(genomics_candidates), genomics_candidates)
+        print(len(chemistry_candidates), chemistry_candidates)
     
-    return genomics_candidates
-
-
-# Filter based on the filtering criteria even though adata.obs.library_platform.unique() is a mix of 4 chemistries...
-def filter_gene_by_expression(adata, raw_mean_expression, count_lowcluster = 4, count_highcluster = 100, verbose = False):
-    detectable_genes = (raw_mean_expression >= count_lowcluster).sum(axis=0) >= 1 # Leaky, expression may be highest in off-target cell
-    optical_crowding_genes = (raw_mean_expression > count_highcluster).sum(axis=0) > 0
-    
-    is_expression_candidate = detectable_genes & (~optical_crowding_genes)
-    expression_candidates = adata.raw.var["feature_name"].astype(str)[is_expression_candidate.tolist()].tolist()
-    
-    if verbose:
-        print(len(expression_candidates), expression_candidates)
-    
-    return expression_candidates
+    return chemistry_candidates
 
 
 def merge_major_minor_markers(majorclass_candidates, minorclass_candidates, majorclass, subtype_to_type):
@@ -88,12 +89,7 @@ def merge_major_minor_markers(majorclass_candidates, minorclass_candidates, majo
     
     markers = cell_markers.tolist() + subtype_markers.tolist()
     
-    unique_markers = [] # sc.pl.dotplot throws a fit if there are duplicates
-    for m in markers:
-        if m not in unique_markers:
-            unique_markers += [m]
-    
-    return unique_markers
+    return list(dict.fromkeys(markers)) # sc.pl.dotplot throws a fit if there are duplicates
 
         
 for majorclass in ["AC", "BC", "Microglia", "RGC"]: # adata.obs['majorclass'].cat.categories, but only ones with subtypes to check
@@ -101,12 +97,16 @@ for majorclass in ["AC", "BC", "Microglia", "RGC"]: # adata.obs['majorclass'].ca
     print(f'{dt.datetime.now()} Major Class: {majorclass}')
 
     top_coefficient_genes = get_top_coefficient_genes(majorclass)
-    top_coefficient_genes = top_coefficient_genes.loc[top_coefficient_genes["Marker"].value_counts()==1] # Unique filter
     raw_mean_expression = raw_mean_expression_minorclass.loc[subtype_to_type.loc[subtype_to_type["majorclass"].astype(str) == majorclass, "minorclass"]]
 
-    genomics_candidates = filter_gene_by_genomics(adata, top_coefficient_genes, verbose = is_verbose)
-    expression_candidates = filter_gene_by_expression(adata, raw_mean_expression, verbose = is_verbose)
-    final_candidates = np.intersect1d(genomics_candidates, expression_candidates)
+    # Long enough, detectable in some subtype of the major class and crowding none of them
+    annotated = xenium_filter.annotate(top_coefficient_genes, marker = "Marker", target = "Name", major = "Major_Name", group_columns = False)
+    final_candidates = np.unique(annotated.loc[annotated["minor_filter"], "Marker"].astype(str))
+    if per_chemistry:
+        in_majorclass = raw_mean_expression_chemistry.index.get_level_values('author_cell_type').isin(raw_mean_expression.index)
+        chemistry_candidates = filter_gene_by_chemistry(summary_store.var, raw_mean_expression_chemistry.loc[in_majorclass],
+                                                        n_cells_chemistry.loc[in_majorclass], count_lowcluster, min_chemistry_cells, verbose = is_verbose)
+        final_candidates = np.intersect1d(final_candidates, chemistry_candidates)
 
     if is_verbose:
         print(len(final_candidates), final_candidates)
@@ -116,11 +116,12 @@ for majorclass in ["AC", "BC", "Microglia", "RGC"]: # adata.obs['majorclass'].ca
     
     major_minor_markers = merge_major_minor_markers(final_majorclass_candidates_ordered, ordered_markers, majorclass, subtype_to_type)
     
-    sc.pl.dotplot(
-        adata = adata[adata.obs.majorclass == majorclass, major_minor_markers],
+    subtypes_present = minor_to_major.loc[minor_to_major["majorclass"] == majorclass, "author_cell_type"]
+    dotplot_from_table(
+        plot_mean, plot_frac,
         var_names = major_minor_markers,
-        gene_symbols = "feature_name",
         groupby = 'author_cell_type',
+        categories_order = plot_mean.index[plot_mean.index.isin(subtypes_present)].tolist(),
         vmax = count_lowcluster * 3,
         vmin = count_lowcluster - 1,
         show = False,
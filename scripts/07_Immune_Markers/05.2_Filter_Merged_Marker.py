@@ -14,11 +14,16 @@ import pandas as pd
 import numpy as np
 import seaborn as sns
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # scripts/ for camr
+from camr.genes import load_gene_index
+from camr.h5ad import read_h5ad_columns
+from camr.hierarchy import load_hierarchy
 
 os.chdir('/project/hipaa_ycheng11lab/atlas/CAMR2024')
 os.makedirs('05_Filter_Merged_Markers', exist_ok = True)
 sc.settings.n_jobs = -1
-adata = ad.read_h5ad('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad')
 
 sc.plotting.DotPlot.DEFAULT_SAVE_PREFIX = "" # "05_Filter_Merged_Markers/figures/5_dotplot_" # figures/05_Filter_Merged_Markers/figures/5_dotplot_mouseRetina_minorclass-ROD_curatedMarkers_rawCounts.pdf
 sc.plotting.DotPlot.DEFAULT_LARGEST_DOT = 200.0
@@ -37,32 +42,23 @@ if raw:
 if xenium_filtered:
     data_string = data_string + "_xeniumFiltered"
 
-# Clean subtypes
-adata.obs = adata.obs.loc[:, ["majorclass", "author_cell_type"]]
-adata.obs["author_cell_type"] = adata.obs["author_cell_type"].astype(str)
-is_unassigned = adata.obs["author_cell_type"] == adata.obs["majorclass"]
-is_subtype = adata.obs["author_cell_type"].isin(["AC", "BC", "Microglia", "RGC"])
-unassigned_subtypes = adata.obs["author_cell_type"].loc[is_unassigned & is_subtype]
-adata.obs.loc[is_unassigned & is_subtype, "author_cell_type"] = ["Unassigned_" + uv for uv in unassigned_subtypes]
+gene_index = load_gene_index() # Symbol -> column lookups, built once per version of the h5ad
+hierarchy = load_hierarchy() # Cell-type codes saved next to the h5ad, built once per version of it
+adata = read_h5ad_columns('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad', # Only what this stage uses
+                          obs = ["majorclass", "author_cell_type"],
+                          var = ["gene_symbols", "feature_name", "feature_length"],
+                          matrix = "raw/X" if raw else "X")
+
+# Clean subtypes: Unassigned_* pseudo-subtypes as categories of the compiled hierarchy
+hierarchy.annotate(adata.obs, columns = ["author_cell_type"])
 
 
-# Make memory available
-if raw:
-    adata.X = adata.raw.X
-adata.raw = None
-adata.var = adata.var.loc[:, ["gene_symbols", "feature_name", "feature_length"]]
 adata.var["feature_name"] = adata.var["feature_name"].astype(str).str.capitalize()
 adata.var["feature_length"] = adata.var["feature_length"].astype(int)
 adata.var.index = adata.var["feature_name"] # subset on genes instead of booleans
 adata.var_names = adata.var["feature_name"] # subset on genes instead of booleans
 # adata.var_names_make_unique()
 
-import gc
-import ctypes
-gc.collect() # Free memory
-libc = ctypes.CDLL("libc.so.6") # clearing cache 
-libc.malloc_trim(0)
-
 
 merged_filtered_markers = pd.read_csv('05_Filter_Merged_Markers/5_curated_markers_annotatedKeep_lengthExpressionMissingFiltered.txt', sep ='\t')
 merged_filtered_markers = merged_filtered_markers.sort_values(['Queried_Major_Name', 'Queried_Name']) # For now
@@ -74,25 +70,14 @@ if plot_major:
     curated_majorclass_markers.to_csv('05_Filter_Merged_Markers/5_curatedMarkers_majorclass_xeniumFiltered.txt', sep = '\t', index = False)
     markers = curated_majorclass_markers["Marker"]
     
-    # sc.pl.dotplot throws a fit if there are duplicates
-    unique_markers = []
-    for m in markers:
-        if m not in unique_markers:
-            unique_markers += [m]
-        else:
-            print(f'Found duplicate marker {m}!')
-    
-    final_markers = []
-    for m in unique_markers: # Necessary to avoid "KeyError: "Values ['Cd39'], from ['Calb2', ...], are not valid obs/ var names or indices.
-        if m in adata.var_names:
-            final_markers += [m]
-        else:
-            print(f'Marker {m} from curate is not in this data!')
+    # sc.pl.dotplot throws a fit on duplicates and KeyErrors on markers missing from the data (e.g. 'Cd39')
+    resolution = gene_index.resolve(markers, verbose = True)
+    final_markers = adata.var_names[resolution.columns].tolist()
     
     sc.pl.dotplot(adata[:, final_markers],
                   var_names = final_markers,
                   groupby = 'majorclass',
-                  categories_order = adata.obs["majorclass"].astype(str).drop_duplicates(keep='first').sort_values().tolist(), # Only celltypes that have a marker should be present
+                  categories_order = sorted(adata.obs["majorclass"].cat.remove_unused_categories().cat.categories), # Only celltypes that have a marker should be present
                   vmax = max_col,
                   vmin = 0,
                   show = False,
@@ -118,22 +103,9 @@ for majorclass in adata.obs['majorclass'].cat.categories:
     
     marker2type = merged_filtered_markers.loc[is_major_marker, "Name"].tolist() + merged_filtered_markers.loc[is_subtype_marker, "Name"].tolist()
     
-    # sc.pl.dotplot throws a fit if there are duplicates
-    unique_markers = []
-    for i, m in enumerate(markers):
-        if m not in unique_markers:
-            unique_markers += [m]
-        else:
-            print(f'Found duplicate marker {m} in {marker2type[i]}!')
-
-    final_markers = []
-    for m in unique_markers: # Necessary to avoid "KeyError: "Values ['Cd39'], from ['Calb2', ...], are not valid obs/ var names or indices.
-        if m in adata.var_names:
-            final_markers += [m]
-        else:
-            print(f'Marker {m} from curate is not in this data!')
-
-    print(f'Final Markers: {final_markers}')
+    # sc.pl.dotplot throws a fit on duplicates and KeyErrors on markers missing from the data (e.g. 'Cd39')
+    resolution = gene_index.resolve(markers, labels = marker2type, verbose = True)
+    final_markers = adata.var_names[resolution.columns].tolist()
 
     if final_markers == []: # Necessary to avoid "ValueError: left cannot be >= right"
         print(f'No markers available for {majorclass}!')
@@ -142,7 +114,7 @@ for majorclass in adata.obs['majorclass'].cat.categories:
     sc.pl.dotplot(adata[adata.obs['majorclass'] == majorclass_original, final_markers],
                   var_names = final_markers,
                   groupby = 'author_cell_type',
-                  categories_order = adata.obs.loc[adata.obs['majorclass'] == majorclass_original, "author_cell_type"].astype(str).sort_values().drop_duplicates(keep='first').tolist(), # Only celltypes that have a marker should be present
+                  categories_order = hierarchy.subtypes_of(majorclass_original), # Only celltypes that have a marker should be present
                   vmax = max_col,
                   vmin = 0,
                   show = False,
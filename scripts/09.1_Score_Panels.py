@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# How well does each panel version separate the cell types?
+# Every panel's genes are the only features of the majorclass model and of each major class's subtype model;
+# both are cross-validated and per-class precision, recall and F1 are written for all panels side by side.
+# Columns come from the gene-major copy of the h5ad (data_gene_major.py), so each panel takes seconds.
+import datetime
+print(f'{datetime.datetime.now()} Analysis Setup')
+
+import matplotlib.pyplot as plt
+import seaborn as sns
+import os
+from camr.panels import PanelScorer, read_panel
+
+os.chdir('/project/hipaa_ycheng11lab/atlas/CAMR2024')
+
+panels = {
+    'V3': '09_Designer_Analysis/PanelDesignerV3.txt',
+    'V4': '09_Designer_Analysis/PanelDesignV4.txt',
+    'Yes': '09_Designer_Analysis/PanelDesignerYes.txt',
+    'V1_Ambiguous': '09_Designer_Analysis/PanelDesignV1Ambiguous.txt',
+    'mRetina_91g': os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '9MV3RF_mRetina_91g_panel.json'),
+}
+matrix = 'X' # Normalized counts, as the 02.1 models; 'raw/X' for raw counts
+folds = 5
+cells_per_class = 2000 # Cells per class of every model; None for all cells
+n_jobs = 4
+
+scorer = PanelScorer('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad', matrix = matrix)
+scores = scorer.score_panels({name: read_panel(path) for name, path in panels.items() if os.path.isfile(path)},
+                             folds = folds, cells_per_class = cells_per_class, n_jobs = n_jobs)
+scores.to_csv('09_Designer_Analysis/9_panel_scores.txt', index = False, sep = '\t')
+
+# The majorclass model's rows are one per major class; pool them so its macro F1 averages over all major classes
+summary = scores.assign(Major_Name = scores['Major_Name'].where(scores['Level'] != 'majorclass', 'majorclass'))
+summary = summary.groupby(['Panel', 'Level', 'Major_Name'], as_index = False).agg(Macro_F1 = ('F1', 'mean'), N_Genes = ('N_Genes', 'first'))
+summary.to_csv('09_Designer_Analysis/9_panel_scores_summary.txt', index = False, sep = '\t')
+print(summary.pivot(index = 'Major_Name', columns = 'Panel', values = 'Macro_F1'))
+
+plt.figure(figsize = (10, 5))
+sns.barplot(data = summary, x = 'Major_Name', y = 'Macro_F1', hue = 'Panel')
+plt.ylabel('Cross-validated macro F1')
+plt.savefig('09_Designer_Analysis/figures/panel_scores.pdf', bbox_inches = 'tight')
+plt.show()
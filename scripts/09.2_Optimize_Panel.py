@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Greedy panel optimization under a gene budget.
+# Starts from a panel version (or nothing), drops genes while over the budget, adds the Xenium-feasible candidate that
+# most improves subtype classification until the budget is reached, then swaps genes while that still helps.
+# Candidates are scored with naive Bayes terms from the summary store (camr.panel_search), so each step evaluates every
+# candidate without refitting; check the result with 09.1_Score_Panels.py, which cross-validates the 02.1 models.
+import datetime
+print(f'{datetime.datetime.now()} Analysis Setup')
+
+import matplotlib.pyplot as plt
+import pandas as pd
+import os
+from camr.gene_major import load_gene_major
+from camr.panel_search import PanelSearch
+from camr.panels import read_panel
+from camr.store import load_summary_store
+from camr.xenium import panel_feasible_genes, read_panel_targets
+
+os.chdir('/project/hipaa_ycheng11lab/atlas/CAMR2024')
+
+panel_json = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '9MV3RF_mRetina_91g_panel.json')
+start_panel = '09_Designer_Analysis/PanelDesignV4.txt' # Marker table or panel JSON to start from; None for an empty panel
+gene_budget = len(read_panel_targets(panel_json)) # 91
+max_swaps = 200
+cells_per_class = 50 # Evaluation cells per author_cell_type
+n_jobs = 16
+
+h5ad_path = '01_QualityControl/1_camr_scrublet_batch_filtered.h5ad'
+summary_store = load_summary_store(h5ad_path)
+gene_major = load_gene_major(h5ad_path)
+
+# Start genes as Ensembl IDs; marker tables list symbols
+start = [] if start_panel is None else read_panel(start_panel)
+positions = gene_major.columns(start, errors = 'ignore')
+start = gene_major.var.index[positions[positions >= 0]].tolist()
+
+feasible = panel_feasible_genes(summary_store)
+candidates = feasible.index[feasible].tolist() + start # Start genes stay eligible even when not feasible
+search = PanelSearch(summary_store, gene_major, candidates, cells_per_class = cells_per_class, n_jobs = n_jobs)
+panel, history = search.optimize(start, budget = gene_budget, max_swaps = max_swaps)
+
+markers = summary_store.var.loc[panel, 'feature_name']
+pd.DataFrame({'Ensembl': panel, 'Marker': markers.to_numpy(), 'In_Start_Panel': pd.Index(panel).isin(start)}).to_csv(
+    '09_Designer_Analysis/9_optimized_panel.txt', index = False, sep = '\t')
+history.to_csv('09_Designer_Analysis/9_panel_search_history.txt', index = False, sep = '\t')
+
+plt.figure(figsize = (8, 4))
+plt.plot(history['Step'], history['Accuracy'], marker = 'o')
+plt.xlabel('Search step')
+plt.ylabel('Naive Bayes accuracy')
+plt.title(f'{len(panel)} genes, {(~pd.Index(panel).isin(start)).sum()} not in the start panel')
+plt.savefig('09_Designer_Analysis/figures/panel_search.pdf', bbox_inches = 'tight')
+plt.show()
@@ -11,19 +11,17 @@ import pandas as pd
 import numpy as np
 import os
 
+from camr.hierarchy import load_hierarchy
+
 os.chdir('/project/hipaa_ycheng11lab/atlas/CAMR2024')
 
 adata = ad.read_h5ad('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad')
 
 print("Give the subtypes their designations")
 
-adata.obs["author_cell_type"] = adata.obs["author_cell_type"].astype(str)
-is_unassigned = adata.obs["author_cell_type"] == adata.obs["majorclass"]
-is_subtype = adata.obs["author_cell_type"].isin(["AC", "BC", "Microglia", "RGC"])
-unassigned_subtypes = adata.obs["author_cell_type"].loc[is_unassigned & is_subtype]
-adata.obs.loc[is_unassigned & is_subtype, "author_cell_type"] = ["Unassigned_" + uv for uv in unassigned_subtypes]
-adata.obs["minorclass"] = adata.obs["author_cell_type"].astype(str)
-adata.obs["Major_Name"] = adata.obs["majorclass"].astype(str)
+hierarchy_columns = ["author_cell_type", "minorclass", "Major_Name"]
+load_hierarchy('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad').annotate(adata.obs, columns = hierarchy_columns) # Unassigned_* subtypes
+adata.obs[hierarchy_columns] = adata.obs[hierarchy_columns].astype(str) # Plain strings in the Shiny input, as before
 
 print("Make sure we can use symbols in the shiny app")
 
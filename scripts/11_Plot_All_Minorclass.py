@@ -15,6 +15,9 @@ import numpy as np
 import seaborn as sns
 import os
 
+from camr.dotplot import dotplot_stats, dotplot_from_stats
+from camr.genes import load_gene_index
+
 os.chdir('/project/ycheng11lab/jfmaurer/mouse_retina_atlas_chen_2024/')
 os.makedirs('11_Plot_All_Minorclass', exist_ok = True)
 sc.settings.n_jobs = -1
@@ -51,14 +54,13 @@ for raw in [False, True]:
   if raw:
     data_string = "rawCounts"
     max_col = 12
-    adata.X = adata.raw.X
 
   all_markers = markers["Marker"].unique().tolist()
+  group_stats = dotplot_stats(adata, all_d_markers, "minorclass", use_raw = raw) # One pass over the marker columns
   
-  sc.pl.dotplot(adata[adata.obs["minorclass"].isin(all_d_names), all_d_markers],
+  dotplot_from_stats(group_stats["minorclass"],
               var_names = all_d_markers,
-              gene_symbols = "feature_name", categories_order = all_d_names,
-              groupby = "minorclass",
+              categories_order = all_d_names,
               vmax = max_col,
               vmin = 0,
               show = False,
@@ -66,23 +68,25 @@ for raw in [False, True]:
 
 exit()
 
+gene_index = load_gene_index('10_Make_Shiny/10_Shiny_Input.h5ad') # Symbol -> column lookups of the same file
 group_var = "majorclass"
 for raw in [False, True]:
   if raw:
     data_string = "rawCounts"
     max_col = 12
-    adata.X = adata.raw.X
-
+  
+  all_markers = adata.var_names[gene_index.resolve(markers["Marker"]).columns].tolist()
+  
   for cell_set in ["majorclass", "AC", "BC", "Microglia", "RGC"]:
     
     # subset adata to cells
     if cell_set == "majorclass":
-      adata_set = adata
       group_var = "majorclass"
+      set_stats = dotplot_stats(adata, all_markers, group_var, use_raw = raw)[group_var]
     else:
-      adata_set = adata[adata.obs['Major_Name'] == cell_set]
       group_var = "minorclass"
-    cat_order = adata_set.obs[group_var].astype(str).drop_duplicates(keep='first').sort_values()#.tolist(), # Only celltypes that have a marker should be present
+      set_stats = dotplot_stats(adata, all_markers, group_var, use_raw = raw, mask = adata.obs['Major_Name'] == cell_set)[group_var]
+    cat_order = set_stats.groups[set_stats.n_cells > 0].astype(str).sort_values()#.tolist(), # Only celltypes that have a marker should be present
     
     for marker_set in ["majorclass", "AC", "BC", "Microglia", "RGC"]:
     
@@ -92,27 +96,15 @@ for raw in [False, True]:
       else:
         marker_set_values = markers.loc[marker_set == markers["Major_Name"], "Marker"]
 
-      unique_markers = []
-      for m in marker_set_values: # sc.pl.dotplot throws a fit if there are duplicates
-          if m not in unique_markers:
-              unique_markers += [m]
-          else:
-              print(f'Found duplicate marker {m}!')
-      
-      final_markers = []
-      for m in unique_markers: # Necessary to avoid "KeyError
-          if m in adata.var_names:
-              final_markers += [m]
-          else:
-              print(f'Marker {m} from curate is not in this data!')
+      # sc.pl.dotplot throws a fit on duplicates and KeyErrors on markers missing from the data
+      final_markers = adata.var_names[gene_index.resolve(marker_set_values, verbose = True).columns].tolist()
       
       if final_markers == []: # Necessary to avoid "ValueError: left cannot be >= right"
         print(f'No {marker_set} markers available for {cell_set}!')
         continue
       
-      sc.pl.dotplot(adata_set[:, final_markers],
-                    var_names = final_markers, gene_symbols = "feature_name",
-                    groupby = group_var,
+      dotplot_from_stats(set_stats,
+                    var_names = final_markers,
                     categories_order = cat_order,
                     vmax = max_col,
                     vmin = 0,
@@ -15,6 +15,8 @@ import numpy as np
 import seaborn as sns
 import os
 
+from camr.dotplot import dotplot_stats, dotplot_from_stats
+
 os.chdir('/project/hipaa_ycheng11lab/atlas/CAMR2024')
 os.makedirs('11_Plot_Final_Checks', exist_ok = True)
 sc.settings.n_jobs = -1
@@ -37,21 +39,19 @@ for raw in [False, True]:
   if raw:
     data_string = "rawCounts"
     max_col = 12
-    adata.X = adata.raw.X
 
   all_markers = markers["Marker"].unique().tolist()
+  group_stats = dotplot_stats(adata, all_markers, ["minorclass", "majorclass"], use_raw = raw) # One pass over the marker columns
   
-  sc.pl.dotplot(adata[:, all_markers],
-              var_names = all_markers, gene_symbols = "feature_name",
-              groupby = "minorclass",
+  dotplot_from_stats(group_stats["minorclass"],
+              var_names = all_markers,
               vmax = max_col,
               vmin = 0,
               show = False,
               save = f"{plot_prefix}Minor-Cell_All-Marker_{data_string}.pdf")
 
-  sc.pl.dotplot(adata[:, all_markers],
-              var_names = all_markers, gene_symbols = "feature_name",
-              groupby = "majorclass",
+  dotplot_from_stats(group_stats["majorclass"],
+              var_names = all_markers,
               vmax = max_col,
               vmin = 0,
               show = False,
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Scripts 11, 12, 13 & 14 combined: each former script is a set of plot specs switched on below.
+# The h5ad is loaded once, every aggregation the specs need is computed in one pass per count type,
+# and the figures are rendered in parallel. Specs are batched by the project whose data they plot,
+# since 11_Plot_Final_Checks draws from the hipaa copy of the atlas and the others from jfmaurer's.
+
+import datetime
+print(f'{datetime.datetime.now()} Analysis Setup')
+
+import anndata as ad
+import scanpy as sc
+import pandas as pd
+import os
+
+from camr.gene_major import GENE_MAJOR_DIR, load_gene_major
+from camr.plot_runner import read_marker_file, run_plot_specs
+
+jfmaurer_root = '/project/ycheng11lab/jfmaurer/mouse_retina_atlas_chen_2024/'
+hipaa_root = '/project/hipaa_ycheng11lab/atlas/CAMR2024/'
+os.chdir(jfmaurer_root)
+sc.settings.n_jobs = -1
+
+plot_all_minorclass = True  # 11_Plot_All_Minorclass
+plot_final_checks = True    # 11_Plot_Final_Checks
+plot_photoreceptors = True  # 12_photoreceptor_expression
+plot_ambiguous = True       # 13_Plot_Ambiguous
+plot_add_ups = True         # 14_Plot_Add_Ups
+plot_v4 = True              # 14_Plot_V4
+n_jobs = 8                  # Rendering processes
+gene_major = True           # Read only the marker columns from the gene-major copy of the h5ad
+
+sc.plotting.DotPlot.DEFAULT_SAVE_PREFIX = ""
+sc.plotting.DotPlot.DEFAULT_LARGEST_DOT = 200.0
+
+count_types = [(False, "normCounts", 3), (True, "rawCounts", 12)] # raw, data_string, max_col
+
+def major_first(resultsPath):
+    markers = pd.read_csv(resultsPath, sep = '\t').sort_values(["Major_Name", "Name"]) # NOTE: Nrg1 & 2010007h06rik adjusted
+    return pd.concat([markers.loc[markers["Name"] == markers["Major_Name"], :], markers.loc[markers["Name"] != markers["Major_Name"], :]])
+
+specs = {jfmaurer_root: [], hipaa_root: []} # Data root -> specs plotted from its 10_Shiny_Input.h5ad
+
+if plot_all_minorclass:
+    plot_prefix = "/project/ycheng11lab/jfmaurer/mouse_retina_atlas_chen_2024/11_Plot_All_Minorclass/"
+    all_d_markers = major_first("09_Designer_Analysis/PanelDesignerYes.txt")["Marker"].unique().tolist()
+    all_d_names = ['Unassigned_AC', 'Astrocyte', 'Cone', 'Endothelial', 'HC', 'MG', 'Unassigned_Microglia', 'Unassigned_RGC',
+    'BC3A', 'BC3B', 'BC4', 'BC6', 'BC7', 'BC5A', 'BC5B', 'BC5C',
+    'Unassigned_BC', '10_Novel', '37_Novel', '40_M1dup', '45_AlphaOFFT', '7_Novel',
+    '41_AlphaONT', '42_AlphaOFFS', '43_AlphaONS',
+    '3_FminiON', '4_FminiOFF', '28_FmidiOFF', '38_FmidiON', '32_F_Novel',
+    '22_M5', '31_M2', '33_M1']
+    for raw, data_string, max_col in count_types:
+        specs[jfmaurer_root] += [dict(markers = all_d_markers, groupby = "minorclass", cells = {"minorclass": all_d_names}, categories_order = all_d_names,
+                       raw = raw, vmax = max_col, save = f"{plot_prefix}All-Cell_All-Marker_{data_string}_vYes.pdf")]
+
+if plot_final_checks:
+    plot_prefix = "/project/hipaa_ycheng11lab/atlas/CAMR2024/11_Plot_Final_Checks/"
+    final_markers = read_marker_file(os.path.join(hipaa_root, "09_Designer_Analysis/PanelDesignerV3.txt"))
+    for raw, data_string, max_col in count_types:
+        specs[hipaa_root] += [dict(markers = final_markers, groupby = "minorclass", raw = raw, vmax = max_col, save = f"{plot_prefix}Minor-Cell_All-Marker_{data_string}.pdf"),
+                  dict(markers = final_markers, groupby = "majorclass", raw = raw, vmax = max_col, save = f"{plot_prefix}Major-Cell_All-Marker_{data_string}.pdf")]
+
+if plot_photoreceptors:
+    plot_prefix = "/project/ycheng11lab/jfmaurer/mouse_retina_atlas_chen_2024/12_photoreceptor_expression/"
+    rod_gene = ['Rho','Pde6a', 'Gngt1', 'Optn','Nrl','Nr2e3', 'Reep6', 'Cnga1', 'Guca1b', 'Pde6a', 'Rp1',
+                'Cngb1','Rcvrn', 'Pdc','Syne2','Mef2c','Fyco1','Atf4']
+    cone_gene = ['Opn1mw','Opn1sw', 'Ccdc136', 'Optn','Nrl','Gngt2', 'Gnat2']
+    for raw, data_string, max_col in count_types:
+        specs[jfmaurer_root] += [dict(markers = rod_gene, groupby = "majorclass", raw = raw, vmax = max_col, save = f"{plot_prefix}Major-Cell_Rod_{data_string}.pdf"),
+                  dict(markers = cone_gene, groupby = "majorclass", raw = raw, vmax = max_col, save = f"{plot_prefix}Major-Cell_Cone_{data_string}.pdf")]
+
+if plot_ambiguous:
+    plot_prefix = "/project/ycheng11lab/jfmaurer/mouse_retina_atlas_chen_2024/13_Plot_Ambiguous/"
+    ambiguous_markers = read_marker_file("09_Designer_Analysis/PanelDesignV1Ambiguous.txt")
+    for raw, data_string, max_col in count_types:
+        specs[jfmaurer_root] += [dict(markers = ambiguous_markers, groupby = "minorclass", raw = raw, vmax = max_col, save = f"{plot_prefix}Minor-Cell_All-Marker_{data_string}.pdf"),
+                  dict(markers = ambiguous_markers, groupby = "majorclass", raw = raw, vmax = max_col, save = f"{plot_prefix}Major-Cell_All-Marker_{data_string}.pdf"),
+                  dict(markers = ambiguous_markers, groupby = "minorclass", cells = {"majorclass": ["RGC"]}, raw = raw, vmax = max_col,
+                       save = f"{plot_prefix}Minor-Cell_All-Marker_{data_string}_RGC.pdf")]
+
+if plot_add_ups:
+    plot_prefix = "/project/ycheng11lab/jfmaurer/mouse_retina_atlas_chen_2024/14_Add_Ups/AddUp_"
+    add_up_markers = ['Tmcc3', 'Anks1b', 'Asic2', 'Vsx2', 'Rho', 'Pde6a', 'Nr2e3', 'Cnga1', 'Guca1b', 'Rp1', 'Rcvrn',
+                      # Second set below
+                      'Pax6', 'Tfap2a', 'Gad2', 'Slc6a1', 'Slc32a1', 'Slc6a9', 'Slc17a6', 'Pou4f2', 'Rbpms', 'Onecut1', 'Onecut2']
+    for raw, data_string, max_col in count_types:
+        specs[jfmaurer_root] += [dict(markers = add_up_markers, groupby = "minorclass", raw = raw, vmax = max_col, save = f"{plot_prefix}Minor-Cell_All-Marker_{data_string}.pdf"),
+                  dict(markers = add_up_markers, groupby = "majorclass", raw = raw, vmax = max_col, save = f"{plot_prefix}Major-Cell_All-Marker_{data_string}.pdf")]
+
+if plot_v4:
+    plot_prefix = "/project/ycheng11lab/jfmaurer/mouse_retina_atlas_chen_2024/14_Plot_V4/V4_"
+    markers = major_first("09_Designer_Analysis/PanelDesignV4.txt")
+    v4_markers = markers["Marker"].unique().tolist()
+    v4_major_markers = markers.loc[markers["Name"] == markers["Major_Name"], "Marker"].unique().tolist()
+    for raw, data_string, max_col in count_types:
+        specs[jfmaurer_root] += [dict(markers = v4_markers, groupby = "minorclass", raw = raw, vmax = max_col, save = f"{plot_prefix}Minor-Cell_All-Marker_{data_string}.pdf")]
+        specs[jfmaurer_root] += [dict(markers = v4_markers, groupby = "minorclass", cells = {"majorclass": [cellType]}, raw = raw, vmax = max_col,
+                       save = f"{plot_prefix}{cellType}_All-Marker_{data_string}.pdf") for cellType in ['AC', 'BC','RGC','Microglia']]
+        specs[jfmaurer_root] += [dict(markers = v4_markers, groupby = "majorclass", raw = raw, vmax = max_col, save = f"{plot_prefix}Major-Cell_All-Marker_{data_string}.pdf"),
+                  dict(markers = v4_major_markers, groupby = "majorclass", raw = raw, vmax = max_col, save = f"{plot_prefix}Major-Cell_Major-Marker_{data_string}.pdf")]
+
+for root, root_specs in specs.items():
+    if not root_specs:
+        continue
+    for spec in root_specs:
+        os.makedirs(os.path.dirname(spec["save"]), exist_ok = True)
+    
+    shiny_input = os.path.join(root, '10_Make_Shiny/10_Shiny_Input.h5ad')
+    if gene_major:
+        markers = pd.Index([m for spec in root_specs for m in spec["markers"]]).drop_duplicates().tolist()
+        obs_columns = sorted({spec["groupby"] for spec in root_specs} | {c for spec in root_specs for c in (spec.get("cells") or {})})
+        adata = load_gene_major(shiny_input, os.path.join(root, GENE_MAJOR_DIR)).read_anndata(markers, obs = obs_columns)
+    else:
+        adata = ad.read_h5ad(shiny_input)
+    run_plot_specs(adata, root_specs, n_jobs = n_jobs)
@@ -15,6 +15,8 @@ import numpy as np
 import seaborn as sns
 import os
 
+from camr.dotplot import dotplot_stats, dotplot_from_stats
+
 os.chdir('/project/ycheng11lab/jfmaurer/mouse_retina_atlas_chen_2024')
 os.makedirs('12_photoreceptor_expression', exist_ok = True)
 sc.settings.n_jobs = -1
@@ -39,22 +41,20 @@ for raw in [False, True]:
   if raw:
     data_string = "rawCounts"
     max_col = 12
-    adata.X = adata.raw.X
 
   # rod_gene = set(rod_gene)
   # cone_gene = set(cone_gene)
+  group_stats = dotplot_stats(adata, rod_gene + cone_gene, "majorclass", use_raw = raw) # One pass over the marker columns
 
-  sc.pl.dotplot(adata[:, rod_gene],
-              var_names = rod_gene, gene_symbols = "feature_name",
-              groupby = "majorclass",
+  dotplot_from_stats(group_stats["majorclass"],
+              var_names = rod_gene,
               vmax = max_col,
               vmin = 0,
               show = False,
               save = f"{plot_prefix}Major-Cell_Rod_{data_string}.pdf")
 
-  sc.pl.dotplot(adata[:, cone_gene],
-              var_names = cone_gene, gene_symbols = "feature_name",
-              groupby = "majorclass",
+  dotplot_from_stats(group_stats["majorclass"],
+              var_names = cone_gene,
               vmax = max_col,
               vmin = 0,
               show = False,
@@ -15,6 +15,8 @@ import numpy as np
 import seaborn as sns
 import os
 
+from camr.dotplot import dotplot_stats, dotplot_from_stats
+
 os.chdir('/project/ycheng11lab/jfmaurer/mouse_retina_atlas_chen_2024/')
 os.makedirs('14_Add_Ups', exist_ok = True)
 sc.settings.n_jobs = -1
@@ -60,19 +62,18 @@ for raw in [False, True]:
   if raw:
     data_string = "rawCounts"
     max_col = 12
-    adata.X = adata.raw.X
   
-  sc.pl.dotplot(adata[:, all_markers],
-              var_names = all_markers, gene_symbols = "feature_name",
-              groupby = "minorclass",
+  group_stats = dotplot_stats(adata, all_markers, ["minorclass", "majorclass"], use_raw = raw) # One pass over the marker columns
+  
+  dotplot_from_stats(group_stats["minorclass"],
+              var_names = all_markers,
               vmax = max_col,
               vmin = 0,
               show = False,
               save = f"{plot_prefix}Minor-Cell_All-Marker_{data_string}.pdf")
 
-  sc.pl.dotplot(adata[:, all_markers],
-              var_names = all_markers, gene_symbols = "feature_name",
-              groupby = "majorclass",
+  dotplot_from_stats(group_stats["majorclass"],
+              var_names = all_markers,
               vmax = max_col,
               vmin = 0,
               show = False,
@@ -0,0 +1,3 @@
+# Shared helpers for the CAMR2024 marker pipeline.
+# The numbered scripts run from the project root as `python scripts/<name>.py`, which puts
+# `scripts/` on sys.path so `from camr.<module> import ...` works without installing anything.
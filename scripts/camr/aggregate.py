@@ -0,0 +1,349 @@
+# Sparse group-by aggregation of expression matrices.
+# Replaces `pd.DataFrame(adata.raw.X.toarray(), ...).groupby(...).agg("mean")`, which densifies
+# the whole cells x genes matrix, with a one-hot (groups x cells) indicator multiplied into the
+# CSR matrix. Peak memory is the sparse matrix plus the groups x genes results, or with
+# aggregate_groups_backed() a single row block plus the results.
+# With n_jobs > 1 the cells are split into contiguous row ranges of about equal nonzeros; each
+# worker process aggregates its range (from shared-memory copies of the CSR arrays, or streamed
+# from the file when backed) and the partial sums are added up.
+
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+
+import anndata as ad
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+@dataclass
+class GroupStats:
+    """
+    Per-group sufficient statistics of an expression matrix.
+
+    Arguments:
+        groups: Group labels, one per row of the statistic arrays.
+        genes: Gene labels, one per column of the statistic arrays.
+        n_cells: Number of cells in each group, shape (groups,).
+        sum: Sum of expression per group and gene, shape (groups, genes).
+        sumsq: Sum of squared expression per group and gene, shape (groups, genes).
+        nnz: Number of cells with nonzero expression per group and gene, shape (groups, genes).
+    """
+    groups: pd.Index
+    genes: pd.Index
+    n_cells: np.ndarray
+    sum: np.ndarray
+    sumsq: np.ndarray
+    nnz: np.ndarray
+
+    @property
+    def mean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum / self.n_cells[:, np.newaxis]
+
+    @property
+    def variance(self):
+        # Population variance from the sufficient statistics, clipped against rounding below zero
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.maximum(self.sumsq / self.n_cells[:, np.newaxis] - self.mean ** 2, 0)
+
+    @property
+    def frac(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.nnz / self.n_cells[:, np.newaxis]
+
+    def collapse(self, level=0):
+        """
+        Sum the statistics of a (group, stratum) MultiIndex over the other levels, e.g. per group over
+        all chemistries. Cells whose stratum was missing are not in the stratified statistics.
+        """
+        name = level if isinstance(level, str) else self.groups.names[level]
+        codes, groups = pd.factorize(self.groups.get_level_values(level), sort=True)
+        indicator = group_indicator(codes, len(groups))
+        return GroupStats(pd.Index(groups, name=name),
+                          self.genes, indicator @ self.n_cells, indicator @ self.sum,
+                          indicator @ self.sumsq, indicator @ self.nnz)
+
+    def to_frame(self, stat: str = 'mean'):
+        """Return one statistic as a groups x genes DataFrame, the layout of data/raw_meanExpression_*.txt."""
+        return pd.DataFrame(getattr(self, stat), index=self.groups, columns=self.genes)
+
+    def __add__(self, other):
+        # Partial results over disjoint sets of cells combine by summing every statistic
+        if not (self.groups.equals(other.groups) and self.genes.equals(other.genes)):
+            raise ValueError('Can only add GroupStats computed over the same groups and genes')
+        return GroupStats(self.groups, self.genes,
+                          self.n_cells + other.n_cells,
+                          self.sum + other.sum,
+                          self.sumsq + other.sumsq,
+                          self.nnz + other.nnz)
+
+
+def group_codes(labels):
+    """Return (integer codes, categories) for a label vector; missing labels get code -1."""
+    labels = pd.Series(labels)
+    if not isinstance(labels.dtype, pd.CategoricalDtype):
+        labels = labels.astype('category')
+    return labels.cat.codes.to_numpy(), labels.cat.categories
+
+
+def group_indicator(codes, n_groups: int):
+    """One-hot (groups x cells) CSR indicator; cells with code -1 belong to no group."""
+    codes = np.asarray(codes)
+    cells = np.flatnonzero(codes >= 0)
+    return sp.csr_matrix((np.ones(len(cells), dtype=np.float64), (codes[cells], cells)),
+                         shape=(n_groups, len(codes)))
+
+
+def nonzero_indicator(X):
+    """Matrix with 1 wherever X is nonzero; sparse inputs share their index arrays with X."""
+    if sp.issparse(X):
+        X = X if X.format in ('csr', 'csc') else X.tocsr()
+        return X.__class__(((X.data != 0).astype(np.float32), X.indices, X.indptr), shape=X.shape)
+    return (np.asarray(X) != 0).astype(np.float32)
+
+
+def squared(X):
+    """Elementwise square of X; sparse inputs share their index arrays with X."""
+    if sp.issparse(X):
+        X = X if X.format in ('csr', 'csc') else X.tocsr()
+        return X.__class__((np.square(X.data, dtype=np.float64), X.indices, X.indptr), shape=X.shape)
+    return np.square(np.asarray(X, dtype=np.float64))
+
+
+def _dense(M):
+    return M.toarray() if sp.issparse(M) else np.asarray(M)
+
+
+def _stacked_codes(obs, groupbys, strata=()):
+    # Codes of every grouping shifted so they index rows of one stacked (all groups x cells) indicator.
+    # Each groupby is a grouping on its own and, for every stratum column, a (group, stratum) grouping.
+    codes, categories, offset = [], [], 0
+    strata_codes = [(stratum, *group_codes(obs[stratum])) for stratum in strata]
+    for groupby in groupbys:
+        group_code, cats = group_codes(obs[groupby])
+        groupings = [(groupby, group_code, pd.Index(cats, name=groupby))]
+        for stratum, stratum_code, stratum_cats in strata_codes:
+            combined = np.where((group_code >= 0) & (stratum_code >= 0),
+                                group_code.astype(np.int64) * len(stratum_cats) + stratum_code, -1)
+            groupings += [((groupby, stratum), combined,
+                           pd.MultiIndex.from_product([cats, stratum_cats], names=[groupby, stratum]))]
+        for key, code, index in groupings:
+            codes += [np.where(code >= 0, code + offset, -1)]
+            categories += [(key, index)]
+            offset += len(index)
+    return codes, categories, offset
+
+
+def _accumulate(X, codes, n_groups: int, start: int = 0, stop=None):
+    # n_cells, sums, sums of squares and nonzero counts of the stacked groups over rows start:stop
+    rows = [c[start:stop] for c in codes]
+    cells = np.concatenate([np.flatnonzero(r >= 0) for r in rows])
+    groups = np.concatenate([r[r >= 0] for r in rows])
+    indicator = sp.csr_matrix((np.ones(len(cells)), (groups, cells)), shape=(n_groups, len(rows[0])))
+    n_cells = np.asarray(indicator.sum(axis=1)).ravel()
+    return (n_cells, _dense(indicator @ X), _dense(indicator @ squared(X)),
+            _dense(indicator @ nonzero_indicator(X)))
+
+
+def _split(categories, genes, n_cells, sums, sumsq, nnz):
+    # Cut the stacked results back into one GroupStats per grouping
+    results, offset = {}, 0
+    for key, cats in categories:
+        rows = slice(offset, offset + len(cats))
+        results[key] = GroupStats(cats, genes, n_cells[rows], sums[rows], sumsq[rows], nnz[rows])
+        offset += len(cats)
+    return results
+
+
+def _share(array):
+    # Copy an array into a new shared memory block; returns the block and what workers need to attach
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _attach(descriptor):
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _shared_rows(views, shape, start: int, stop: int):
+    # Rows start:stop of the shared matrix as a CSR (or dense) view without copying
+    if len(views) == 1:
+        return views[0][start:stop]
+    data, indices, indptr = views
+    lo, hi = indptr[start], indptr[stop]
+    return sp.csr_matrix((data[lo:hi], indices[lo:hi], indptr[start:stop + 1] - lo),
+                         shape=(stop - start, shape[1]), copy=False)
+
+
+def _accumulate_shared(task):
+    # Worker: statistics of rows start:stop of a matrix held in shared memory
+    arrays, shape, codes, n_groups, start, stop = task
+    blocks, views = zip(*(_attach(descriptor) for descriptor in arrays))
+    try:
+        return _accumulate(_shared_rows(views, shape, start, stop), codes, n_groups)
+    finally:
+        del views # Views must be released before the blocks can be closed
+        for shm in blocks:
+            shm.close()
+
+
+def row_ranges(indptr, n_ranges: int):
+    """Split the rows of a CSR indptr into at most `n_ranges` contiguous (start, stop) ranges of about equal nonzeros."""
+    indptr = np.asarray(indptr)
+    bounds = np.searchsorted(indptr, np.linspace(0, indptr[-1], n_ranges + 1), side='left')
+    bounds[0], bounds[-1] = 0, len(indptr) - 1
+    bounds = np.unique(bounds)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _sum_partials(partials):
+    total = None
+    for partial in partials:
+        total = list(partial) if total is None else [t + p for t, p in zip(total, partial)]
+    return total
+
+
+def aggregate_groups(X, obs, groupbys, genes=None, n_jobs: int = 1, strata=None):
+    """
+    Per-group sums, sums of squares, nonzero counts (and from them means, variances and fraction
+    expressing) for several groupings in one pass.
+
+    The indicators of every grouping are stacked into a single matrix so every statistic is one
+    sparse product against X or a view of X that shares its index arrays.
+
+    Arguments:
+        X: cells x genes expression matrix (CSR/CSC sparse or dense).
+        obs: Cell metadata with one column per grouping.
+        groupbys: Column name or list of column names in `obs` to group by.
+        genes: Optional gene labels for the columns of X.
+        n_jobs: Worker processes; above 1, X is copied once into shared memory and each worker
+            aggregates a contiguous range of rows.
+        strata: Optional column name or list of column names in `obs` (e.g. library_platform,
+            reference) to also stratify every grouping by, in the same pass.
+
+    Returns:
+        dict mapping each groupby to its GroupStats and, for every stratum, (groupby, stratum) to
+        the GroupStats of the (group, stratum) pairs, indexed by a MultiIndex.
+    """
+    if isinstance(groupbys, str):
+        groupbys = [groupbys]
+    strata = [strata] if isinstance(strata, str) else list(strata or [])
+    genes = pd.Index(range(X.shape[1]) if genes is None else genes)
+    codes, categories, n_groups = _stacked_codes(obs, groupbys, strata)
+    if n_jobs <= 1:
+        return _split(categories, genes, *_accumulate(X, codes, n_groups))
+    if X.shape[0] == 0: # No cells, so no row ranges for the workers: zero counts and NaN means
+        return _split(categories, genes, np.zeros(n_groups), *[np.zeros((n_groups, len(genes)))] * 3)
+
+    if sp.issparse(X):
+        X = X if X.format == 'csr' else X.tocsr()
+        arrays, ranges = [X.data, X.indices, X.indptr], row_ranges(X.indptr, n_jobs)
+    else:
+        X = np.asarray(X)
+        arrays, ranges = [X], row_ranges(np.arange(X.shape[0] + 1), n_jobs)
+    shared = [_share(array) for array in arrays]
+    try:
+        tasks = [([descriptor for _, descriptor in shared], X.shape, [c[start:stop] for c in codes],
+                  n_groups, start, stop) for start, stop in ranges]
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(tasks))) as pool:
+            totals = _sum_partials(pool.map(_accumulate_shared, tasks))
+    finally:
+        for shm, _ in shared:
+            shm.close()
+            shm.unlink()
+    return _split(categories, genes, *totals)
+
+
+def read_row_block(matrix, start: int, stop: int):
+    """Read rows start:stop of an on-disk CSR group or dense dataset as an in-memory matrix."""
+    if isinstance(matrix, h5py.Dataset):
+        return matrix[start:stop]
+    encoding = matrix.attrs.get('encoding-type', matrix.attrs.get('h5sparse_format'))
+    encoding = encoding.decode() if isinstance(encoding, bytes) else str(encoding)
+    if not encoding.startswith('csr'):
+        raise ValueError(f'Row blocks need a CSR or dense matrix, found {encoding}')
+    indptr = matrix['indptr'][start:stop + 1]
+    data = matrix['data'][indptr[0]:indptr[-1]]
+    indices = matrix['indices'][indptr[0]:indptr[-1]]
+    return sp.csr_matrix((data, indices, indptr - indptr[0]),
+                         shape=(stop - start, matrix.attrs['shape'][1]))
+
+
+def iter_row_blocks(matrix, block_size: int = 20_000, start: int = 0, stop=None):
+    """Yield (start, stop, block) over rows start:stop of an on-disk matrix, one block in memory at a time."""
+    n_rows = matrix.shape[0] if isinstance(matrix, h5py.Dataset) else matrix.attrs['shape'][0]
+    stop = n_rows if stop is None else min(stop, n_rows)
+    for block_start in range(start, stop, block_size):
+        block_stop = min(block_start + block_size, stop)
+        yield block_start, block_stop, read_row_block(matrix, block_start, block_stop)
+
+
+def _accumulate_file(task):
+    # Worker (or the single process): stream rows start:stop of `matrix` and sum the block statistics
+    h5ad_path, matrix, codes, n_groups, start, stop, block_size, verbose = task
+    totals = []
+    with h5py.File(h5ad_path, 'r') as f:
+        for block_start, block_stop, block in iter_row_blocks(f[matrix], block_size, start, stop):
+            if verbose:
+                print(f'{dt.datetime.now()} Aggregating cells {block_start}-{block_stop}')
+            partial = _accumulate(block, codes, n_groups, block_start - start, block_stop - start)
+            totals = _sum_partials([totals, partial]) if totals else list(partial)
+    return totals
+
+
+def aggregate_groups_backed(h5ad_path, groupbys, matrix: str = 'raw/X', genes=None,
+                            block_size: int = 20_000, verbose: bool = False, n_jobs: int = 1,
+                            strata=None):
+    """
+    Streaming version of aggregate_groups() over an h5ad opened with backed='r'.
+
+    Only obs/var and one block of `block_size` rows of `matrix` are held in memory, so memory
+    stays constant however many cells the file holds. Results match aggregate_groups() on the
+    fully loaded matrix.
+
+    Arguments:
+        h5ad_path: Path to the h5ad file.
+        groupbys: Column name or list of column names in obs to group by.
+        matrix: HDF5 path of the matrix inside the file, 'raw/X' (raw counts) or 'X'.
+        genes: Optional gene labels for the columns; defaults to the matching var_names.
+        block_size: Number of cells per block.
+        n_jobs: Worker processes; each streams its own contiguous range of rows from the file.
+        strata: Optional obs columns to also stratify every grouping by, see aggregate_groups().
+    """
+    if isinstance(groupbys, str):
+        groupbys = [groupbys]
+    strata = [strata] if isinstance(strata, str) else list(strata or [])
+    adata = ad.read_h5ad(h5ad_path, backed='r')
+    try:
+        if genes is None:
+            genes = adata.raw.var_names if matrix.startswith('raw') else adata.var_names
+        genes = pd.Index(genes)
+        codes, categories, n_groups = _stacked_codes(adata.obs, groupbys, strata)
+        on_disk = adata.file[matrix]
+        if isinstance(on_disk, h5py.Dataset):
+            indptr = np.arange(on_disk.shape[0] + 1)
+        else:
+            indptr = on_disk['indptr'][()]
+    finally:
+        adata.file.close()
+
+    if len(indptr) == 1: # No cells: zero counts and NaN means
+        return _split(categories, genes, np.zeros(n_groups), *[np.zeros((n_groups, len(genes)))] * 3)
+
+    ranges = row_ranges(indptr, max(n_jobs, 1))
+    tasks = [(h5ad_path, matrix, [c[start:stop] for c in codes], n_groups, start, stop, block_size, verbose)
+             for start, stop in ranges]
+    if n_jobs <= 1:
+        totals = _accumulate_file(tasks[0])
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(tasks))) as pool:
+            totals = _sum_partials(pool.map(_accumulate_file, tasks))
+    return _split(categories, genes, *totals)
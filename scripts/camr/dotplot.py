@@ -0,0 +1,91 @@
+# Dotplots from precomputed group statistics.
+# sc.pl.dotplot(adata[mask, genes], ...) slices the full matrix and recomputes the mean and the
+# fraction expressing of every group on each call. Here the (group x gene) mean/fraction tables
+# are computed once (camr.aggregate or the summary store) and handed straight to scanpy's DotPlot
+# through a one-cell-per-group AnnData, so the figure keeps scanpy's look (DEFAULT_LARGEST_DOT,
+# vmin/vmax, categories_order, DEFAULT_SAVE_PREFIX) and rendering costs milliseconds.
+
+import anndata as ad
+import numpy as np
+import pandas as pd
+import scanpy as sc
+from scanpy.plotting._utils import savefig_or_show
+
+from camr.aggregate import aggregate_groups
+
+
+def dotplot_stats(adata, var_names, groupbys, use_raw: bool = False, mask=None):
+    """
+    GroupStats of only the `var_names` columns of adata (raw counts with use_raw=True).
+
+    Arguments:
+        adata: AnnData whose var_names hold the gene symbols used in var_names.
+        var_names: Genes to summarize; duplicates are summarized once.
+        groupbys: obs column or list of obs columns to group by.
+        mask: Optional boolean cell mask, e.g. adata.obs["majorclass"] == "RGC".
+    """
+    genes = pd.Index(var_names).drop_duplicates()
+    columns = pd.Series(np.arange(adata.n_vars), index=adata.var_names)
+    columns = columns.loc[~columns.index.duplicated()].reindex(genes)
+    if columns.isnull().any():
+        raise KeyError(f'Markers not in adata.var_names: {columns.index[columns.isnull()].tolist()}')
+    X = adata.raw.X if use_raw else adata.X
+    X = X[:, columns.to_numpy(dtype=np.int64)]
+    obs = adata.obs
+    if mask is not None:
+        mask = np.asarray(mask)
+        X, obs = X[mask], obs.loc[mask]
+    return aggregate_groups(X, obs, groupbys, genes=genes)
+
+
+def dotplot_from_table(mean, frac, var_names=None, groupby: str = 'group', categories_order=None,
+                       show=None, save=None, return_fig: bool = False,
+                       cmap=None, dot_max=None, dot_min=None, smallest_dot=None, **kwds):
+    """
+    Draw sc.pl.dotplot() from (group x gene) mean and fraction-expressing tables.
+
+    Arguments:
+        mean: groups x genes mean expression, the dot colour.
+        frac: groups x genes fraction of cells expressing, the dot size.
+        var_names: Genes to plot, in order; defaults to all columns of `mean`.
+        groupby: Label of the group axis.
+        categories_order: Groups to plot, in order; defaults to every group with cells.
+        show, save, return_fig: As in sc.pl.dotplot().
+        kwds: Passed on to sc.pl.DotPlot (vmin, vmax, figsize, title, ...).
+    """
+    mean, frac = (df.loc[:, ~df.columns.duplicated()] for df in (mean, frac)) # First of repeated symbols
+    var_names = list(mean.columns) if var_names is None else list(var_names)
+    if categories_order is None:
+        categories_order = mean.index[~mean.isnull().all(axis=1)].tolist() # observed groups only
+    categories_order = list(categories_order)
+    genes = pd.Index(var_names).drop_duplicates()
+
+    # One pseudo-cell per group; DotPlot only uses it for the layout since both tables are given
+    groups = pd.Categorical(categories_order, categories=categories_order)
+    pseudobulk = ad.AnnData(X=mean.loc[categories_order, genes].to_numpy(dtype=np.float32),
+                            obs=pd.DataFrame({groupby: groups}, index=[str(i) for i in range(len(groups))]),
+                            var=pd.DataFrame(index=genes.astype(str)))
+    dot_color_df = mean.loc[categories_order, var_names].set_axis(groups, axis=0)
+    dot_size_df = frac.loc[categories_order, var_names].set_axis(groups, axis=0)
+
+    dp = sc.pl.DotPlot(pseudobulk, var_names, groupby, categories_order=categories_order,
+                       dot_color_df=dot_color_df, dot_size_df=dot_size_df, **kwds)
+    style = {k: v for k, v in dict(cmap=cmap, dot_max=dot_max, dot_min=dot_min,
+                                   smallest_dot=smallest_dot).items() if v is not None}
+    if style:
+        dp = dp.style(**style)
+
+    if return_fig:
+        return dp
+    dp.make_figure()
+    savefig_or_show(sc.pl.DotPlot.DEFAULT_SAVE_PREFIX, show=show, save=save)
+    show = sc.settings.autoshow if show is None else show
+    if not show:
+        return dp.get_axes()
+
+
+def dotplot_from_stats(stats, var_names=None, categories_order=None, **kwds):
+    """dotplot_from_table() on the mean and fraction expressing of a GroupStats."""
+    return dotplot_from_table(stats.to_frame('mean'), stats.to_frame('frac'), var_names=var_names,
+                              groupby=stats.groups.name or 'group', categories_order=categories_order,
+                              **kwds)
@@ -0,0 +1,208 @@
+# Gene-major (CSC) on-disk copies of h5ad count matrices.
+# The h5ad stores raw.X and X as CSR, so pulling a few hundred marker columns still reads every
+# row of the 11 GB file. build_gene_major() converts each matrix once, out of core, into a CSC copy
+# whose columns are contiguous runs of data/indices in an HDF5 file named by the content hash of
+# the source h5ad; GeneMajor.read() then reads only the runs of the requested genes.
+
+import datetime as dt
+import os
+
+import anndata as ad
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from camr.aggregate import iter_row_blocks
+from camr.h5ad import read_dataframe_columns, read_h5ad_columns
+from camr.store import fingerprint
+
+GENE_MAJOR_DIR = 'data/gene_major'
+MATRICES = ['raw/X', 'X']
+GENE_COLUMNS = ['feature_name', 'gene_symbols'] # var columns kept for looking genes up by symbol
+CHUNK = 1 << 16 # HDF5 chunk length (elements) of the data and indices datasets
+
+
+def gene_major_path(h5ad_path, out_dir=GENE_MAJOR_DIR):
+    stem = os.path.basename(h5ad_path).removesuffix('.h5ad')
+    return os.path.join(out_dir, f'{stem}.{fingerprint(h5ad_path)}.h5')
+
+
+def _matrix_shape(matrix):
+    return matrix.shape if isinstance(matrix, h5py.Dataset) else tuple(matrix.attrs['shape'])
+
+
+def _write_csc(f, name, matrix, block_size: int, tmp_prefix: str, verbose: bool):
+    # Two streaming passes over the row blocks: count the nonzeros of every column, then scatter
+    # each block into its column runs of disk-backed arrays. Blocks arrive in row order, so the
+    # row indices inside every column come out sorted.
+    n_rows, n_cols = _matrix_shape(matrix)
+    counts = np.zeros(n_cols, dtype=np.int64)
+    dtype = None
+    for start, stop, block in iter_row_blocks(matrix, block_size):
+        block = sp.csr_matrix(block)
+        counts += np.bincount(block.indices, minlength=n_cols)
+        dtype = block.dtype
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    nnz = int(indptr[-1])
+    if verbose:
+        print(f'{dt.datetime.now()} {name}: {n_rows} x {n_cols}, {nnz} nonzeros')
+
+    data = np.memmap(tmp_prefix + '.data', dtype=dtype or np.float32, mode='w+', shape=(max(nnz, 1),))
+    indices = np.memmap(tmp_prefix + '.indices', dtype=np.int32, mode='w+', shape=(max(nnz, 1),))
+    try:
+        next_pos = indptr[:-1].copy()
+        for start, stop, block in iter_row_blocks(matrix, block_size):
+            if verbose:
+                print(f'{dt.datetime.now()} {name}: transposing cells {start}-{stop}')
+            block = sp.csc_matrix(block)
+            block.sort_indices()
+            block_counts = np.diff(block.indptr)
+            # Destination of the k-th stored value: where its column continues plus its rank in the column
+            dest = np.repeat(next_pos - block.indptr[:-1], block_counts) + np.arange(block.nnz)
+            data[dest] = block.data
+            indices[dest] = block.indices + start
+            next_pos += block_counts
+
+        g = f.create_group(name)
+        g.attrs['encoding-type'] = 'csc_matrix'
+        g.attrs['encoding-version'] = '0.1.0'
+        g.attrs['shape'] = (n_rows, n_cols)
+        chunks = (min(CHUNK, nnz),) if nnz else None
+        g.create_dataset('data', shape=(nnz,), dtype=data.dtype, chunks=chunks)
+        g.create_dataset('indices', shape=(nnz,), dtype=np.int32, chunks=chunks)
+        g.create_dataset('indptr', data=indptr)
+        step = CHUNK * 256
+        for offset in range(0, nnz, step):
+            g['data'][offset:offset + step] = data[offset:offset + step]
+            g['indices'][offset:offset + step] = indices[offset:offset + step]
+    finally:
+        del data, indices
+        for suffix in ['.data', '.indices']:
+            os.remove(tmp_prefix + suffix)
+
+
+def build_gene_major(h5ad_path, out_dir=GENE_MAJOR_DIR, matrices=MATRICES,
+                     block_size: int = 20_000, verbose: bool = True):
+    """
+    Write a gene-major (CSC) copy of the count matrices of `h5ad_path`; returns its path.
+
+    Only one row block of the source and the column offsets are held in memory; the transposed
+    values go through temporary memory-mapped files next to the output.
+
+    Arguments:
+        h5ad_path: Source h5ad.
+        out_dir: Directory holding one copy per source content hash.
+        matrices: HDF5 paths of the matrices to convert, e.g. 'raw/X' and 'X'.
+        block_size: Cells per streamed row block.
+    """
+    path = gene_major_path(h5ad_path, out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+
+    tmp_path = path + '.tmp'
+    with h5py.File(h5ad_path, 'r') as source, h5py.File(tmp_path, 'w') as f:
+        f.attrs['source'] = os.path.abspath(h5ad_path)
+        f.attrs['created'] = str(dt.datetime.now())
+        var = read_dataframe_columns(source['var'], [c for c in GENE_COLUMNS if c in source['var']])
+        genes = f.create_group('var')
+        genes.create_dataset('_index', data=var.index.astype(str).to_numpy().astype('S'))
+        for column in var.columns:
+            genes.create_dataset(column, data=var[column].astype(str).to_numpy().astype('S'))
+        f.create_dataset('obs_names', data=read_dataframe_columns(source['obs'], []).index.astype(str)
+                         .to_numpy().astype('S'))
+
+        for name in matrices:
+            if name not in source:
+                continue
+            if _matrix_shape(source[name])[1] != var.shape[0]:
+                raise ValueError(f'{name} and var list different genes; the copy assumes one gene order')
+            _write_csc(f, name, source[name], block_size, tmp_path + '.' + name.replace('/', '_'), verbose)
+    os.replace(tmp_path, path)
+    return path
+
+
+class GeneMajor:
+    """Column reads from a gene-major copy written by build_gene_major()."""
+
+    def __init__(self, path):
+        self.path = path
+        with h5py.File(path, 'r') as f:
+            self.source = f.attrs['source']
+            self.var = pd.DataFrame({k: f['var'][k][()].astype(str) for k in f['var'] if k != '_index'},
+                                    index=pd.Index(f['var/_index'][()].astype(str)))
+            self.obs_names = pd.Index(f['obs_names'][()].astype(str))
+            self.matrices = [name for name in MATRICES if name in f]
+
+    def columns(self, genes, errors: str = 'raise'):
+        """
+        Column positions of `genes`, matched against the var index, then feature_name and gene_symbols.
+        Unknown genes raise a KeyError, or get position -1 with errors='ignore'.
+        """
+        genes = pd.Index(genes)
+        positions = pd.Series(np.arange(len(self.var)), index=self.var.index).reindex(genes)
+        for column in self.var.columns:
+            if not positions.isnull().any():
+                break
+            by_symbol = pd.Series(np.arange(len(self.var)), index=self.var[column])
+            by_symbol = by_symbol.loc[~by_symbol.index.duplicated()] # First of repeated symbols
+            positions = positions.fillna(by_symbol.reindex(genes))
+        if errors == 'ignore':
+            return positions.fillna(-1).to_numpy(dtype=np.int64)
+        if positions.isnull().any():
+            raise KeyError(f'Genes not in {self.path}: {positions.index[positions.isnull()].tolist()}')
+        return positions.to_numpy(dtype=np.int64)
+
+    def read(self, genes, matrix: str = 'raw/X'):
+        """cells x genes CSC matrix of `genes` (in the given order) from one matrix of the copy."""
+        positions = self.columns(genes)
+        with h5py.File(self.path, 'r') as f:
+            g = f[matrix]
+            indptr = g['indptr'][()]
+            starts, stops = indptr[positions], indptr[positions + 1]
+            # Read the runs in file order; runs of requested genes that touch are read at once
+            order = np.argsort(starts, kind='stable')
+            data, indices = [None] * len(positions), [None] * len(positions)
+            run = 0
+            while run < len(order):
+                end = run + 1
+                while end < len(order) and starts[order[end]] <= stops[order[end - 1]]:
+                    end += 1
+                lo, hi = starts[order[run]], stops[order[run:end]].max()
+                run_data, run_indices = g['data'][lo:hi], g['indices'][lo:hi]
+                for i in order[run:end]:
+                    data[i] = run_data[starts[i] - lo:stops[i] - lo]
+                    indices[i] = run_indices[starts[i] - lo:stops[i] - lo]
+                run = end
+            n_rows = g.attrs['shape'][0]
+        col_ptr = np.concatenate([[0], np.cumsum(stops - starts)])
+        empty = np.zeros(0)
+        return sp.csc_matrix((np.concatenate(data) if len(data) else empty,
+                              np.concatenate(indices) if len(indices) else empty.astype(np.int32),
+                              col_ptr), shape=(n_rows, len(positions)))
+
+    def read_anndata(self, genes, obs=None):
+        """
+        AnnData of only `genes`: X from the copy of X and raw from the copy of raw/X, when present.
+
+        Arguments:
+            genes: Gene labels (var index, feature_name or gene_symbols), used as var_names.
+            obs: obs columns to read from the source h5ad ([] or None for the index only).
+        """
+        var = pd.DataFrame(index=pd.Index(genes).astype(str))
+        obs_df = (read_h5ad_columns(self.source, obs=obs, var=[], matrix=None).obs if obs
+                  else pd.DataFrame(index=self.obs_names))
+        X = self.read(genes, 'X').tocsr() if 'X' in self.matrices else None
+        adata = ad.AnnData(X=X, obs=obs_df, var=var)
+        if 'raw/X' in self.matrices:
+            adata.raw = ad.AnnData(X=self.read(genes, 'raw/X').tocsr(), obs=obs_df, var=var)
+        return adata
+
+
+def load_gene_major(h5ad_path, out_dir=GENE_MAJOR_DIR, build: bool = True):
+    """Open the gene-major copy for the current content of `h5ad_path`, building it first if needed."""
+    path = gene_major_path(h5ad_path, out_dir)
+    if not os.path.isfile(path):
+        if not build:
+            raise FileNotFoundError(f'No gene-major copy of {h5ad_path}; run build_gene_major()')
+        build_gene_major(h5ad_path, out_dir)
+    return GeneMajor(path)
@@ -0,0 +1,163 @@
+# Persisted gene index: normalized symbol -> Ensembl ID -> column position -> feature_length.
+# Every stage cleaned its marker lists with `if m not in unique_markers` and `if m in adata.var_names`
+# loops (quadratic in the number of markers) after capitalizing all 32k var names to match the curated
+# spelling. The index is built once per content hash of the h5ad (like camr.store) and matches
+# symbols case-insensitively, so resolving and deduplicating a marker list is a couple of hash
+# lookups over the whole list, and yields column positions into that h5ad's var directly.
+
+import os
+from dataclasses import dataclass
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from camr.h5ad import read_dataframe_columns
+from camr.store import SOURCE_H5AD, _read_strings, _write_strings, fingerprint
+
+GENE_INDEX_DIR = 'data/gene_index'
+SYMBOL_COLUMNS = ['feature_name', 'gene_symbols'] # var columns symbols are looked up in, in this order
+
+
+def normalize_symbols(symbols):
+    """Lookup keys of gene symbols or Ensembl IDs: stripped and case-folded ('CD39', 'Cd39' -> 'cd39')."""
+    return pd.Index(symbols).astype(str).str.strip().str.casefold()
+
+
+def gene_index_path(h5ad_path=SOURCE_H5AD, out_dir=GENE_INDEX_DIR):
+    stem = os.path.basename(h5ad_path).removesuffix('.h5ad')
+    return os.path.join(out_dir, f'{stem}.{fingerprint(h5ad_path)}.h5')
+
+
+def build_gene_index(h5ad_path=SOURCE_H5AD, out_dir=GENE_INDEX_DIR):
+    """Write the gene index of `h5ad_path` (var only, no matrix is read); returns its path."""
+    path = gene_index_path(h5ad_path, out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    with h5py.File(h5ad_path, 'r') as source:
+        columns = [c for c in SYMBOL_COLUMNS + ['feature_length'] if c in source['var']]
+        var = read_dataframe_columns(source['var'], columns)
+    tmp_path = path + '.tmp'
+    with h5py.File(tmp_path, 'w') as f:
+        f.attrs['source'] = os.path.abspath(h5ad_path)
+        _write_strings(f, 'Ensembl', var.index)
+        for column in var.columns.intersection(SYMBOL_COLUMNS):
+            _write_strings(f, column, var[column])
+        if 'feature_length' in var:
+            f.create_dataset('feature_length', data=var['feature_length'].astype(np.int64).to_numpy())
+    os.replace(tmp_path, path)
+    return path
+
+
+@dataclass
+class MarkerResolution:
+    """Result of GeneIndex.resolve(): one entry per input marker plus the report of the list."""
+    markers: np.ndarray   # Input markers as given
+    positions: np.ndarray # Column of every marker, -1 when not in the data
+    duplicated: np.ndarray # Marker resolves to a gene (or missing symbol) seen earlier in the list
+
+    @property
+    def found(self):
+        return self.positions >= 0
+
+    @property
+    def columns(self):
+        """Columns of the markers in the data, each gene once, in first-seen order."""
+        return self.positions[self.found & ~self.duplicated]
+
+    @property
+    def kept(self):
+        """Markers as given behind columns."""
+        return self.markers[self.found & ~self.duplicated].tolist()
+
+    @property
+    def missing(self):
+        return self.markers[~self.found & ~self.duplicated].tolist()
+
+    @property
+    def duplicates(self):
+        return self.markers[self.duplicated].tolist()
+
+    def report(self, labels=None):
+        """DataFrame of the missing and duplicate markers (Marker, Status, and Label when labels are given)."""
+        problems = ~self.found & ~self.duplicated | self.duplicated
+        report = pd.DataFrame({'Marker': self.markers[problems],
+                               'Status': np.where(self.duplicated[problems], 'duplicate', 'missing')})
+        if labels is not None:
+            report['Label'] = np.asarray(labels)[problems]
+        return report
+
+
+class GeneIndex:
+    """
+    Gene lookups on one h5ad's var, from build_gene_index() or any var table.
+
+    Arguments:
+        var: Table indexed by Ensembl ID in the h5ad's gene order, with feature_name (and optionally
+            gene_symbols and feature_length) columns.
+    """
+
+    def __init__(self, var):
+        self.var = var
+        keys = [normalize_symbols(var.index)] + [normalize_symbols(var[c]) for c in SYMBOL_COLUMNS if c in var]
+        positions = np.tile(np.arange(len(var)), len(keys))
+        # Ensembl IDs first, then symbols; the first gene with a key wins, as in the h5ad order
+        lookup = pd.Series(positions, index=pd.Index(np.concatenate([np.asarray(k) for k in keys])))
+        self.lookup = lookup.loc[~lookup.index.duplicated()]
+
+    @classmethod
+    def load(cls, path):
+        with h5py.File(path, 'r') as f:
+            var = pd.DataFrame({c: _read_strings(f, c) for c in SYMBOL_COLUMNS if c in f},
+                               index=pd.Index(_read_strings(f, 'Ensembl'), name='Ensembl'))
+            if 'feature_length' in f:
+                var['feature_length'] = f['feature_length'][()]
+        return cls(var)
+
+    def positions(self, markers):
+        """Column position of every marker (symbol in any case, or Ensembl ID); -1 when not in the data."""
+        return self.lookup.reindex(normalize_symbols(markers)).fillna(-1).to_numpy(dtype=np.int64)
+
+    def resolve(self, markers, labels=None, verbose: bool = False):
+        """
+        Resolve a marker list against the data, flagging missing and duplicate markers.
+
+        A marker is a duplicate when an earlier one resolves to the same gene (e.g. 'Cd39' after
+        'Entpd1' when both name the same gene, or the same missing symbol in another spelling).
+
+        Arguments:
+            markers: Symbols or Ensembl IDs, in order.
+            labels: Optional label of every marker (e.g. its target subtype) for the messages.
+            verbose: Print one line per duplicate and missing marker, and the markers kept.
+        """
+        markers = np.asarray(markers, dtype=object)
+        positions = self.positions(markers)
+        keys = np.where(positions >= 0, positions.astype(str), 'missing:' + np.asarray(normalize_symbols(markers), dtype=object))
+        resolution = MarkerResolution(markers, positions, pd.Index(keys).duplicated())
+        if verbose:
+            for marker, status, *label in resolution.report(labels).itertuples(index=False):
+                where = f' in {label[0]}' if label else ''
+                print(f'Found duplicate marker {marker}{where}!' if status == 'duplicate'
+                      else f'Marker {marker}{where} from curate is not in this data!')
+            print(f'Final Markers: {resolution.kept}')
+        return resolution
+
+    def feature_length(self, markers):
+        """feature_length of every marker; NaN when not in the data."""
+        positions = self.positions(markers)
+        lengths = self.var['feature_length'].to_numpy(dtype=float)
+        return np.where(positions >= 0, lengths[positions], np.nan)
+
+    def ensembl(self, markers):
+        """Ensembl ID of every marker; None when not in the data."""
+        positions = self.positions(markers)
+        return np.where(positions >= 0, self.var.index.to_numpy()[positions], None)
+
+
+def load_gene_index(h5ad_path=SOURCE_H5AD, out_dir=GENE_INDEX_DIR, build: bool = True):
+    """Open the gene index for the current content of `h5ad_path`, building it first if needed."""
+    path = gene_index_path(h5ad_path, out_dir)
+    if not os.path.isfile(path):
+        if not build:
+            raise FileNotFoundError(f'No gene index for {h5ad_path}; run build_gene_index()')
+        build_gene_index(h5ad_path, out_dir)
+    return GeneIndex.load(path)
@@ -0,0 +1,59 @@
+# Column-projected h5ad loading.
+# ad.read_h5ad() materializes every obs/var column, obsm/uns and both X and raw/X; stages that only
+# need two obs columns and one matrix then drop the rest and call malloc_trim to get the memory
+# back. read_h5ad_columns() reads just the requested elements straight from the HDF5 groups, so
+# peak memory and load time scale with what the stage uses.
+
+import datetime as dt
+
+import anndata as ad
+import h5py
+import pandas as pd
+
+try:
+    from anndata.io import read_elem # anndata >= 0.11
+except ImportError:
+    from anndata.experimental import read_elem
+
+
+def _attr(group, key):
+    value = group.attrs[key]
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def read_dataframe_columns(group, columns=None):
+    """Read the index and only `columns` of an on-disk anndata dataframe group."""
+    index = read_elem(group[_attr(group, '_index')])
+    if columns is None:
+        columns = list(group.attrs.get('column-order', []))
+    missing = [c for c in columns if c not in group]
+    if missing:
+        raise KeyError(f'{group.name} has no columns {missing}')
+    return pd.DataFrame({c: read_elem(group[c]) for c in columns},
+                        index=pd.Index(index, name=None))
+
+
+def read_h5ad_columns(path, obs=None, var=None, matrix: str | None = 'X', verbose: bool = False):
+    """
+    Load an AnnData with only the requested obs/var columns and at most one matrix.
+
+    Arguments:
+        path: Path to the h5ad file.
+        obs: obs columns to read ([] for the index only, None for all).
+        var: var columns to read ([] for the index only, None for all).
+        matrix: 'X', 'raw/X' (raw counts become the returned X) or None for no matrix.
+
+    Returns:
+        AnnData with X set to the chosen matrix (or None) and no raw, obsm, layers or uns.
+    """
+    with h5py.File(path, 'r') as f:
+        obs_df = read_dataframe_columns(f['obs'], obs)
+        var_df = read_dataframe_columns(f['var'], var)
+        X = None
+        if matrix is not None:
+            if verbose:
+                print(f'{dt.datetime.now()} Reading {matrix}')
+            X = read_elem(f[matrix])
+            if X.shape[1] != var_df.shape[0]:
+                raise ValueError(f'{matrix} has {X.shape[1]} columns but var has {var_df.shape[0]} genes')
+    return ad.AnnData(X=X, obs=obs_df, var=var_df)
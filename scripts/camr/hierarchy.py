@@ -0,0 +1,220 @@
+# Cell-type hierarchy of the atlas as integer codes.
+# Every stage re-derived its labels per cell: astype(str) over millions of rows, "Unassigned_" + label
+# list comprehensions for the cells of a major class without a subtype, .str.upper() for the curated
+# spelling, and joins with 2_minorToMajorClass.txt / 4_queried_to_name.txt. The labels only take a
+# few hundred distinct values, so the hierarchy is compiled once per content hash of the h5ad into
+# per-cell major class and subtype codes plus small label tables, saved next to the h5ad.
+# Relabeling (Unassigned_*, upper case, harmonized names) then rewrites the categories and keeps
+# the codes, and subsetting compares codes.
+
+import os
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from camr.h5ad import read_h5ad_columns
+from camr.store import SOURCE_H5AD, _read_strings, _write_strings, fingerprint
+
+QUERIED_TO_NAME = '04_Merge_Curated_Markers/4_queried_to_name.txt'
+UNASSIGNED_MAJORS = ['AC', 'BC', 'Microglia', 'RGC'] # Major classes whose cells without a subtype carry the class name
+OBS_COLUMNS = ['author_cell_type', 'minorclass', 'majorclass', 'Major_Name'] # obs columns annotate() sets by default
+HIERARCHY_VERSION = 1 # Bumped whenever the layout changes so older files are rebuilt rather than misread
+
+
+def relabel_categories(labels, mapping):
+    """
+    Categorical `labels` with its categories renamed by `mapping` (dict or function of a label); the
+    cells keep their codes and categories renamed to the same label are merged.
+    """
+    labels = pd.Series(labels).astype('category')
+    old = labels.cat.categories.astype(str)
+    new = pd.Index([mapping(c) if callable(mapping) else mapping.get(c, c) for c in old])
+    categories = new.unique()
+    codes = np.append(categories.get_indexer(new), -1)[labels.cat.codes.to_numpy()] # -1 (NaN) stays -1
+    return pd.Series(pd.Categorical.from_codes(codes, categories), index=labels.index, name=labels.name)
+
+
+def hierarchy_path(h5ad_path=SOURCE_H5AD):
+    return h5ad_path.removesuffix('.h5ad') + '.hierarchy.h5'
+
+
+def build_hierarchy(h5ad_path=SOURCE_H5AD, major: str = 'majorclass', subtype: str = 'author_cell_type',
+                    unassigned=UNASSIGNED_MAJORS):
+    """
+    Compile the cell-type codes of `h5ad_path` and save them next to it; returns the path.
+
+    Cells of a major class in `unassigned` whose subtype label is the class name get the subtype
+    'Unassigned_<class>'. Only the distinct (subtype, major class) pairs are relabelled; cells are
+    mapped to them by their codes.
+    """
+    obs = read_h5ad_columns(h5ad_path, obs=[major, subtype], var=[], matrix=None).obs
+    majors = obs[major].astype('category')
+    subtypes = obs[subtype].astype('category')
+    major_labels = pd.Index(majors.cat.categories.astype(str))
+    author_labels = pd.Index(subtypes.cat.categories.astype(str))
+    major_codes = majors.cat.codes.to_numpy().astype(np.int64)
+    author_codes = subtypes.cat.codes.to_numpy().astype(np.int64)
+    labelled = (major_codes >= 0) & (author_codes >= 0)
+
+    # Distinct (author label, major class) pairs and the pair of every labelled cell
+    pairs, cell_pair = np.unique(author_codes[labelled] * len(major_labels) + major_codes[labelled], return_inverse=True)
+    pair_author = author_labels[pairs // len(major_labels)]
+    pair_major = major_labels[pairs % len(major_labels)]
+    is_unassigned = (pair_author == pair_major) & pair_major.str.casefold().isin(pd.Index(unassigned).str.casefold())
+    pair_labels = np.where(is_unassigned, 'Unassigned_' + pair_author, pair_author)
+
+    # One subtype per distinct label; a label seen under two major classes keeps the first
+    subtype_labels, pair_subtype = np.unique(pair_labels, return_inverse=True)
+    first_pair = np.unique(pair_subtype, return_index=True)[1]
+    subtype_codes = np.full(len(obs), -1, dtype=np.int64)
+    subtype_codes[labelled] = pair_subtype[cell_pair]
+
+    path = hierarchy_path(h5ad_path)
+    tmp_path = path + '.tmp'
+    dtype = np.int16 if max(len(subtype_labels), len(major_labels)) < 2 ** 15 else np.int32
+    with h5py.File(tmp_path, 'w') as f:
+        f.attrs['source'] = os.path.abspath(h5ad_path)
+        f.attrs['fingerprint'] = fingerprint(h5ad_path)
+        f.attrs['version'] = HIERARCHY_VERSION
+        _write_strings(f, 'majors', major_labels)
+        _write_strings(f, 'subtypes', subtype_labels)
+        _write_strings(f, 'subtype_author', pair_author[first_pair])
+        f.create_dataset('subtype_major', data=major_labels.get_indexer(pair_major[first_pair]))
+        f.create_dataset('major_codes', data=major_codes.astype(dtype), compression='gzip')
+        f.create_dataset('subtype_codes', data=subtype_codes.astype(dtype), compression='gzip')
+    os.replace(tmp_path, path)
+    return path
+
+
+class CellHierarchy:
+    """
+    Major class and subtype codes of every cell of one h5ad, written by build_hierarchy().
+
+    Attributes:
+        majors, subtypes: Category labels; subtypes include the Unassigned_<class> pseudo-subtypes.
+        subtype_major: Major class code of every subtype.
+        subtype_author: Original author_cell_type label of every subtype.
+        names: Harmonized (curated) name of every subtype, from add_names(); the subtype label otherwise.
+        major_codes, subtype_codes: Per cell codes (-1 when missing), in h5ad obs order.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with h5py.File(path, 'r') as f:
+            self.source = f.attrs['source']
+            self.majors = pd.Index(_read_strings(f, 'majors'))
+            self.subtypes = pd.Index(_read_strings(f, 'subtypes'))
+            self.subtype_author = pd.Index(_read_strings(f, 'subtype_author'))
+            self.subtype_major = f['subtype_major'][()]
+            self.major_codes = f['major_codes'][()]
+            self.subtype_codes = f['subtype_codes'][()]
+        self.names = self.subtypes.copy()
+        self._aliases()
+
+    def _aliases(self):
+        # Case-insensitive label -> subtype code over the subtype labels, author labels and names
+        labels = pd.Index(np.concatenate([self.subtypes, self.subtype_author, self.names])).str.casefold()
+        lookup = pd.Series(np.tile(np.arange(len(self.subtypes)), 3), index=labels)
+        self.alias = lookup.loc[~lookup.index.duplicated()]
+
+    def add_names(self, queried_to_name):
+        """
+        Take the harmonized name of every subtype from a 4_queried_to_name.txt table (Name, Major_Name,
+        Queried_Name, Queried_Major_Name), matched on the queried subtype and major class.
+        """
+        table = queried_to_name.astype(str)
+        key = (table['Queried_Name'].str.casefold() + '\t' + table['Queried_Major_Name'].str.casefold()).to_numpy()
+        names = pd.Series(table['Name'].to_numpy(), index=key)
+        names = names.loc[~names.index.duplicated()]
+        own = self.subtype_author.str.casefold() + '\t' + self.majors[self.subtype_major].str.casefold()
+        found = names.reindex(own)
+        self.names = pd.Index(np.where(found.isnull(), self.subtypes, found.to_numpy()))
+        self._aliases()
+        return self
+
+    def codes(self, labels, errors: str = 'raise'):
+        """Subtype codes of labels (subtype, author label or harmonized name, any case); -1 with errors='ignore'."""
+        codes = self.alias.reindex(pd.Index(labels).astype(str).str.casefold())
+        if errors != 'ignore' and codes.isnull().any():
+            raise KeyError(f'Unknown cell types: {codes.index[codes.isnull()].tolist()}')
+        return codes.fillna(-1).to_numpy(dtype=np.int64)
+
+    def major(self, case=None):
+        """Per cell major class as a Categorical; case='upper' for the curated spelling."""
+        labels = pd.Categorical.from_codes(self.major_codes, self.majors)
+        return relabel_categories(labels, str.upper).array if case == 'upper' else labels
+
+    def subtype(self, case=None, names: bool = False):
+        """Per cell subtype (Unassigned_* included) as a Categorical; names=True for the harmonized names."""
+        labels = pd.Categorical.from_codes(self.subtype_codes, self.subtypes)
+        if names:
+            labels = relabel_categories(labels, dict(zip(self.subtypes, self.names))).array # Names may merge subtypes
+        return relabel_categories(labels, str.upper).array if case == 'upper' else labels
+
+    def subtypes_of(self, major, present_only: bool = True):
+        """Sorted subtype labels of a major class (label in any case); only subtypes with cells by default."""
+        code = self.majors.str.casefold().get_loc(str(major).casefold())
+        members = np.flatnonzero(self.subtype_major == code)
+        if present_only:
+            members = members[np.bincount(self.subtype_codes[self.subtype_codes >= 0], minlength=len(self.subtypes))[members] > 0]
+        return self.subtypes[members].sort_values().tolist()
+
+    def cells(self, majors=None, subtypes=None):
+        """Boolean mask of the cells in any of `majors` and any of `subtypes` (labels in any case; None for all)."""
+        mask = np.ones(len(self.subtype_codes), dtype=bool)
+        if majors is not None:
+            codes = pd.Index(self.majors.str.casefold()).get_indexer(pd.Index(majors).astype(str).str.casefold())
+            mask &= np.isin(self.major_codes, codes[codes >= 0])
+        if subtypes is not None:
+            mask &= np.isin(self.subtype_codes, self.codes(subtypes, errors='ignore'))
+        return mask
+
+    def pairs(self):
+        """minorclass -> majorclass table of the subtypes, like 02_Modeling/2_minorToMajorClass.txt."""
+        return pd.DataFrame({'minorclass': self.subtypes, 'majorclass': self.majors[self.subtype_major],
+                             'author_cell_type': self.subtype_author, 'Name': self.names})
+
+    def annotate(self, obs, case=None, columns=OBS_COLUMNS):
+        """
+        Set hierarchy columns of `obs` (same cells, same order) as categoricals.
+
+        Arguments:
+            obs: Cell table of the h5ad.
+            case: 'upper' for the curated spelling.
+            columns: Any of author_cell_type and minorclass (subtypes, Unassigned_* included),
+                majorclass and Major_Name, and Name (harmonized names, only when asked for).
+        """
+        if len(obs) != len(self.subtype_codes):
+            raise ValueError(f'obs has {len(obs)} cells but {self.path} has {len(self.subtype_codes)}')
+        labels = {'author_cell_type': 'subtype', 'minorclass': 'subtype', 'majorclass': 'major', 'Major_Name': 'major', 'Name': 'name'}
+        unknown = set(columns) - set(labels)
+        if unknown:
+            raise KeyError(f'{sorted(unknown)} are not hierarchy columns')
+        values = {}
+        for column in columns:
+            level = labels[column]
+            if level not in values:
+                values[level] = self.subtype(case, names=True) if level == 'name' else getattr(self, level)(case)
+            obs[column] = values[level]
+        return obs
+
+
+def load_hierarchy(h5ad_path=SOURCE_H5AD, queried_to_name=QUERIED_TO_NAME, build: bool = True):
+    """
+    Open the hierarchy saved next to `h5ad_path`, (re)building it when missing or when the h5ad changed;
+    harmonized names come from `queried_to_name` when that file exists.
+    """
+    path = hierarchy_path(h5ad_path)
+    current = False
+    if os.path.isfile(path):
+        with h5py.File(path, 'r') as f:
+            current = f.attrs.get('version') == HIERARCHY_VERSION and f.attrs.get('fingerprint') == fingerprint(h5ad_path)
+    if not current:
+        if not build:
+            raise FileNotFoundError(f'No current cell-type hierarchy for {h5ad_path}; run build_hierarchy()')
+        build_hierarchy(h5ad_path)
+    hierarchy = CellHierarchy(path)
+    if queried_to_name is not None and os.path.isfile(queried_to_name):
+        hierarchy.add_names(pd.read_csv(queried_to_name, sep='\t'))
+    return hierarchy
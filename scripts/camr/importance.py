@@ -0,0 +1,156 @@
+# Permutation feature importance on sparse expression matrices.
+# sklearn's permutation_importance() densifies X_test and re-predicts every cell for every one of
+# the 32k genes and repeats. Permuting a sparse column only moves its nonzero values: a uniform
+# row permutation sends the column's m nonzero rows to a uniform random m-subset of rows, which
+# rng.choice(n, m, replace=False) draws directly. Only the cells that lose or gain a value can
+# change prediction, so only those are re-predicted; genes the model never uses are skipped (their
+# importance is exactly 0). Linear models are re-scored by updating their decision values with the
+# changed entries only; any other model (e.g. the random forest) re-predicts the changed cells in
+# batches that gather many genes and repeats into one predict() call.
+
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.metrics import accuracy_score
+from sklearn.utils import Bunch
+
+from camr.modeling import ovr_coefficients, to_csr32
+
+
+def used_features(model, n_features: int):
+    """Columns a fitted model can depend on: nonzero coefficients, or the split features of its trees."""
+    if hasattr(model, 'coef_') or hasattr(model, 'estimators_') and hasattr(model.estimators_[0], 'coef_'):
+        coef, _ = ovr_coefficients(model)
+        return np.flatnonzero(np.any(coef != 0, axis=0))
+    trees = getattr(model, 'estimators_', None)
+    if trees is not None or hasattr(model, 'tree_'):
+        trees = [model] if trees is None else np.ravel(trees)
+        return np.unique(np.concatenate([tree.tree_.feature[tree.tree_.feature >= 0] for tree in trees]))
+    return np.arange(n_features)
+
+
+def _linear_predictor(model, X, base_pred):
+    # (coef, intercept, classes) when the model predicts argmax of X @ coef.T + intercept (sign for one row)
+    if not (hasattr(model, 'coef_') or hasattr(model, 'estimators_') and hasattr(model.estimators_[0], 'coef_')):
+        return None
+    coef, intercept = ovr_coefficients(model)
+    linear = (np.asarray(coef, dtype=np.float64), np.asarray(intercept, dtype=np.float64), np.asarray(model.classes_))
+    if not np.array_equal(_linear_predict(linear, X @ linear[0].T + linear[1]), base_pred):
+        return None # Not a plain linear decision rule; fall back to predict()
+    return linear
+
+
+def _linear_predict(linear, scores):
+    _, _, classes = linear
+    scores = np.asarray(scores)
+    if scores.shape[1] == 1:
+        return classes[(scores[:, 0] > 0).astype(int)]
+    return classes[scores.argmax(axis=1)]
+
+
+def sparse_permutation_importance(model, X, y, features=None, blocks=None, n_repeats: int = 10,
+                                  scoring=None, random_state: int = 42, batch_rows: int = 200_000,
+                                  feature_names=None, verbose: bool = False):
+    """
+    Permutation importance of genes (or gene groups) of a fitted classifier on sparse cells x genes X.
+
+    Arguments:
+        model: Fitted classifier with predict(); linear models are re-scored without predict().
+        X: Held-out cells x genes matrix (sparse or dense; used as CSR float32).
+        y: True labels of the cells, in the encoding model.predict() returns.
+        features: Columns to score; defaults to used_features(model).
+        blocks: Optional {name: columns} gene groups, each permuted as one unit with the same row
+            permutation for all its columns (keeps the genes' joint expression); replaces features.
+        n_repeats: Permutations per feature or block.
+        scoring: score(y_true, y_pred), higher is better; defaults to accuracy.
+        batch_rows: Changed cells gathered per predict() call for non-linear models.
+        feature_names: Names of the columns of X for the result table.
+
+    Returns:
+        Bunch like sklearn's permutation_importance() (importances_mean, importances_std,
+        importances, one row per column of X or per block) plus `table`, a DataFrame of the
+        scored features or blocks sorted by mean importance.
+    """
+    X = to_csr32(X)
+    y = np.asarray(y)
+    n_cells, n_genes = X.shape
+    accuracy = scoring is None
+    scoring = scoring or accuracy_score
+    rng = np.random.default_rng(random_state)
+
+    base_pred = model.predict(X)
+    base_score = scoring(y, base_pred)
+    base_correct = base_pred == y
+    linear = _linear_predictor(model, X, base_pred)
+    base_scores = (X @ linear[0].T + linear[1]) if linear is not None else None
+    Xc = X.tocsc()
+
+    if blocks is not None:
+        names = list(blocks)
+        units = [np.asarray(columns, dtype=np.int64) for columns in blocks.values()]
+    else:
+        features = used_features(model, n_genes) if features is None else np.asarray(features, dtype=np.int64)
+        names = None
+        units = [np.array([j]) for j in features]
+    importances = np.zeros((len(units), n_repeats))
+
+    def permuted_score(aff, pred_aff):
+        if accuracy:
+            return base_score + ((pred_aff == y[aff]).sum() - base_correct[aff].sum()) / n_cells
+        pred = base_pred.copy()
+        pred[aff] = pred_aff
+        return scoring(y, pred)
+
+    pending, pending_rows = [], 0
+    def flush():
+        nonlocal pending, pending_rows
+        if pending:
+            preds = model.predict(sp.vstack([Xa for _, _, _, Xa in pending], format='csr'))
+            offset = 0
+            for unit, repeat, aff, _ in pending:
+                importances[unit, repeat] = base_score - permuted_score(aff, preds[offset:offset + len(aff)])
+                offset += len(aff)
+        pending, pending_rows = [], 0
+
+    for unit, columns in enumerate(units):
+        # Nonzero entries of the unit's columns: source rows, local column and values
+        spans = [slice(Xc.indptr[j], Xc.indptr[j + 1]) for j in columns]
+        rows = np.concatenate([Xc.indices[span] for span in spans]).astype(np.int64)
+        if len(rows) == 0:
+            continue # Nothing moves; importance 0
+        local = np.repeat(np.arange(len(columns)), [span.stop - span.start for span in spans])
+        values = np.concatenate([Xc.data[span] for span in spans]).astype(np.float64)
+        sources, source_index = np.unique(rows, return_inverse=True)
+        for repeat in range(n_repeats):
+            targets = rng.choice(n_cells, len(sources), replace=False) # Image of the nonzero rows under a random permutation
+            aff = np.union1d(sources, targets)
+            delta = sp.csr_matrix((np.concatenate([-values, values]),
+                                   (np.concatenate([np.searchsorted(aff, rows), np.searchsorted(aff, targets[source_index])]),
+                                    np.concatenate([local, local]))), shape=(len(aff), len(columns)))
+            if linear is not None:
+                scores = base_scores[aff] + delta @ linear[0][:, columns].T
+                importances[unit, repeat] = base_score - permuted_score(aff, _linear_predict(linear, scores))
+            else:
+                expand = sp.csr_matrix((np.ones(len(columns)), (np.arange(len(columns)), columns)),
+                                       shape=(len(columns), n_genes))
+                pending += [(unit, repeat, aff, to_csr32(X[aff] + delta @ expand))]
+                pending_rows += len(aff)
+                if pending_rows >= batch_rows:
+                    flush()
+        if verbose and (unit + 1) % 1000 == 0:
+            print(f'{dt.datetime.now()} Permuted {unit + 1} of {len(units)}')
+    flush()
+
+    if blocks is not None:
+        full, index = importances, pd.Index(names, name='Block')
+    else:
+        full = np.zeros((n_genes, n_repeats))
+        full[features] = importances
+        labels = np.asarray(feature_names) if feature_names is not None else np.arange(n_genes)
+        index = pd.Index(labels[features], name='Feature')
+    table = pd.DataFrame({'Importance_Mean': importances.mean(axis=1), 'Importance_Std': importances.std(axis=1),
+                          'N_Genes': [len(columns) for columns in units]}, index=index)
+    return Bunch(importances_mean=full.mean(axis=1), importances_std=full.std(axis=1), importances=full,
+                 table=table.sort_values('Importance_Mean', ascending=False))
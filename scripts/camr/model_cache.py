@@ -0,0 +1,128 @@
+# Content-addressed cache of trained marker models and their artifacts.
+# 02.1 refits and re-dumps every model on every run, even when nothing it depends on changed.
+# A model is keyed on the hash of the source h5ad (camr.store.fingerprint), the cells it was
+# trained on, the gene columns and the training parameters; on a hit the stored validation
+# report, confusion matrix, coefficient table and pickle are copied back into place without
+# training. The coefficients are also kept as float32 .npy arrays that load memory-mapped, so
+# downstream code can score cells without unpickling the sklearn objects.
+
+import hashlib
+import json
+import os
+import shutil
+from dataclasses import dataclass
+
+import numpy as np
+
+from camr.modeling import ovr_coefficients
+
+CACHE_VERSION = 1 # Bumped whenever the entry layout changes so older entries are ignored
+
+
+def digest(*values):
+    """Short hex hash of arrays and frames (by dtype, shape and bytes; strings by value), lists of them and JSON-able values."""
+    h = hashlib.blake2b(digest_size=16)
+    for value in values:
+        if value is None:
+            h.update(b'None')
+        elif isinstance(value, (list, tuple)):
+            h.update(f'[{digest(*value)}]'.encode())
+        elif isinstance(value, np.ndarray) or hasattr(value, 'to_numpy'):
+            array = np.asarray(value)
+            if array.dtype.kind in 'OUS':
+                array = array.astype(str).astype('S') # Object columns hash by value
+            h.update(f'{array.dtype.str}{array.shape}'.encode())
+            h.update(np.ascontiguousarray(array).tobytes())
+        else:
+            h.update(json.dumps(value, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def cache_key(data, cells=None, features=None, params=None):
+    """
+    Key of a trained model.
+
+    Arguments:
+        data: Fingerprint of the source h5ad (camr.store.fingerprint()).
+        cells: What identifies the training cells, e.g. their h5ad rows or the major class and its labels.
+        features: Gene columns the model is trained on; None for all genes.
+        params: Dict of every parameter that changes the fit or its artifacts.
+    """
+    return digest(CACHE_VERSION, data, cells, features, params)
+
+
+@dataclass
+class CachedModel:
+    """A cached linear model: memory-mapped float32 coefficients plus the stored artifact files."""
+    directory: str
+    coef: np.ndarray
+    intercept: np.ndarray
+    classes: np.ndarray
+    meta: dict
+
+    def decision_function(self, X):
+        return np.asarray(X @ self.coef.T) + self.intercept
+
+    def predict(self, X):
+        scores = self.decision_function(X)
+        if scores.shape[1] == 1:
+            return self.classes[(scores[:, 0] > 0).astype(int)]
+        return self.classes[scores.argmax(axis=1)]
+
+    def file(self, name):
+        return os.path.join(self.directory, self.meta['files'][name])
+
+    def restore(self, outputs):
+        """Copy the stored artifacts to `outputs` ({artifact name: path}); names not cached are skipped."""
+        for name, path in outputs.items():
+            if name in self.meta['files']:
+                shutil.copyfile(self.file(name), path)
+
+
+class ModelCache:
+    """Directory of cache entries, one sub-directory <tag>.<key> per model."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, tag: str, key: str):
+        return os.path.join(self.directory, f'{tag}.{key}')
+
+    def load(self, tag: str, key: str):
+        """The CachedModel of (tag, key), or None on a miss."""
+        directory = self.path(tag, key)
+        if not os.path.exists(os.path.join(directory, 'meta.json')):
+            return None
+        with open(os.path.join(directory, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+        return CachedModel(directory, np.load(os.path.join(directory, 'coef.npy'), mmap_mode='r'),
+                           np.load(os.path.join(directory, 'intercept.npy')),
+                           np.load(os.path.join(directory, 'classes.npy')), meta)
+
+    def save(self, tag: str, key: str, model, files, meta=None):
+        """
+        Store a fitted model and its artifact files; the entry appears atomically once complete.
+
+        Arguments:
+            model: Fitted LogisticRegression/SGDClassifier or OneVsRestClassifier of them.
+            files: {artifact name: path} of files to keep, e.g. the report and coefficient table.
+            meta: JSON-able record stored with the entry, e.g. the training resources.
+        """
+        directory = self.path(tag, key)
+        staging = f'{directory}.tmp{os.getpid()}'
+        os.makedirs(staging, exist_ok=True)
+        coef, intercept = ovr_coefficients(model)
+        np.save(os.path.join(staging, 'coef.npy'), np.ascontiguousarray(coef, dtype=np.float32))
+        np.save(os.path.join(staging, 'intercept.npy'), np.asarray(intercept, dtype=np.float32))
+        classes = np.asarray(model.classes_)
+        np.save(os.path.join(staging, 'classes.npy'), classes if classes.dtype.kind != 'O' else classes.astype(str))
+        stored = {}
+        for name, path in files.items():
+            stored[name] = f'{name}{os.path.splitext(path)[1]}'
+            shutil.copyfile(path, os.path.join(staging, stored[name]))
+        with open(os.path.join(staging, 'meta.json'), 'w') as meta_file:
+            json.dump(dict(meta or {}, key=key, tag=tag, files=stored), meta_file, indent=1, default=str)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.replace(staging, directory)
+        return self.load(tag, key)
@@ -0,0 +1,483 @@
+# Sparse one-vs-rest logistic regression for the marker models.
+# LogisticRegression(multi_class='ovr', n_jobs=16) with the default lbfgs solver fits the classes
+# in worker processes that each receive a copy of X. Here X stays one CSR float32 matrix, every
+# binary problem is fitted with saga (cost per epoch proportional to nnz) and the binary fits run
+# in threads of this process, which share X; saga releases the GIL while it iterates.
+
+import copy
+import datetime as dt
+import multiprocessing as mp
+import os
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from joblib import Parallel, delayed, parallel_backend
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.model_selection import train_test_split
+from sklearn.multiclass import OneVsRestClassifier
+from sklearn.preprocessing import LabelBinarizer
+from threadpoolctl import threadpool_limits
+
+from camr.aggregate import read_row_block
+
+
+def to_csr32(X):
+    """X as CSR float32 with sorted indices; already conforming matrices are returned as is."""
+    if not sp.issparse(X):
+        return sp.csr_matrix(np.asarray(X, dtype=np.float32))
+    X = X if X.format == 'csr' else X.tocsr()
+    if X.dtype != np.float32:
+        X = X.astype(np.float32)
+    if not X.has_sorted_indices:
+        X.sort_indices()
+    return X
+
+
+def fit_ovr(X, y, n_jobs: int = 16, solver: str = 'saga', max_iter: int = 1000, tol: float = 1e-4,
+            C: float = 1.0, random_state: int = 42):
+    """
+    Fit one binary logistic regression per class of y on CSR float32 X, in parallel threads.
+
+    Arguments:
+        X: cells x genes matrix; converted once by to_csr32().
+        y: Class labels.
+        n_jobs: Threads fitting binary problems at the same time.
+        solver, max_iter, tol, C, random_state: As in LogisticRegression.
+
+    Returns:
+        The fitted OneVsRestClassifier; ovr_coefficients() gives its coef_/intercept_.
+    """
+    model = OneVsRestClassifier(LogisticRegression(solver=solver, max_iter=max_iter, tol=tol, C=C,
+                                                   random_state=random_state), n_jobs=n_jobs)
+    with parallel_backend('threading', n_jobs=n_jobs):
+        model.fit(to_csr32(X), y)
+    return model
+
+
+def ovr_coefficients(model):
+    """(classes x genes coefficients, intercepts) of a LogisticRegression or a OneVsRestClassifier of them."""
+    if hasattr(model, 'estimators_'):
+        return (np.vstack([estimator.coef_ for estimator in model.estimators_]),
+                np.concatenate([estimator.intercept_ for estimator in model.estimators_]))
+    return model.coef_, model.intercept_
+
+
+def balanced_subsample(labels, cap, strata=None, random_state: int = 42):
+    """
+    Sorted positions of at most `cap` randomly drawn cells per label, or per (label, stratum) pair
+    when `strata` (e.g. the reference study of every cell) is given; cap None keeps every cell.
+    """
+    labels = np.asarray(labels).astype(str)
+    if cap is None:
+        return np.arange(len(labels))
+    keys = pd.Series(labels)
+    if strata is not None:
+        keys = keys + '\t' + pd.Series(np.asarray(strata).astype(str))
+    order = np.random.default_rng(random_state).permutation(len(keys))
+    rank = keys.iloc[order].groupby(keys.iloc[order].to_numpy(), sort=False).cumcount().to_numpy()
+    return np.sort(order[rank < cap])
+
+
+def child_pids():
+    """Running descendant processes of this process (e.g. joblib/loky workers), from /proc."""
+    parents = {}
+    for pid in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                parents[int(pid)] = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+    pids, frontier = [], [os.getpid()]
+    while frontier:
+        frontier = [pid for pid, parent in parents.items() if parent in frontier]
+        pids += frontier
+    return pids
+
+
+def reset_peak_rss(pid='self'):
+    """Reset the kernel's peak resident set size (VmHWM) of a process, where Linux allows it."""
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss(pid='self'):
+    """Peak resident set size of a process in bytes since the last reset_peak_rss(), or 0 if it is gone."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if pid != 'self':
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # Lifetime peak, in kB on Linux
+
+
+@contextmanager
+def track_resources(label: str, verbose: bool = True):
+    """
+    Measure wall-clock time and peak memory of a block; yields a dict that is filled on exit with
+    'wall_s', 'peak_rss_gb' (this process, threads included) and 'children_peak_rss_gb' (worker
+    processes, e.g. the ones LogisticRegression(n_jobs=...) starts with lbfgs).
+
+    The children's value adds up the peaks of the workers still running at the end of the block and,
+    if it rose during the block, the largest peak of the workers that have exited (the kernel keeps
+    only that maximum). Peaks of different processes need not coincide, so the sum is an upper bound.
+    """
+    usage = {'label': label}
+    reset_peak_rss()
+    for pid in child_pids():
+        reset_peak_rss(pid)
+    exited_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    start = time.perf_counter()
+    try:
+        yield usage
+    finally:
+        usage['wall_s'] = time.perf_counter() - start
+        usage['peak_rss_gb'] = peak_rss() / 1e9
+        children = sum(peak_rss(pid) for pid in child_pids())
+        if resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss > exited_peak:
+            children += resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        usage['children_peak_rss_gb'] = children / 1e9
+        if verbose:
+            print(f"{dt.datetime.now()} {label}: {usage['wall_s']:.1f} s, peak RSS {usage['peak_rss_gb']:.2f} GB"
+                  f" (+ {usage['children_peak_rss_gb']:.2f} GB in worker processes)")
+
+
+# Process-parallel training of one model per group (e.g. per major class).
+# The matrix is written once to disk as CSR with its rows sorted by group, so each group's cells
+# are one contiguous row range; workers memory-map the arrays and slice their range without
+# copying. Jobs get a share of the cores proportional to their nonzeros and start largest first,
+# so the whole run takes about as long as the largest group.
+
+def write_grouped_csr(X, groups, directory, block_rows: int = 100_000):
+    """
+    Save X as CSR .npy arrays in `directory` with the rows sorted by `groups`.
+
+    The sorted rows are gathered `block_rows` at a time into the preallocated (memory-mapped) arrays,
+    so besides X only one block is held in memory.
+
+    Returns:
+        ({group: (start, stop)} row ranges of the sorted matrix, original row of every sorted row).
+    """
+    os.makedirs(directory, exist_ok=True)
+    codes, categories = pd.factorize(pd.Series(groups).astype(str), sort=True)
+    order = np.argsort(codes, kind='stable')
+    if not (sp.issparse(X) and X.format == 'csr'):
+        X = to_csr32(X)
+    indptr = np.concatenate([[0], np.cumsum(np.diff(X.indptr)[order])]).astype(np.int64)
+    nnz = int(indptr[-1])
+    data = np.lib.format.open_memmap(os.path.join(directory, 'data.npy'), mode='w+', dtype=np.float32, shape=(nnz,))
+    indices = np.lib.format.open_memmap(os.path.join(directory, 'indices.npy'), mode='w+', dtype=X.indices.dtype, shape=(nnz,))
+    for start in range(0, len(order), block_rows):
+        stop = min(start + block_rows, len(order))
+        block = to_csr32(X[order[start:stop]])
+        data[indptr[start]:indptr[stop]] = block.data
+        indices[indptr[start]:indptr[stop]] = block.indices
+    data.flush()
+    indices.flush()
+    del data, indices
+    np.save(os.path.join(directory, 'indptr.npy'), indptr)
+    np.save(os.path.join(directory, 'shape.npy'), np.asarray(X.shape))
+    bounds = np.searchsorted(codes[order], np.arange(len(categories) + 1))
+    return {group: (int(bounds[i]), int(bounds[i + 1])) for i, group in enumerate(categories)}, order
+
+
+def read_grouped_rows(directory, start: int, stop: int):
+    """Rows start:stop of a matrix written by write_grouped_csr(), as CSR over the memory-mapped arrays."""
+    data, indices, indptr = (np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+                             for name in ['data', 'indices', 'indptr'])
+    n_genes = int(np.load(os.path.join(directory, 'shape.npy'))[1])
+    lo, hi = int(indptr[start]), int(indptr[stop])
+    return sp.csr_matrix((data[lo:hi], indices[lo:hi], np.asarray(indptr[start:stop + 1]) - lo),
+                         shape=(stop - start, n_genes), copy=False)
+
+
+def split_cores(sizes, n_cores: int):
+    """Share `n_cores` between jobs in proportion to their sizes, at least one core each."""
+    sizes = pd.Series(sizes, dtype=float)
+    cores = np.maximum(1, np.floor(n_cores * sizes / sizes.sum())).astype(int)
+    for key in sizes.sort_values(ascending=False).index: # Leftover cores go to the largest jobs
+        if cores.sum() >= n_cores:
+            break
+        cores[key] += 1
+    return cores.to_dict()
+
+
+def _run_grouped_job(task):
+    job, group, directory, start, stop, labels, n_jobs = task
+    with threadpool_limits(n_jobs):
+        return group, job(group, read_grouped_rows(directory, start, stop), labels, n_jobs)
+
+
+def run_grouped_jobs(job, X, groups, labels, directory, n_cores=None, verbose: bool = True):
+    """
+    Run job(group, X_group, labels_group, n_jobs) for every group in its own process.
+
+    Arguments:
+        job: Module- or script-level function; workers are forked, so functions defined in the
+            calling script work.
+        X: cells x genes matrix; written once to a temporary directory and memory-mapped by the workers.
+        groups: Group of every cell, e.g. adata.obs['majorclass'].
+        labels: Per-cell labels handed to the job with its rows, e.g. author_cell_type.
+        directory: Scratch directory; the row-sorted matrix is written to a temporary directory in it
+            and removed once the jobs are done.
+        n_cores: Cores to share between the jobs; defaults to the cores this process may use.
+
+    Returns:
+        dict mapping each group to the job's return value.
+    """
+    n_cores = n_cores or len(os.sched_getaffinity(0))
+    os.makedirs(directory, exist_ok=True)
+    grouped = tempfile.mkdtemp(prefix='grouped_X_', dir=directory)
+    try:
+        ranges, order = write_grouped_csr(X, groups, grouped)
+        indptr = np.load(os.path.join(grouped, 'indptr.npy'))
+        sizes = {group: int(indptr[stop] - indptr[start]) + 1 for group, (start, stop) in ranges.items()}
+        cores = split_cores(sizes, n_cores)
+        labels = np.asarray(labels)[order]
+
+        tasks = [(job, group, grouped, *ranges[group], labels[slice(*ranges[group])], cores[group])
+                 for group in sorted(ranges, key=sizes.get, reverse=True)]
+        if verbose:
+            for group, cores_used in cores.items():
+                print(f'{dt.datetime.now()} {group}: {ranges[group][1] - ranges[group][0]} cells, {cores_used} cores')
+        with ProcessPoolExecutor(max_workers=len(tasks), mp_context=mp.get_context('fork')) as pool:
+            return dict(pool.map(_run_grouped_job, tasks))
+    finally:
+        shutil.rmtree(grouped, ignore_errors=True)
+
+
+# Out-of-core training: the cells are streamed from the h5ad in shuffled chunks and a linear model
+# is updated with partial_fit, so memory is one chunk however many cells are trained on.
+
+def holdout_rows(rows, path, test_size: float = 0.2, random_state: int = 42):
+    """
+    Split cell rows into (train, held-out) rows, both sorted. The held-out rows are saved to `path`
+    (.npy) and reused on later runs so every model of a cell set is validated on the same cells;
+    name the file after the data and cell set (e.g. its fingerprint and size). A saved split with
+    rows outside `rows` belongs to another cell set and is redrawn.
+    """
+    rows = np.asarray(rows)
+    test = np.load(path) if os.path.isfile(path) else None
+    if test is None or not np.isin(test, rows).all():
+        _, test = train_test_split(rows, test_size=test_size, random_state=random_state)
+        test = np.sort(test)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        np.save(path, test)
+    return np.setdiff1d(rows, test), test
+
+
+def iter_cell_chunks(h5ad_path, rows, matrix: str = 'X', chunk_size: int = 50_000,
+                     block_size: int = 20_000, rng=None, columns=None):
+    """
+    Yield (rows, CSR float32 block) for the given cells of an h5ad matrix, about `chunk_size` cells at a time.
+
+    The file is read in row blocks of `block_size` (only the span holding requested cells). With a
+    numpy Generator as rng the blocks are visited in random order and each chunk's cells are
+    shuffled; without, cells come in file order. `columns` optionally keeps only those genes.
+    """
+    rows = np.sort(np.asarray(rows))
+    with h5py.File(h5ad_path, 'r') as f:
+        m = f[matrix]
+        n_rows = m.shape[0] if isinstance(m, h5py.Dataset) else m.attrs['shape'][0]
+        starts = np.arange(0, n_rows, block_size)
+        bounds = np.searchsorted(rows, np.append(starts, n_rows))
+        starts = starts[np.diff(bounds) > 0] # Blocks holding requested cells
+        if rng is not None:
+            starts = rng.permutation(starts)
+
+        buffer_rows, buffer_X, buffered = [], [], 0
+        for i, start in enumerate(starts):
+            selected = rows[np.searchsorted(rows, start):np.searchsorted(rows, min(start + block_size, n_rows))]
+            block = sp.csr_matrix(read_row_block(m, selected[0], selected[-1] + 1))[selected - selected[0]]
+            if columns is not None:
+                block = block[:, columns]
+            buffer_rows += [selected]
+            buffer_X += [to_csr32(block)]
+            buffered += len(selected)
+            if buffered >= chunk_size or i == len(starts) - 1:
+                chunk_rows, X = np.concatenate(buffer_rows), sp.vstack(buffer_X, format='csr')
+                if rng is not None:
+                    shuffle = rng.permutation(len(chunk_rows))
+                    chunk_rows, X = chunk_rows[shuffle], X[shuffle]
+                yield chunk_rows, X
+                buffer_rows, buffer_X, buffered = [], [], 0
+
+
+def fit_incremental(h5ad_path, rows, y, classes, matrix: str = 'X', epochs: int = 5,
+                    chunk_size: int = 50_000, block_size: int = 20_000, alpha: float = 1e-4,
+                    n_jobs: int = 1, random_state: int = 42, columns=None, verbose: bool = True):
+    """
+    Train a one-vs-rest logistic-loss SGDClassifier with partial_fit on streamed, shuffled chunks.
+
+    Arguments:
+        h5ad_path: Source h5ad.
+        rows: Training cells (row numbers of the h5ad).
+        y: Label of each of `rows`, in the same order.
+        classes: Every label the model should know, as partial_fit requires them up front.
+        matrix: HDF5 path of the matrix to train on, 'X' or 'raw/X'.
+        epochs: Passes over the training cells, each in a new random order.
+        alpha: L2 regularization strength of SGDClassifier.
+        n_jobs: Threads updating the one-vs-rest problems of each chunk.
+        columns: Optional gene columns to train on instead of every gene.
+    """
+    order = np.argsort(rows, kind='stable')
+    sorted_rows, sorted_y = np.asarray(rows)[order], np.asarray(y)[order]
+    model = SGDClassifier(loss='log_loss', alpha=alpha, random_state=random_state, n_jobs=n_jobs)
+    rng = np.random.default_rng(random_state)
+    for epoch in range(epochs):
+        if verbose:
+            print(f'{dt.datetime.now()} Epoch {epoch + 1}/{epochs} over {len(sorted_rows)} cells')
+        for chunk_rows, X in iter_cell_chunks(h5ad_path, sorted_rows, matrix, chunk_size, block_size, rng, columns):
+            model.partial_fit(X, sorted_y[np.searchsorted(sorted_rows, chunk_rows)], classes=classes)
+    return model
+
+
+def predict_incremental(model, h5ad_path, rows, matrix: str = 'X', chunk_size: int = 50_000,
+                        block_size: int = 20_000, columns=None):
+    """Predictions of `model` for the cells `rows`, streamed from the h5ad; returned in sorted row order."""
+    predictions = [model.predict(X) for _, X in iter_cell_chunks(h5ad_path, rows, matrix, chunk_size, block_size,
+                                                                 columns=columns)]
+    return np.concatenate(predictions) if predictions else np.array([])
+
+
+# L1 regularization path for marker selection with a gene budget.
+# Instead of taking the top k coefficients of a dense L2 fit, every binary one-vs-rest problem is
+# fitted with an L1 (or elastic-net) penalty for increasing C, from a sparse start. With warm_start
+# each fit begins at the previous solution, which differs in a few genes, so saga converges in a
+# few epochs and the whole path costs about as much as a few independent fits. The active genes
+# and the validation accuracy of every C are kept so the solution can be picked by a gene budget.
+
+@dataclass
+class L1Path:
+    """
+    Coefficients of a one-vs-rest L1 path, one entry per C.
+
+    Attributes:
+        Cs: Inverse regularization strengths, increasing.
+        classes: Labels of the model; a binary problem has one coefficient row (for classes[1]).
+        coef: Per C, sparse rows x genes coefficients.
+        intercept: C x rows intercepts.
+        accuracy: Validation accuracy of every C.
+        estimators: The binary estimators at the last C; model() copies them.
+    """
+    Cs: np.ndarray
+    classes: np.ndarray
+    coef: list
+    intercept: np.ndarray
+    accuracy: np.ndarray
+    estimators: list
+
+    def class_genes(self):
+        """C x rows count of genes with a nonzero coefficient."""
+        return np.vstack([coef.getnnz(axis=1) for coef in self.coef])
+
+    def total_genes(self):
+        """Per C, the genes with a nonzero coefficient in any row: the genes the model needs."""
+        return np.array([len(np.unique(coef.indices)) for coef in self.coef])
+
+    def table(self):
+        """One row per C: Active_Genes (total), Max/Mean_Class_Genes and Accuracy."""
+        class_genes = self.class_genes()
+        return pd.DataFrame({'C': self.Cs, 'Active_Genes': self.total_genes(),
+                             'Max_Class_Genes': class_genes.max(axis=1), 'Mean_Class_Genes': class_genes.mean(axis=1),
+                             'Accuracy': self.accuracy})
+
+    def select(self, total=None, per_class=None):
+        """
+        Position of the most accurate C whose genes fit the budget (the larger C on ties).
+
+        Arguments:
+            total: Most genes the whole model may use, e.g. the targets of a Xenium panel.
+            per_class: Most genes any one class may use.
+        """
+        fits = np.ones(len(self.Cs), dtype=bool)
+        if total is not None:
+            fits &= self.total_genes() <= total
+        if per_class is not None:
+            fits &= self.class_genes().max(axis=1) <= per_class
+        if not fits.any():
+            raise ValueError(f'No C of the path fits {total} genes in total and {per_class} per class; start the path at a smaller C')
+        candidates = np.flatnonzero(fits)
+        return candidates[np.flatnonzero(self.accuracy[candidates] == self.accuracy[candidates].max())[-1]]
+
+    def model(self, position):
+        """OneVsRestClassifier with the coefficients of path position `position`."""
+        coef = self.coef[position].toarray()
+        estimators = []
+        for row, estimator in enumerate(self.estimators):
+            estimator = copy.deepcopy(estimator)
+            estimator.coef_ = coef[row:row + 1]
+            estimator.intercept_ = self.intercept[position, row:row + 1].copy()
+            estimator.C = self.Cs[position]
+            estimators += [estimator]
+        model = OneVsRestClassifier(self.estimators[0])
+        model.estimators_ = estimators
+        model.label_binarizer_ = LabelBinarizer(sparse_output=True).fit(self.classes)
+        model.classes_ = model.label_binarizer_.classes_
+        model.n_features_in_ = coef.shape[1]
+        return model
+
+
+def _path_scores(X, coef, intercept):
+    scores = np.asarray(X @ coef.T.toarray()) + intercept
+    return (scores[:, 0] > 0).astype(int) if scores.shape[1] == 1 else scores.argmax(axis=1)
+
+
+def fit_l1_path(X_train, y_train, X_test, y_test, Cs, l1_ratio=None, n_jobs: int = 16, max_iter: int = 1000,
+                tol: float = 1e-4, random_state: int = 42, verbose: bool = True):
+    """
+    Warm-started L1 (or elastic-net) logistic regression path of every one-vs-rest problem.
+
+    Arguments:
+        X_train, y_train: Training cells x genes (converted by to_csr32()) and labels.
+        X_test, y_test: Validation cells and labels for the accuracy of every C; split them off the
+            training cells, since select() picks C on them and they no longer measure the final model.
+        Cs: Inverse regularization strengths; fitted from the smallest (fewest genes) up.
+        l1_ratio: None for the L1 penalty, otherwise the elastic-net mixing parameter.
+        n_jobs: Threads walking the paths of different classes at the same time.
+        max_iter, tol, random_state: As in LogisticRegression.
+
+    Returns:
+        L1Path.
+    """
+    X_train, X_test = to_csr32(X_train), to_csr32(X_test)
+    y_train, y_test = np.asarray(y_train), np.asarray(y_test)
+    Cs = np.sort(np.asarray(Cs, dtype=np.float64))
+    classes = np.unique(y_train)
+    penalty = 'l1' if l1_ratio is None else 'elasticnet'
+
+    def walk(label):
+        estimator = LogisticRegression(penalty=penalty, l1_ratio=l1_ratio, solver='saga', warm_start=True,
+                                       max_iter=max_iter, tol=tol, random_state=random_state)
+        target = (y_train == label).astype(int)
+        coef, intercept = [], []
+        for C in Cs:
+            estimator.set_params(C=C).fit(X_train, target)
+            coef += [sp.csr_matrix(estimator.coef_)]
+            intercept += [estimator.intercept_[0]]
+        if verbose:
+            print(f'{dt.datetime.now()} L1 path of {label}: {coef[0].nnz} to {coef[-1].nnz} genes')
+        return estimator, coef, intercept
+
+    labels = classes[1:] if len(classes) == 2 else classes # One binary problem, as OneVsRestClassifier fits it
+    walks = Parallel(n_jobs=n_jobs, backend='threading')(delayed(walk)(label) for label in labels)
+    coef = [sp.vstack([walk[1][position] for walk in walks], format='csr') for position in range(len(Cs))]
+    intercept = np.array([[walk[2][position] for walk in walks] for position in range(len(Cs))])
+    accuracy = np.array([(classes[_path_scores(X_test, coef[position], intercept[position])] == y_test).mean()
+                         for position in range(len(Cs))])
+    return L1Path(Cs, classes, coef, intercept, accuracy, [walk[0] for walk in walks])
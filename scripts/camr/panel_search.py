@@ -0,0 +1,171 @@
+# Greedy forward/backward search for a gene panel under a budget.
+# Refitting a classifier for every candidate gene is out of reach at thousands of candidates per
+# step. The search scores panels with a Gaussian naive Bayes classifier instead, whose parameters are
+# the per-subtype means and variances already in the summary store (camr.store). Naive Bayes is a sum
+# of one term per gene, so with the per-class log-likelihood S of the current panel cached for a
+# sample of cells, adding or removing a gene is S + T[g] or S - T[g]: one cells x classes update and
+# an argmax per candidate, no refit. T[g] is a per-class constant for the cells where g is zero plus
+# a correction on g's few nonzero cells, so it is built on the fly from the sparse column.
+
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from camr.h5ad import read_h5ad_columns
+from camr.modeling import balanced_subsample
+
+HISTORY_COLUMNS = ['Step', 'Action', 'Added', 'Removed', 'N_Genes', 'Accuracy', 'Margin']
+
+
+class PanelSearch:
+    """
+    Naive Bayes panel scoring and greedy search over candidate genes.
+
+    Arguments:
+        summary_store: camr.store.SummaryStore of the h5ad; supplies the per-class means and variances.
+        gene_major: camr.gene_major.GeneMajor copy of the same h5ad; supplies the evaluation cells.
+        candidates: Ensembl IDs the search may use (e.g. camr.xenium.panel_feasible_genes() plus the
+            start panel).
+        groupby: Classes to separate, an obs column summarized in the store.
+        layer, matrix: Store layer and gene-major matrix of the same counts ('norm' and 'X', as the
+            02.1 models, or 'raw' and 'raw/X').
+        cells_per_class: Evaluation cells drawn per class. They are also in the store statistics, so
+            accuracies are optimistic; they are for ranking panels, not reporting.
+        var_smoothing: Fraction of each gene's largest class variance added to all its variances.
+    """
+
+    def __init__(self, summary_store, gene_major, candidates, groupby: str = 'author_cell_type',
+                 layer: str = 'norm', matrix: str = 'X', cells_per_class: int = 50,
+                 var_smoothing: float = 1e-2, random_state: int = 42, n_jobs: int = 8, verbose: bool = True):
+        self.verbose = verbose
+        self.n_jobs = n_jobs
+        stats = summary_store.stats(layer, groupby)
+        present = stats.n_cells > 0
+        self.classes = stats.groups[present].astype(str)
+        self.genes = pd.Index(pd.unique(pd.Index(candidates).astype(str))).intersection(stats.genes, sort=False)
+        columns = stats.genes.get_indexer(self.genes)
+        mean = stats.mean[present][:, columns]
+        var = stats.variance[present][:, columns]
+        var = var + var_smoothing * var.max(axis=0) + 1e-9
+        # Per gene and class: term(x) = const + x * linear + x^2 * quad
+        self.const = (-0.5 * (mean ** 2 / var + np.log(var))).T.astype(np.float32)  # genes x classes
+        self.linear = (mean / var).T.astype(np.float32)
+        self.quad = (-0.5 / var).T.astype(np.float32)
+
+        labels = read_h5ad_columns(gene_major.source, obs=[groupby], var=[], matrix=None).obs[groupby].astype(str)
+        labelled = np.flatnonzero(labels.isin(self.classes).to_numpy())
+        self.rows = labelled[balanced_subsample(labels.iloc[labelled], cells_per_class, random_state=random_state)]
+        self.y = self.classes.get_indexer(labels.iloc[self.rows])
+        X = gene_major.read(self.genes, matrix)
+        self.X = X[self.rows].tocsc() # Evaluation cells x candidate genes
+        if verbose:
+            print(f'{dt.datetime.now()} Panel search: {len(self.genes)} candidates, {len(self.classes)} classes, '
+                  f'{len(self.rows)} evaluation cells')
+
+    def term(self, gene: int):
+        """cells x classes log-likelihood term of candidate position `gene`."""
+        T = np.broadcast_to(self.const[gene], (len(self.rows), len(self.classes))).copy()
+        span = slice(self.X.indptr[gene], self.X.indptr[gene + 1])
+        x = self.X.data[span][:, np.newaxis]
+        T[self.X.indices[span]] += x * self.linear[gene] + x ** 2 * self.quad[gene]
+        return T
+
+    def scores(self, panel):
+        """cells x classes log-likelihood of a panel (candidate positions)."""
+        S = np.zeros((len(self.rows), len(self.classes)), dtype=np.float32)
+        for gene in panel:
+            S += self.term(gene)
+        return S
+
+    def _evaluate(self, S):
+        # (accuracy, mean margin of the true class over the best class)
+        best = S.max(axis=1)
+        true = S[np.arange(len(self.y)), self.y]
+        return (true >= best).mean(), (true - best).mean()
+
+    def _step(self, S, genes, sign: int):
+        # (accuracy, margin) of S + sign * T[g] for every g in genes
+        def evaluate(gene):
+            span = slice(self.X.indptr[gene], self.X.indptr[gene + 1])
+            rows, x = self.X.indices[span], self.X.data[span][:, np.newaxis]
+            shifted = S + sign * self.const[gene]
+            shifted[rows] += sign * (x * self.linear[gene] + x ** 2 * self.quad[gene])
+            return self._evaluate(shifted)
+        with ThreadPoolExecutor(self.n_jobs) as pool:
+            return np.array(list(pool.map(evaluate, genes)))
+
+    @staticmethod
+    def _best(results):
+        # Position of the highest accuracy, ties broken by margin
+        return np.lexsort((results[:, 1], results[:, 0]))[-1]
+
+    def positions(self, genes):
+        """Candidate positions of Ensembl IDs; genes that are not candidates are dropped."""
+        positions = self.genes.get_indexer(pd.Index(genes).astype(str))
+        return list(dict.fromkeys(positions[positions >= 0]))
+
+    def evaluate(self, genes):
+        """(accuracy, margin) of a panel of Ensembl IDs on the evaluation cells."""
+        return self._evaluate(self.scores(self.positions(genes)))
+
+    def optimize(self, start=(), budget: int = 91, max_swaps: int = 100):
+        """
+        Greedy search from `start` (Ensembl IDs; empty for an empty panel).
+
+        A panel above the budget first drops the gene whose removal costs least until it fits. Below the
+        budget the candidate adding the most accuracy is added until the budget is reached. Then swaps:
+        the gene whose removal costs least is dropped and the best candidate added in its place, for as
+        long as that improves the accuracy (at most max_swaps times).
+
+        Returns:
+            (panel as a list of Ensembl IDs in the order kept, history DataFrame with HISTORY_COLUMNS)
+        """
+        panel = self.positions(start)
+        S = self.scores(panel)
+        current = self._evaluate(S)
+        history = [(0, 'start', '', '', len(panel), *current)]
+
+        def record(action, added, removed):
+            history.append((len(history), action, '' if added is None else self.genes[added],
+                            '' if removed is None else self.genes[removed], len(panel), *current))
+            if self.verbose:
+                print(f'{dt.datetime.now()} {action}: {len(panel)} genes, accuracy {current[0]:.4f}')
+
+        while len(panel) > budget:
+            results = self._step(S, panel, -1)
+            removed = panel.pop(self._best(results))
+            S -= self.term(removed)
+            current = self._evaluate(S)
+            record('remove', None, removed)
+
+        while len(panel) < budget:
+            pool = np.setdiff1d(np.arange(len(self.genes)), panel)
+            if len(pool) == 0:
+                break
+            results = self._step(S, pool, 1)
+            added = pool[self._best(results)]
+            panel.append(added)
+            S += self.term(added)
+            current = self._evaluate(S)
+            record('add', added, None)
+
+        for _ in range(max_swaps):
+            if not panel:
+                break
+            drop = panel[self._best(self._step(S, panel, -1))]
+            without = S - self.term(drop)
+            pool = np.setdiff1d(np.arange(len(self.genes)), panel)
+            if len(pool) == 0:
+                break
+            results = self._step(without, pool, 1)
+            best = self._best(results)
+            if tuple(results[best]) <= current:
+                break
+            panel[panel.index(drop)] = pool[best]
+            S = without + self.term(pool[best])
+            current = self._evaluate(S)
+            record('swap', pool[best], drop)
+
+        return self.genes[panel].tolist(), pd.DataFrame(history, columns=HISTORY_COLUMNS)
@@ -0,0 +1,117 @@
+# Scoring candidate gene panels by how well they separate cell types.
+# A panel is scored by cross-validating the majorclass model and every major class's subtype model
+# with only the panel genes as features, and reporting per-class precision, recall and F1. With ~100
+# genes the columns come from the gene-major copy of the h5ad (camr.gene_major), and columns read for
+# one panel stay in memory for the next, so a batch of overlapping panels reads each gene once and
+# scores in seconds per panel.
+
+import datetime as dt
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.metrics import precision_recall_fscore_support
+from sklearn.model_selection import StratifiedKFold
+
+from camr.gene_major import GENE_MAJOR_DIR, load_gene_major
+from camr.h5ad import read_h5ad_columns
+from camr.modeling import balanced_subsample, fit_ovr, to_csr32
+from camr.xenium import read_panel_targets
+
+COLUMNS = ['Panel', 'Level', 'Major_Name', 'Name', 'Precision', 'Recall', 'F1', 'Support', 'N_Genes', 'N_Missing']
+
+
+def read_panel(path, column: str = 'Marker'):
+    """Genes of a panel file: the custom targets (Ensembl) of a Xenium panel JSON, or the unique `column` of a marker table."""
+    if os.path.splitext(path)[1] == '.json':
+        return read_panel_targets(path)['Ensembl'].tolist()
+    return pd.read_csv(path, sep='\t')[column].drop_duplicates().tolist()
+
+
+def cross_validated_predictions(X, y, folds: int = 5, n_jobs: int = 4, max_iter: int = 200, random_state: int = 42):
+    """Out-of-fold predictions of the one-vs-rest model (camr.modeling.fit_ovr) for every cell of X."""
+    y = np.asarray(y)
+    predictions = np.empty_like(y)
+    for train, test in StratifiedKFold(folds, shuffle=True, random_state=random_state).split(np.zeros(len(y)), y):
+        model = fit_ovr(X[train], y[train], n_jobs=n_jobs, max_iter=max_iter, random_state=random_state)
+        predictions[test] = model.predict(X[test])
+    return predictions
+
+
+class PanelScorer:
+    """
+    Scores gene lists on one h5ad through its gene-major copy.
+
+    Arguments:
+        h5ad_path: Source h5ad; only obs labels are read from it.
+        matrix: Gene-major matrix the models are trained on ('X' normalized, as in 02.1, or 'raw/X').
+        majorclass, subtype: obs columns of the two levels.
+    """
+
+    def __init__(self, h5ad_path, matrix: str = 'X', gene_major_dir=GENE_MAJOR_DIR, build: bool = True,
+                 majorclass: str = 'majorclass', subtype: str = 'author_cell_type'):
+        self.gene_major = load_gene_major(h5ad_path, gene_major_dir, build)
+        self.matrix = matrix
+        obs = read_h5ad_columns(h5ad_path, obs=[majorclass, subtype], var=[], matrix=None).obs
+        self.majorclass = obs[majorclass].astype(str).to_numpy()
+        self.subtype = obs[subtype].astype(str).to_numpy()
+        self._X = sp.csc_matrix((len(obs), 0), dtype=np.float32) # Columns read so far
+        self._slot = {}                                             # Gene-major column -> column of _X
+
+    def read(self, genes):
+        """(CSR float32 cells x found genes, found genes, missing genes); columns are read once and kept."""
+        positions = self.gene_major.columns(genes, errors='ignore')
+        genes = np.asarray(genes).astype(str)
+        found = positions >= 0
+        new = [position for position in dict.fromkeys(positions[found]) if position not in self._slot]
+        if new:
+            self._slot.update({position: self._X.shape[1] + i for i, position in enumerate(new)})
+            columns = self.gene_major.read(self.gene_major.var.index[new], self.matrix).astype(np.float32)
+            self._X = sp.hstack([self._X, columns], format='csc')
+        slots = [self._slot[position] for position in dict.fromkeys(positions[found])]
+        return to_csr32(self._X[:, slots]), genes[found].tolist(), genes[~found].tolist()
+
+    def score(self, genes, name: str = 'panel', folds: int = 5, cells_per_class: int = 2000, n_jobs: int = 4,
+              max_iter: int = 200, random_state: int = 42, verbose: bool = True):
+        """
+        Per-class cross-validated precision, recall and F1 of the majorclass and subtype models on `genes`.
+
+        Arguments:
+            genes: Panel genes (Ensembl IDs or symbols); genes missing from the data are counted, not used.
+            name: Panel column of the result.
+            folds: Stratified cross-validation folds; classes with fewer cells are not scored.
+            cells_per_class: Cells drawn per class of every model (None for all), see balanced_subsample().
+            n_jobs, max_iter, random_state: Passed to fit_ovr().
+
+        Returns:
+            DataFrame with COLUMNS, one row per class of each model; Level is 'majorclass' or 'minorclass'.
+        """
+        X, found, missing = self.read(genes)
+        models = [('majorclass', None, np.arange(len(self.majorclass)), self.majorclass)]
+        for majorclass in np.unique(self.majorclass):
+            rows = np.flatnonzero(self.majorclass == majorclass)
+            models += [('minorclass', majorclass, rows, self.subtype[rows])]
+
+        scores = []
+        for level, majorclass, rows, y in models:
+            keep = balanced_subsample(y, cells_per_class, random_state=random_state)
+            rows, y = rows[keep], y[keep]
+            classes, counts = np.unique(y, return_counts=True)
+            scored = np.isin(y, classes[counts >= folds])
+            if len(classes[counts >= folds]) < 2 or len(found) == 0:
+                continue
+            rows, y = rows[scored], y[scored]
+            predictions = cross_validated_predictions(X[rows], y, folds, n_jobs, max_iter, random_state)
+            labels = np.unique(y)
+            precision, recall, f1, support = precision_recall_fscore_support(y, predictions, labels=labels, zero_division=0)
+            scores += [pd.DataFrame({'Panel': name, 'Level': level, 'Major_Name': labels if majorclass is None else majorclass,
+                                     'Name': labels, 'Precision': precision, 'Recall': recall, 'F1': f1, 'Support': support,
+                                     'N_Genes': len(found), 'N_Missing': len(missing)})]
+        if verbose:
+            print(f'{dt.datetime.now()} Scored {name}: {len(found)} genes, {len(missing)} missing')
+        return pd.concat(scores, ignore_index=True) if scores else pd.DataFrame(columns=COLUMNS)
+
+    def score_panels(self, panels, **kwargs):
+        """score() of every {name: genes} panel, concatenated."""
+        return pd.concat([self.score(genes, name, **kwargs) for name, genes in panels.items()], ignore_index=True)
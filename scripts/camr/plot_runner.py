@@ -0,0 +1,138 @@
+# Spec-driven batch dotplots.
+# Each plot is a dict: which markers, grouped by what, over which cells, raw or normalized counts,
+# colour range and output path. run_plot_specs() loads nothing itself: the caller passes the one
+# AnnData, every (cell filter, groupby) pair needed by the specs is aggregated in one sparse pass
+# per count type over the union of marker columns, and the figures are rendered in a process pool.
+
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scanpy as sc
+
+from camr.aggregate import aggregate_groups
+from camr.dotplot import dotplot_from_table
+
+# Keys a spec may have and their defaults; 'markers', 'groupby' and 'save' are required
+SPEC_DEFAULTS = {
+    'cells': None,            # {obs column: [allowed values]} or None for all cells
+    'raw': False,             # raw counts (adata.raw.X) instead of adata.X
+    'vmin': 0,
+    'vmax': None,
+    'categories_order': None, # Groups to show, in order; defaults to the groups present
+    'figsize': None,
+}
+
+
+def read_marker_file(path, column: str = 'Marker', sep: str = '\t'):
+    """Unique markers of a marker table, in file order."""
+    return pd.read_csv(path, sep=sep)[column].drop_duplicates().tolist()
+
+
+def _resolve(spec):
+    spec = {**SPEC_DEFAULTS, **spec}
+    if isinstance(spec['markers'], str):
+        spec['markers'] = read_marker_file(spec['markers'])
+    return spec
+
+
+def _cell_filter_key(cells):
+    # Hashable identity of a cell filter so specs sharing it share one aggregation
+    if cells is None:
+        return None
+    return tuple(sorted((column, tuple(values)) for column, values in cells.items()))
+
+
+def _cell_mask(obs, cells):
+    mask = np.ones(obs.shape[0], dtype=bool)
+    for column, values in (cells or {}).items():
+        mask &= obs[column].astype(str).isin([str(v) for v in values]).to_numpy()
+    return mask
+
+
+def aggregate_specs(adata, specs, verbose: bool = True):
+    """
+    Group statistics for every spec with one aggregation per count type.
+
+    Every distinct (cell filter, groupby) pair becomes one grouping column of a scratch obs table
+    (the groupby labels, missing outside the filter), so all of them share a single stacked
+    indicator product over the union of marker columns.
+
+    Returns:
+        dict mapping (raw, cell filter key, groupby) to GroupStats.
+    """
+    genes = pd.Index([m for spec in specs for m in spec['markers']]).drop_duplicates()
+    columns = pd.Series(np.arange(adata.n_vars), index=adata.var_names)
+    columns = columns.loc[~columns.index.duplicated()].reindex(genes)
+    if columns.isnull().any():
+        raise KeyError(f'Markers not in adata.var_names: {columns.index[columns.isnull()].tolist()}')
+    columns = columns.to_numpy(dtype=np.int64)
+
+    results = {}
+    for raw in sorted({spec['raw'] for spec in specs}):
+        groupings, scratch_obs = {}, {}
+        for spec in (s for s in specs if s['raw'] == raw):
+            key = (_cell_filter_key(spec['cells']), spec['groupby'])
+            if key in groupings:
+                continue
+            name = f'grouping_{len(groupings)}'
+            labels = adata.obs[spec['groupby']].astype(str).where(_cell_mask(adata.obs, spec['cells']))
+            scratch_obs[name] = pd.Categorical(labels)
+            groupings[key] = name
+        if verbose:
+            print(f'{dt.datetime.now()} Aggregating {len(groupings)} groupings of {len(genes)} genes, raw = {raw}')
+
+        X = (adata.raw.X if raw else adata.X)[:, columns]
+        stats = aggregate_groups(X, pd.DataFrame(scratch_obs, index=adata.obs_names),
+                                 list(groupings.values()), genes=genes)
+        for (cells, groupby), name in groupings.items():
+            stats[name].groups = stats[name].groups.rename(groupby)
+            results[(raw, cells, groupby)] = stats[name]
+    return results
+
+
+def _init_worker(dotplot_defaults):
+    for attr, value in dotplot_defaults.items():
+        setattr(sc.pl.DotPlot, attr, value)
+
+
+def _render(task):
+    mean, frac, kwds = task
+    dotplot_from_table(mean, frac, show=False, **kwds)
+    return kwds['save']
+
+
+def run_plot_specs(adata, specs, n_jobs: int = 4, verbose: bool = True):
+    """
+    Aggregate once and render every spec; returns the list of saved figure paths.
+
+    Arguments:
+        adata: The loaded AnnData; var_names must hold the marker symbols.
+        specs: List of spec dicts, see SPEC_DEFAULTS for the optional keys.
+        n_jobs: Rendering processes; 1 renders in this process.
+    """
+    specs = [_resolve(spec) for spec in specs]
+    stats = aggregate_specs(adata, specs, verbose=verbose)
+
+    tasks = []
+    for spec in specs:
+        group_stats = stats[(spec['raw'], _cell_filter_key(spec['cells']), spec['groupby'])]
+        genes = pd.Index(spec['markers']).drop_duplicates()
+        mean = group_stats.to_frame('mean')[genes]
+        frac = group_stats.to_frame('frac')[genes]
+        kwds = {k: spec[k] for k in ['vmin', 'vmax', 'categories_order', 'figsize', 'save'] if spec[k] is not None}
+        tasks += [(mean, frac, dict(kwds, var_names=spec['markers'], groupby=spec['groupby']))]
+
+    # The style defaults scripts set on sc.pl.DotPlot must reach the worker processes too
+    dotplot_defaults = {attr: getattr(sc.pl.DotPlot, attr)
+                        for attr in dir(sc.pl.DotPlot) if attr.startswith('DEFAULT_')}
+    if n_jobs == 1:
+        saved = [_render(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                 initargs=(dotplot_defaults,)) as pool:
+            saved = list(pool.map(_render, tasks))
+    if verbose:
+        print(f'{dt.datetime.now()} Saved {len(saved)} dotplots')
+    return saved
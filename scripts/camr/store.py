@@ -0,0 +1,207 @@
+# Persistent pseudobulk summary store.
+# One HDF5 file per source h5ad, named by a content hash of that h5ad, holding per group x gene
+# sum, sum of squares, nonzero count, mean and fraction expressing for raw and normalized counts,
+# plus the gene metadata the filter stages need (Ensembl ID, feature_name, feature_length), and
+# the same statistics per group and chemistry (library_platform) from the same pass.
+# Filter stages read this (a few MB) instead of re-reading the 11 GB h5ad or the
+# data/raw_meanExpression_*.txt tables.
+
+import datetime as dt
+import hashlib
+import os
+
+import anndata as ad
+import h5py
+import numpy as np
+import pandas as pd
+
+from camr.aggregate import GroupStats, aggregate_groups_backed
+
+SOURCE_H5AD = '01_QualityControl/1_camr_scrublet_batch_filtered.h5ad'
+STORE_DIR = 'data/summary'
+GROUPBYS = ['majorclass', 'author_cell_type']
+STRATA = ['library_platform'] # Every grouping is also summarized per (group, stratum)
+LAYERS = {'raw': 'raw/X', 'norm': 'X'} # Store layer name -> matrix inside the h5ad
+STATS = ['n_cells', 'sum', 'sumsq', 'nnz']
+STORE_VERSION = 2 # Bumped whenever the layout changes so older stores are rebuilt rather than misread
+
+
+FINGERPRINT_GROUPS = ['obs', 'var', 'raw/var'] # h5ad groups hashed in full: labels and gene tables are what in-place edits change
+FINGERPRINT_INDPTRS = ['X/indptr', 'raw/X/indptr'] # Sparsity structure of the matrices, hashed in full
+_fingerprints = {} # (path, size, mtime) -> fingerprint, so repeated lookups in one run hash once
+
+
+def _hash_datasets(digest, group):
+    # Every dataset under an HDF5 group, in name order, with its path, shape and bytes
+    names = []
+    group.visititems(lambda name, item: names.append(name) if isinstance(item, h5py.Dataset) else None)
+    for name in sorted(names):
+        values = group[name][()]
+        digest.update(f'{group.name}/{name}{np.shape(values)}'.encode())
+        digest.update(np.asarray(values).tobytes() if np.asarray(values).dtype != object else str(values.tolist()).encode())
+
+
+def fingerprint(path, n_samples: int = 64, sample_bytes: int = 1 << 20, full: bool = False):
+    """
+    Content hash of a (large) file, used to key every artifact derived from an h5ad.
+
+    By default the file size, `n_samples` evenly spaced blocks of `sample_bytes` and, for HDF5
+    files, the whole obs/var tables and the indptr of X and raw/X are hashed. That takes a few
+    seconds on the 11 GB h5ad and catches in-place edits of labels, genes or cells that keep the
+    file size; only matrix values edited in place between the sampled blocks go unnoticed. Use
+    full=True to hash every byte.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, n_samples, sample_bytes, full)
+    if key in _fingerprints:
+        return _fingerprints[key]
+    digest = hashlib.blake2b(digest_size=16)
+    size = stat.st_size
+    digest.update(str(size).encode())
+    with open(path, 'rb') as f:
+        if full or size <= n_samples * sample_bytes:
+            for block in iter(lambda: f.read(sample_bytes * 16), b''):
+                digest.update(block)
+        else:
+            for offset in np.linspace(0, size - sample_bytes, n_samples).astype(np.int64):
+                f.seek(int(offset))
+                digest.update(f.read(sample_bytes))
+    if not full and h5py.is_hdf5(path):
+        with h5py.File(path, 'r') as f:
+            for name in FINGERPRINT_GROUPS:
+                if isinstance(f.get(name), h5py.Group):
+                    _hash_datasets(digest, f[name])
+            for name in FINGERPRINT_INDPTRS:
+                if isinstance(f.get(name), h5py.Dataset):
+                    digest.update(f[name][()].tobytes())
+    _fingerprints[key] = digest.hexdigest()
+    return _fingerprints[key]
+
+
+def store_path(h5ad_path=SOURCE_H5AD, store_dir=STORE_DIR):
+    stem = os.path.basename(h5ad_path).removesuffix('.h5ad')
+    return os.path.join(store_dir, f'{stem}.{fingerprint(h5ad_path)}.v{STORE_VERSION}.h5')
+
+
+def _write_strings(group, name, values):
+    group.create_dataset(name, data=np.asarray(values, dtype=object).astype(str).astype('S'))
+
+
+def _read_strings(group, name):
+    return group[name][()].astype(str)
+
+
+def build_summary_store(h5ad_path=SOURCE_H5AD, store_dir=STORE_DIR, groupbys=GROUPBYS, strata=STRATA,
+                        block_size: int = 20_000, verbose: bool = True, n_jobs: int = 1):
+    """
+    Stream every layer of `h5ad_path` once and write the summary store; returns its path.
+
+    Arguments:
+        h5ad_path: Source h5ad.
+        store_dir: Directory holding one store file per source content hash.
+        groupbys: obs columns to summarize by.
+        strata: obs columns to also summarize every grouping by, e.g. library_platform.
+        block_size: Cells per streamed row block.
+        n_jobs: Worker processes streaming the h5ad in parallel.
+    """
+    path = store_path(h5ad_path, store_dir)
+    os.makedirs(store_dir, exist_ok=True)
+
+    adata = ad.read_h5ad(h5ad_path, backed='r')
+    var = adata.var
+    raw_var_names = adata.raw.var_names if adata.raw is not None else var.index
+    obs_groups = adata.obs[groupbys + strata].astype(str).value_counts().rename('n_cells').reset_index()
+    adata.file.close()
+    if not raw_var_names.equals(var.index):
+        raise ValueError('raw.var and var list different genes; the store assumes one gene order')
+
+    tmp_path = path + '.tmp'
+    with h5py.File(tmp_path, 'w') as f:
+        f.attrs['source'] = os.path.abspath(h5ad_path)
+        f.attrs['fingerprint'] = fingerprint(h5ad_path)
+        f.attrs['version'] = STORE_VERSION
+        f.attrs['created'] = str(dt.datetime.now())
+
+        genes = f.create_group('var')
+        _write_strings(genes, 'Ensembl', var.index)
+        _write_strings(genes, 'feature_name', var['feature_name'])
+        genes.create_dataset('feature_length', data=var['feature_length'].astype(np.int64).to_numpy())
+
+        obs = f.create_group('obs_groups')
+        for column in groupbys + strata:
+            _write_strings(obs, column, obs_groups[column])
+        obs.create_dataset('n_cells', data=obs_groups['n_cells'].to_numpy())
+
+        for layer, matrix in LAYERS.items():
+            if verbose:
+                print(f'{dt.datetime.now()} Summarizing {matrix}')
+            group_stats = aggregate_groups_backed(h5ad_path, groupbys, matrix=matrix, genes=var.index,
+                                                  block_size=block_size, n_jobs=n_jobs, strata=strata)
+            for key, stats in group_stats.items():
+                if isinstance(key, tuple): # (groupby, stratum)
+                    g = f.create_group(f'{layer}/{key[0]}/by_{key[1]}')
+                    _write_strings(g, 'groups', stats.groups.get_level_values(0))
+                    _write_strings(g, 'strata', stats.groups.get_level_values(1))
+                else:
+                    g = f.create_group(f'{layer}/{key}')
+                    _write_strings(g, 'groups', stats.groups)
+                for stat in STATS + ['mean', 'frac']:
+                    g.create_dataset(stat, data=getattr(stats, stat), compression='gzip')
+    os.replace(tmp_path, path) # Only a complete store is ever picked up by the filter stages
+    return path
+
+
+class SummaryStore:
+    """Read access to a summary store written by build_summary_store()."""
+
+    def __init__(self, path):
+        self.path = path
+        with h5py.File(path, 'r') as f:
+            self.var = pd.DataFrame({
+                'feature_name': _read_strings(f['var'], 'feature_name'),
+                'feature_length': f['var/feature_length'][()],
+            }, index=pd.Index(_read_strings(f['var'], 'Ensembl'), name='Ensembl'))
+            self.obs_groups = pd.DataFrame({k: _read_strings(f['obs_groups'], k)
+                                            for k in f['obs_groups'] if k != 'n_cells'})
+            self.obs_groups['n_cells'] = f['obs_groups/n_cells'][()]
+
+    @staticmethod
+    def _groups(g, groupby, stratum):
+        if stratum is None:
+            return pd.Index(_read_strings(g, 'groups'), name=groupby)
+        return pd.MultiIndex.from_arrays([_read_strings(g, 'groups'), _read_strings(g, 'strata')],
+                                         names=[groupby, stratum])
+
+    def stats(self, layer: str = 'raw', groupby: str = 'author_cell_type', stratum=None):
+        """
+        GroupStats of one layer ('raw' or 'norm') and grouping, columns labelled by Ensembl ID.
+        With a stratum (e.g. 'library_platform') the rows are (group, stratum) pairs.
+        """
+        with h5py.File(self.path, 'r') as f:
+            g = f[f'{layer}/{groupby}' + (f'/by_{stratum}' if stratum else '')]
+            return GroupStats(self._groups(g, groupby, stratum), self.var.index,
+                              *(g[stat][()] for stat in STATS))
+
+    def frame(self, stat: str = 'mean', layer: str = 'raw', groupby: str = 'author_cell_type', stratum=None):
+        """
+        One statistic as a groups x genes table labelled by feature_name, like data/raw_meanExpression_*.txt.
+        Besides STATS, 'mean' and 'frac', 'auroc' and 'lift' once camr.specificity has written them.
+        """
+        with h5py.File(self.path, 'r') as f:
+            g = f[f'{layer}/{groupby}' + (f'/by_{stratum}' if stratum else '')]
+            return pd.DataFrame(g[stat][()], index=self._groups(g, groupby, stratum),
+                                columns=self.var['feature_name'].tolist())
+
+    def group_pairs(self, child: str = 'author_cell_type', parent: str = 'majorclass'):
+        """Distinct (child, parent) labels present in the data, e.g. minorclass -> majorclass."""
+        return self.obs_groups[[child, parent]].drop_duplicates().reset_index(drop=True)
+
+
+def load_summary_store(h5ad_path=SOURCE_H5AD, store_dir=STORE_DIR, build: bool = True, n_jobs: int = 1):
+    """Open the store for the current content of `h5ad_path`, building it first if needed."""
+    path = store_path(h5ad_path, store_dir)
+    if not os.path.isfile(path):
+        if not build:
+            raise FileNotFoundError(f'No summary store for {h5ad_path}; run build_summary_store()')
+        build_summary_store(h5ad_path, store_dir, n_jobs=n_jobs)
+    return SummaryStore(path)
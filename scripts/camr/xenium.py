@@ -0,0 +1,277 @@
+# Xenium panel feasibility of genes.
+# A marker is only usable on the panel if its transcript is long enough for the probes and its raw
+# mean count is detectable in some cell group without optically crowding any group. These are the
+# rules 03.1 and 05.x apply after modeling; panel_feasible_genes() evaluates them up front from the
+# summary store so the models can be trained on feasible genes only.
+# XeniumFilter applies the same rules to marker tables: the per-group reductions (any subtype of a
+# major class detectable or crowding, any major class ...) are computed once as the group x gene
+# maximum raw mean, and every marker row is resolved to integer gene, subtype and major class
+# positions, so the whole annotated table is a handful of NumPy gathers instead of melts and merges of
+# 32k-column tables. Every rule is then a comparison with a threshold, which is what lets sweep()
+# evaluate a whole grid of thresholds at once.
+
+import json
+
+import numpy as np
+import pandas as pd
+
+LENGTH_THRESHOLD = 960 # Conservative minimum transcript length
+COUNT_LOWCLUSTER = 4 # Recommended detection limit for cell markers
+COUNT_HIGHCLUSTER = 100 # Recommended detection ceiling
+MINOR_KEEP_MAJORS = ['AC', 'BC', 'Microglia', 'RGC'] # Major classes whose subtypes decide the 05.1 minor_keep
+
+
+def panel_feasible_genes(summary_store, groups=None, groupby: str = 'author_cell_type',
+                         length_threshold: int = LENGTH_THRESHOLD, count_lowcluster: float = COUNT_LOWCLUSTER,
+                         count_highcluster: float = COUNT_HIGHCLUSTER):
+    """
+    Boolean Series over the store's genes (Ensembl index) of genes that can pass the Xenium filters.
+
+    Arguments:
+        summary_store: camr.store.SummaryStore.
+        groups: Groups whose raw means decide detectability and crowding, e.g. the subtypes of one
+            major class; None for every group.
+        groupby: Grouping of the raw means, 'author_cell_type' or 'majorclass'.
+        length_threshold, count_lowcluster, count_highcluster: The 03.1 filter thresholds.
+    """
+    mean = summary_store.stats('raw', groupby).to_frame('mean')
+    if groups is not None:
+        mean = mean.loc[mean.index.isin(pd.Index(groups).astype(str))]
+    mean = mean.loc[~mean.isnull().all(axis=1)] # Groups without cells
+    detectable = (mean.to_numpy() >= count_lowcluster).any(axis=0)
+    crowding = (mean.to_numpy() > count_highcluster).any(axis=0)
+    long_enough = summary_store.var['feature_length'].to_numpy() >= length_threshold
+    return pd.Series(detectable & ~crowding & long_enough, index=summary_store.var.index, name='panel_feasible')
+
+
+def read_panel_targets(path, category: str = 'current'):
+    """
+    Gene targets of a Xenium panel design JSON (e.g. 9MV3RF_mRetina_91g_panel.json).
+
+    Arguments:
+        path: Panel JSON; targets are under payload.targets.
+        category: Target source category; 'current' for the custom genes of the design, 'base' for
+            the base panel, None for all genes.
+
+    Returns:
+        DataFrame with Ensembl and Marker (gene symbol) columns, one row per gene target.
+    """
+    with open(path) as panel_file:
+        targets = json.load(panel_file)['payload']['targets']
+    genes = [target for target in targets if target['type']['descriptor'] == 'gene'
+             and (category is None or target['source']['category'] == category)]
+    return pd.DataFrame({'Ensembl': [target['type']['data']['id'] for target in genes],
+                         'Marker': [target['type']['data']['name'] for target in genes]})
+
+
+def _keys(labels, match_case):
+    labels = pd.Index(labels).astype(str)
+    return labels if match_case else labels.str.casefold()
+
+
+def _lookup(labels, match_case=False):
+    # Label -> first position
+    labels = _keys(labels, match_case)
+    return pd.Series(np.arange(len(labels)), index=labels).loc[~labels.duplicated()]
+
+
+def _positions(lookup, values, match_case=False):
+    return lookup.reindex(_keys(values, match_case)).fillna(-1).to_numpy(dtype=np.int64)
+
+
+class XeniumFilter:
+    """
+    Xenium length, detection and crowding rules for marker tables, from the summary store's raw means.
+
+    Arguments:
+        summary_store: camr.store.SummaryStore.
+        length_threshold, count_lowcluster, count_highcluster: The filter thresholds.
+        subtype, major: Store groupings of the subtype and major class levels.
+        minor_keep_majors: Major classes whose subtypes decide minor_keep.
+        match_case: Match cell-type labels exactly and markers against the capitalized gene symbols,
+            as the 05.1 merges did; labels and symbols match case-insensitively otherwise.
+    """
+
+    def __init__(self, summary_store, length_threshold: int = LENGTH_THRESHOLD,
+                 count_lowcluster: float = COUNT_LOWCLUSTER, count_highcluster: float = COUNT_HIGHCLUSTER,
+                 subtype: str = 'author_cell_type', major: str = 'majorclass',
+                 minor_keep_majors=MINOR_KEEP_MAJORS, match_case: bool = False):
+        self.length_threshold = length_threshold
+        self.count_lowcluster = count_lowcluster
+        self.count_highcluster = count_highcluster
+        self.match_case = match_case
+        self.var = summary_store.var
+        symbols = self.var['feature_name'].astype(str)
+        self.genes = _lookup(symbols.str.capitalize() if match_case else symbols, match_case)
+        self.length = self.var['feature_length'].to_numpy()
+
+        minor = summary_store.stats('raw', subtype)
+        majors = summary_store.stats('raw', major)
+        self.subtypes, self.majors = minor.groups.astype(str), majors.groups.astype(str)
+        self.minor_mean = minor.mean  # subtypes x genes
+        self.major_mean = majors.mean # majors x genes
+
+        # Subtypes labelled with their major class name are that class's unassigned cells
+        major_names = set(_keys(self.majors, match_case))
+        aliases = [name for name in self.subtypes if _keys([name], match_case)[0] in major_names]
+        self.subtype_lookup = pd.concat([_lookup(self.subtypes, match_case),
+                                         _lookup(['Unassigned_' + name for name in aliases], match_case)
+                                         .map(dict(enumerate(self.subtypes.get_indexer(aliases))))])
+        self.major_lookup = _lookup(self.majors, match_case)
+
+        # Per major class and gene: highest raw mean of its subtypes, so "any subtype reaches the limit /
+        # exceeds the ceiling" is one comparison for any threshold
+        pairs = summary_store.group_pairs(subtype, major)
+        subtype_codes = self.subtypes.get_indexer(pairs[subtype].astype(str))
+        major_codes = self.majors.get_indexer(pairs[major].astype(str))
+        paired = (subtype_codes >= 0) & (major_codes >= 0)
+        self.minor_max = np.full((len(self.majors), self.minor_mean.shape[1]), -np.inf) # majors x genes
+        for row in range(len(self.majors)):
+            members = subtype_codes[paired & (major_codes == row)]
+            if len(members):
+                self.minor_max[row] = np.fmax.reduce(self.minor_mean[members], axis=0) # NaN (no cells) ignored
+        self.major_max = np.fmax.reduce(self.major_mean, axis=0)
+
+        # minor_keep is per gene: some minor_keep_majors class has a detectable subtype, and some such
+        # class has no crowding subtype (NaN, no cells, counts as not crowding)
+        keep_rows = _positions(self.major_lookup, minor_keep_majors, match_case)
+        keep_max = self.minor_max[keep_rows[keep_rows >= 0]]
+        self.keep_max = np.fmax.reduce(keep_max, axis=0, initial=-np.inf)
+        self.keep_min = np.min(np.nan_to_num(keep_max, nan=-np.inf), axis=0, initial=np.inf)
+
+    def _resolve(self, markers, marker, target, major):
+        # Threshold-independent values of every marker row
+        gene = _positions(self.genes, markers[marker], self.match_case)
+        sub = _positions(self.subtype_lookup, markers[target], self.match_case)
+        maj = _positions(self.major_lookup, markers[major], self.match_case)
+        known = gene >= 0
+        g = np.where(known, gene, 0)
+
+        def gather(values, rows, fill):
+            # values[rows, gene] where both are known, else fill
+            ok = known & (rows >= 0)
+            return np.where(ok, values[np.where(rows >= 0, rows, 0), g], fill)
+
+        return dict(gene=g, known=known, length=np.where(known, self.length[g], np.nan),
+                    minor_target=gather(self.minor_mean, sub, np.nan), major_target=gather(self.major_mean, maj, np.nan),
+                    minor_max=gather(self.minor_max, maj, np.nan), minor_known=known & (maj >= 0),
+                    major_max=np.where(known, self.major_max[g], np.nan),
+                    keep_max=np.where(known, self.keep_max[g], np.nan), keep_min=np.where(known, self.keep_min[g], np.nan),
+                    is_major=_positions(self.major_lookup, markers[target], self.match_case) >= 0)
+
+    @staticmethod
+    def _rules(rows, length_threshold, count_lowcluster, count_highcluster):
+        # Every rule of annotate() for resolved rows; thresholds may be (combinations, 1) arrays for a grid
+        with np.errstate(invalid='ignore'):
+            rules = {'Long_Enough': rows['known'] & (rows['length'] >= length_threshold),
+                     'Detectable_Minor_Expression': rows['minor_target'] >= count_lowcluster,
+                     'Detectable_Major_Expression': rows['major_target'] >= count_lowcluster,
+                     'Minor_Detectable': rows['minor_known'] & (rows['minor_max'] >= count_lowcluster),
+                     'Minor_Crowding_Risk': ~rows['minor_known'] | (rows['minor_max'] > count_highcluster), # Assumed when unknown
+                     'Major_Detectable': rows['known'] & (rows['major_max'] >= count_lowcluster),
+                     'Major_Crowding_Risk': rows['known'] & (rows['major_max'] > count_highcluster)}
+        rules['Detectable_Expression'] = rules['Detectable_Major_Expression'] | rules['Detectable_Minor_Expression']
+        rules['Optical_Crowding_Risk'] = rules['Major_Crowding_Risk'] | rules['Minor_Crowding_Risk']
+        rules['Xenium_Filter'] = rules['Long_Enough'] & rules['Detectable_Expression'] & ~rules['Optical_Crowding_Risk']
+        rules['major_keep'] = rules['Long_Enough'] & rules['Major_Detectable'] & ~rules['Major_Crowding_Risk']
+        with np.errstate(invalid='ignore'):
+            rules['minor_keep'] = ~rows['known'] | ((rows['keep_max'] >= count_lowcluster) & ~(rows['keep_min'] > count_highcluster)) # Leaky when unknown
+        rules['final_keep'] = np.where(rows['is_major'], rules['major_keep'], rules['minor_keep'])
+        rules['minor_filter'] = rules['Long_Enough'] & rules['Minor_Detectable'] & ~rules['Minor_Crowding_Risk']
+        return rules
+
+    def annotate(self, markers, marker: str = 'Marker', target: str = 'Queried_Name', major: str = 'Major_Name',
+                 group_columns: bool = True):
+        """
+        Copy of `markers` with every rule as a column.
+
+        Arguments:
+            markers: Table with a gene symbol, target subtype and target major class per row; names
+                match as set by match_case and 'Unassigned_<class>' finds the unassigned cells of a class.
+            marker, target, major: Their columns; target may name a major class (major class markers).
+            group_columns: Also add the raw mean of the marker in every major class, one column each.
+
+        Columns added:
+            Ensembl, feature_length, Not_In_Data, Long_Enough;
+            Raw_Mean_Expression_Minorclass_Target / _Majorclass_Target and Detectable_Minor_Expression /
+            Detectable_Major_Expression: raw mean in the target groups and whether it reaches the limit;
+            Minor_Detectable / Minor_Crowding_Risk: any subtype of the target major class reaches the
+            limit / exceeds the ceiling (crowding assumed when unknown); Major_Detectable /
+            Major_Crowding_Risk: the same over all major classes;
+            Detectable_Expression, Optical_Crowding_Risk and Xenium_Filter (the 05 filter);
+            is_major, major_keep, minor_keep and final_keep (the 05.1 filter; minor_keep depends on the
+            gene only: some minor_keep_majors class has a detectable subtype and some has no crowding one);
+            minor_filter: long enough, detectable in and crowding no subtype of the major class (the 03.1 filter).
+        """
+        table = markers.copy()
+        rows = self._resolve(table, marker, target, major)
+        rules = self._rules(rows, self.length_threshold, self.count_lowcluster, self.count_highcluster)
+        known, g = rows['known'], rows['gene']
+        table['Ensembl'] = np.where(known, self.var.index.to_numpy()[g], None)
+        table['feature_length'] = rows['length']
+        table['Not_In_Data'] = ~known
+        table['Long_Enough'] = rules['Long_Enough']
+        table['Raw_Mean_Expression_Minorclass_Target'] = rows['minor_target']
+        table['Detectable_Minor_Expression'] = rules['Detectable_Minor_Expression']
+        table['Raw_Mean_Expression_Majorclass_Target'] = rows['major_target']
+        table['Detectable_Major_Expression'] = rules['Detectable_Major_Expression']
+        for name in ['Minor_Detectable', 'Minor_Crowding_Risk', 'Major_Detectable', 'Major_Crowding_Risk']:
+            table[name] = rules[name]
+        if group_columns:
+            for row, name in enumerate(self.majors):
+                table[name] = np.where(known, self.major_mean[row, g], np.nan)
+        for name in ['Detectable_Expression', 'Optical_Crowding_Risk', 'Xenium_Filter']:
+            table[name] = rules[name]
+        table['is_major'] = rows['is_major']
+        for name in ['major_keep', 'minor_keep', 'final_keep', 'minor_filter']:
+            table[name] = rules[name]
+        return table
+
+    def sweep(self, markers, length_thresholds=(LENGTH_THRESHOLD,), count_lowclusters=(COUNT_LOWCLUSTER,),
+              count_highclusters=(COUNT_HIGHCLUSTER,), rule: str = 'final_keep', marker: str = 'Marker',
+              target: str = 'Queried_Name', major: str = 'Major_Name'):
+        """
+        Evaluate one filter rule of annotate() over a grid of thresholds in one pass.
+
+        The rows are resolved once; every rule is a comparison of per-row raw means and lengths with
+        the thresholds, so the whole grid is a (combinations x rows) boolean array.
+
+        Arguments:
+            markers: Marker table as for annotate().
+            length_thresholds, count_lowclusters, count_highclusters: Values of each threshold; every
+                combination is evaluated.
+            rule: Keep column of annotate(): 'final_keep' (05.1), 'Xenium_Filter' (05) or 'minor_filter' (03.1).
+            marker, target, major: Columns as for annotate().
+
+        Returns:
+            summary: One row per combination: the thresholds, N_Kept, and N_Gained / N_Lost against
+                this filter's own thresholds.
+            counts: Rows kept per combination and class, Level 'majorclass' (by the major column) or
+                'minorclass' (by the target column).
+            flips: Rows whose keep differs from this filter's thresholds, per combination, with Kept
+                the value under the combination.
+        """
+        rows = self._resolve(markers, marker, target, major)
+        grid = pd.MultiIndex.from_product([length_thresholds, count_lowclusters, count_highclusters],
+                                          names=['Length_Threshold', 'Count_Lowcluster', 'Count_Highcluster']).to_frame(index=False)
+        thresholds = [grid[column].to_numpy(dtype=float)[:, np.newaxis] for column in grid.columns]
+        keep = np.broadcast_to(self._rules(rows, *thresholds)[rule], (len(grid), len(markers))) # combinations x rows
+        baseline = self._rules(rows, self.length_threshold, self.count_lowcluster, self.count_highcluster)[rule]
+
+        summary = grid.assign(N_Kept=keep.sum(axis=1), N_Gained=(keep & ~baseline).sum(axis=1),
+                              N_Lost=(~keep & baseline).sum(axis=1))
+        counts = []
+        for level, column in [('majorclass', major), ('minorclass', target)]:
+            codes, names = pd.factorize(markers[column].astype(str))
+            indicator = np.zeros((len(markers), len(names)), dtype=np.int64)
+            indicator[np.arange(len(markers)), codes] = 1
+            kept = keep.astype(np.int64) @ indicator # combinations x classes
+            counts += [pd.concat([grid.loc[grid.index.repeat(len(names))].reset_index(drop=True),
+                                  pd.DataFrame({'Level': level, 'Name': np.tile(names, len(grid)),
+                                                'N_Markers': np.tile(indicator.sum(axis=0), len(grid)),
+                                                'N_Kept': kept.ravel()})], axis=1)]
+        combination, row = np.nonzero(keep != baseline)
+        flips = pd.concat([grid.iloc[combination].reset_index(drop=True),
+                           markers[[marker, target, major]].iloc[row].reset_index(drop=True),
+                           pd.DataFrame({'Kept': keep[combination, row]})], axis=1)
+        return summary, pd.concat(counts, ignore_index=True), flips
@@ -0,0 +1,10 @@
+import os
+
+from camr.gene_major import build_gene_major, gene_major_path
+
+# One-time gene-major (CSC) copies of raw.X and X for the stages that read a few hundred marker genes
+block_size = 20000 # Cells per streamed row block
+
+for h5ad_path in ['01_QualityControl/1_camr_scrublet_batch_filtered.h5ad', '10_Make_Shiny/10_Shiny_Input.h5ad']:
+  if os.path.isfile(h5ad_path) and not os.path.isfile(gene_major_path(h5ad_path)):
+    build_gene_major(h5ad_path, block_size = block_size, verbose = True)
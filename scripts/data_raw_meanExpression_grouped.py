@@ -1,24 +1,38 @@
 import sklearn as sk
 import anndata as ad
-import scanpy as sc 
+import scanpy as sc
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
 import os
 
+from camr.aggregate import aggregate_groups, aggregate_groups_backed
+
 sc.settings.n_jobs = -1
 
-adata = ad.read_h5ad('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad')
-genes = adata.var["feature_name"].astype(str).tolist()
+streaming = True # Stream raw/X in row blocks through backed='r' so this runs on a normal worker node
+block_size = 20000 # Cells per block when streaming
+n_jobs = 16 # Worker processes, each aggregating its own range of cells
 
 fmajorname = 'data/raw_meanExpression_majorclass.txt'
-if not os.path.isfile(fmajorname):
-  raw_feature_expression_pd = pd.DataFrame(adata.raw.X.toarray(), columns = genes)
-  raw_feature_expression_pd["majorclass"] = adata.obs["majorclass"].tolist()
-  raw_feature_expression_pd.groupby("majorclass").agg("mean").to_csv(fmajorname, sep = '\t')
-
 fminorname = 'data/raw_meanExpression_minorclass.txt'
-if not os.path.isfile(fminorname):
-  raw_feature_expression_pd = pd.DataFrame(adata.raw.X.toarray(), columns = genes)
-  raw_feature_expression_pd["author_cell_type"] = adata.obs["author_cell_type"].tolist()
-  raw_feature_expression_pd.groupby("author_cell_type").agg("mean").to_csv(fminorname, sep = '\t')
+fmajorfrac = 'data/raw_fracExpression_majorclass.txt'
+fminorfrac = 'data/raw_fracExpression_minorclass.txt'
+
+if not all(os.path.isfile(f) for f in [fmajorname, fminorname, fmajorfrac, fminorfrac]):
+  if streaming:
+    adata = ad.read_h5ad('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad', backed = 'r')
+    genes = adata.var["feature_name"].astype(str).tolist()
+    adata.file.close()
+    group_stats = aggregate_groups_backed('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad', ["majorclass", "author_cell_type"],
+                                          matrix = 'raw/X', genes = genes, block_size = block_size, verbose = True, n_jobs = n_jobs)
+  else:
+    adata = ad.read_h5ad('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad')
+    genes = adata.var["feature_name"].astype(str).tolist()
+    # One sparse pass for both groupings instead of densifying raw.X once per grouping
+    group_stats = aggregate_groups(adata.raw.X, adata.obs, ["majorclass", "author_cell_type"], genes = genes, n_jobs = n_jobs)
+
+  # Only groups with cells, like the groupby over the labels; unused categorical levels would be all-NaN rows
+  for groupby, stat, fname in [("majorclass", "mean", fmajorname), ("author_cell_type", "mean", fminorname),
+                               ("majorclass", "frac", fmajorfrac), ("author_cell_type", "frac", fminorfrac)]:
+    group_stats[groupby].to_frame(stat).loc[group_stats[groupby].n_cells > 0].to_csv(fname, sep = '\t')
@@ -0,0 +1,8 @@
+from camr.specificity import build_specificity
+
+# One-vs-rest AUROC and detection-rate lift of every gene x majorclass / author_cell_type, written into the summary store
+# Needs the gene-major copies (data_gene_major.py); read back with load_summary_store().frame('auroc', 'norm', 'author_cell_type')
+n_jobs = 16 # Worker processes, each ranking its own block of genes
+entries_per_block = 20000000 # Nonzeros per block, bounds the memory of each worker
+
+build_specificity('01_QualityControl/1_camr_scrublet_batch_filtered.h5ad', entries_per_block = entries_per_block, n_jobs = n_jobs)